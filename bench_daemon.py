@@ -0,0 +1,1355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Xeray UI - Бенчмарки демона
+Замеры производительности подсистем демона на синтетических данных
+
+Пример запуска:
+    python bench_daemon.py check_status --servers 1000 --requests 20000
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import os
+import random
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from typing import Dict, Any
+
+import aiohttp
+import aiohttp.web
+
+import daemon as daemon_module
+from daemon import (XrayDaemon, DeadlineIndex, HashRing, HealthProber, RequestAuthenticator,
+                    ServerRecord, ServerRegistry, UserDeltaTracker, WorkerSupervisor, SQL_INSERT_SERVER)
+
+
+def make_daemon(workdir: str, **kwargs) -> XrayDaemon:
+    """Создание демона с временной базой данных"""
+    return XrayDaemon(host='127.0.0.1', port=0, db_path=os.path.join(workdir, 'daemon.db'), **kwargs)
+
+
+async def seed_servers(daemon: XrayDaemon, count: int, port: int = None, config_dir: str = '/etc/xray',
+                       agent_url: str = None):
+    """Подключение синтетических серверов через команду connect"""
+    for server_id in range(1, count + 1):
+        result = await daemon.process_command('connect', {
+            'server_id': server_id,
+            'server_name': f'node-{server_id}',
+            'server_ip': '127.0.0.1',
+            'server_port': port or 10000 + server_id % 50000,
+            'config_path': os.path.join(config_dir, f'node-{server_id}.json'),
+            'agent_url': agent_url
+        })
+        if not result.get('success'):
+            raise RuntimeError(f"Не удалось подключить сервер {server_id}: {result}")
+
+
+async def serve_api(daemon: XrayDaemon, port: int = 0, reuse_port: bool = False):
+    """Запуск API демона на локальном порту (по умолчанию свободном), возвращает (runner, базовый URL)"""
+    runner = aiohttp.web.AppRunner(daemon.build_app(), access_log=None)
+    await runner.setup()
+    site = aiohttp.web.TCPSite(runner, '127.0.0.1', port, reuse_port=reuse_port or None)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://127.0.0.1:{port}'
+
+
+def free_port() -> int:
+    """Свободный локальный порт"""
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+async def run_concurrent(func, total: int, concurrency: int) -> float:
+    """Выполнение total вызовов func(i) с ограниченной параллельностью, возвращает время в секундах"""
+    queue = iter(range(total))
+
+    async def worker():
+        for i in queue:
+            await func(i)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - started
+
+
+async def bench_check_status(args) -> Dict[str, Any]:
+    """Пропускная способность check_status"""
+    workdir = tempfile.mkdtemp(prefix='xeray-bench-')
+    daemon = make_daemon(workdir)
+    try:
+        await seed_servers(daemon, args.servers)
+
+        async def check(i):
+            await daemon.process_command('check_status', {'server_id': i % args.servers + 1})
+
+        elapsed = await run_concurrent(check, args.requests, args.concurrency)
+
+        return {
+            'servers': args.servers,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'rps': round(args.requests / elapsed)
+        }
+    finally:
+        daemon.db.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+async def bench_warm_start(args) -> Dict[str, Any]:
+    """Время загрузки таблицы servers в реестр при запуске демона"""
+    workdir = tempfile.mkdtemp(prefix='xeray-bench-')
+    daemon = make_daemon(workdir)
+    try:
+        rows = [
+            (i, f'daemon_{i}_1700000000', f'node-{i}', '10.0.0.1', 443, '/etc/xray/config.json', None)
+            for i in range(1, args.servers + 1)
+        ]
+        await daemon.db.executemany(SQL_INSERT_SERVER, rows)
+        del rows
+
+        started = time.perf_counter()
+        loaded = await daemon.load_servers()
+        elapsed = time.perf_counter() - started
+
+        # Пиковую память замеряем отдельным проходом: tracemalloc замедляет загрузку
+        daemon.servers = ServerRegistry()
+        tracemalloc.start()
+        await daemon.load_servers()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        return {
+            'servers': loaded,
+            'seconds': round(elapsed, 3),
+            'peak_memory_mb': round(peak / 1024 / 1024, 1)
+        }
+    finally:
+        daemon.db.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+async def bench_batch(args) -> Dict[str, Any]:
+    """Нагрузочный тест: одиночные HTTP-запросы check_status против /api/batch"""
+    workdir = tempfile.mkdtemp(prefix='xeray-bench-')
+    daemon = make_daemon(workdir)
+    runner = None
+    try:
+        await seed_servers(daemon, args.servers)
+        runner, base_url = await serve_api(daemon)
+        headers = {'X-Auth-Key': daemon.secret}
+
+        async with aiohttp.ClientSession(headers=headers) as session:
+            async def single(i):
+                payload = {'server_id': i % args.servers + 1}
+                async with session.post(f'{base_url}/api/check_status', json=payload) as response:
+                    await response.read()
+
+            async def batch(i):
+                first = i * args.batch_size
+                payload = [
+                    {'command': 'check_status', 'data': {'server_id': (first + j) % args.servers + 1}}
+                    for j in range(args.batch_size)
+                ]
+                async with session.post(f'{base_url}/api/batch', json=payload) as response:
+                    await response.read()
+
+            single_time = await run_concurrent(single, args.requests, args.concurrency)
+            batches = max(1, args.requests // args.batch_size)
+            batch_time = await run_concurrent(batch, batches, min(args.concurrency, batches))
+
+        return {
+            'servers': args.servers,
+            'commands': args.requests,
+            'batch_size': args.batch_size,
+            'single_commands_per_sec': round(args.requests / single_time),
+            'batch_commands_per_sec': round(batches * args.batch_size / batch_time)
+        }
+    finally:
+        if runner:
+            await runner.cleanup()
+        daemon.db.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+async def start_stub_listeners(count: int):
+    """Запуск локальных TCP-заглушек узлов, возвращает (серверы, порты)"""
+    async def handle(reader, writer):
+        writer.close()
+
+    listeners = [await asyncio.start_server(handle, '127.0.0.1', 0, backlog=1024) for _ in range(count)]
+    ports = [listener.sockets[0].getsockname()[1] for listener in listeners]
+    return listeners, ports
+
+
+async def bench_probe(args) -> Dict[str, Any]:
+    """Скорость проверки доступности парка узлов на локальных заглушках"""
+    listeners, ports = await start_stub_listeners(args.listeners)
+    try:
+        result = {}
+        for count in (1000, 10000):
+            targets = [
+                ServerRecord(i, f'daemon_{i}', f'node-{i}', '127.0.0.1', ports[i % len(ports)], '/etc/xray/config.json')
+                for i in range(count)
+            ]
+            prober = HealthProber(ServerRegistry(), concurrency=args.concurrency, timeout=args.timeout)
+
+            started = time.perf_counter()
+            results = await prober.sweep(targets)
+            elapsed = time.perf_counter() - started
+
+            result[count] = {
+                'seconds_per_sweep': round(elapsed, 3),
+                'sweeps_per_sec': round(1 / elapsed, 2),
+                'probes_per_sec': round(count / elapsed),
+                'online': sum(results.values())
+            }
+        return result
+    finally:
+        for listener in listeners:
+            listener.close()
+            await listener.wait_closed()
+
+
+async def bench_stats_history(args) -> Dict[str, Any]:
+    """Запись синтетических точек статистики и выборки по диапазонам времени"""
+    workdir = tempfile.mkdtemp(prefix='xeray-bench-')
+    daemon = make_daemon(workdir)
+    collector = daemon.collector
+    try:
+        # Точки раз в минуту для каждого сервера, заканчивая текущим временем
+        per_server = max(1, args.points // args.servers)
+        end = int(time.time())
+        start = end - per_server * 60
+        chunk = []
+        started = time.perf_counter()
+        for step in range(per_server):
+            timestamp = start + step * 60
+            for server_id in range(1, args.servers + 1):
+                chunk.append((server_id, timestamp, random.randint(0, 500),
+                              random.randint(0, 10 ** 7), random.randint(0, 10 ** 8)))
+            if len(chunk) >= 50000:
+                await collector.write(chunk)
+                chunk = []
+        await collector.write(chunk)
+        write_time = time.perf_counter() - started
+
+        result = {
+            'points': collector.points_written,
+            'servers': args.servers,
+            'write_points_per_sec': round(collector.points_written / write_time)
+        }
+
+        windows = {
+            'raw_1h': ('raw', 3600),
+            'raw_7d': ('raw', 7 * 86400),
+            '1m_6h': ('1m', 6 * 3600),
+            '1h_7d': ('1h', 7 * 86400),
+            '1d_90d': ('1d', 90 * 86400),
+        }
+        for name, (resolution, span) in windows.items():
+            started = time.perf_counter()
+            returned = 0
+            for _ in range(args.queries):
+                server_id = random.randint(1, args.servers)
+                window_end = random.randint(min(start + span, end), end)
+                history = await collector.query(server_id, window_end - span, window_end, resolution)
+                returned += len(history['points'])
+            elapsed = time.perf_counter() - started
+            result[name] = {
+                'avg_ms': round(elapsed / args.queries * 1000, 3),
+                'avg_points': round(returned / args.queries, 1)
+            }
+        return result
+    finally:
+        daemon.db.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+async def bench_aggregate(args) -> Dict[str, Any]:
+    """Скорость агрегации статистики парка (пользователи распределены по серверам)"""
+    import daemon as daemon_module
+
+    users_per_server = max(1, args.users // args.servers)
+    latest = {
+        server_id: daemon_module.normalize_stats({
+            'uptime': random.randint(0, 10 ** 6),
+            'inbound_connections': random.randint(0, 500),
+            'outbound_connections': random.randint(0, 500),
+            'total_up': random.randint(0, 10 ** 12),
+            'total_down': random.randint(0, 10 ** 12),
+            'users': [
+                {'id': user_id, 'email': f'user{user_id}@example.com',
+                 'up': random.randint(0, 10 ** 10), 'down': random.randint(0, 10 ** 10)}
+                for user_id in range(server_id * users_per_server, (server_id + 1) * users_per_server)
+            ]
+        })
+        for server_id in range(args.servers)
+    }
+
+    result = {'servers': args.servers, 'users': users_per_server * args.servers}
+    backends = [('numpy', daemon_module.numpy), ('array', None)] if daemon_module.numpy else [('array', None)]
+    original = daemon_module.numpy
+    try:
+        for name, backend in backends:
+            daemon_module.numpy = backend
+            started = time.perf_counter()
+            for _ in range(args.queries):
+                daemon_module.aggregate_stats(latest, top_n=10)
+            result[f'{name}_ms'] = round((time.perf_counter() - started) / args.queries * 1000, 2)
+    finally:
+        daemon_module.numpy = original
+    return result
+
+
+async def bench_delta(args) -> Dict[str, Any]:
+    """Размер и время сериализации ответа get_stats: полный снимок против изменений"""
+    users = [
+        {'id': i, 'email': f'user{i}@example.com', 'up': random.randint(0, 10 ** 10), 'down': random.randint(0, 10 ** 10)}
+        for i in range(args.users)
+    ]
+    tracker = UserDeltaTracker()
+    tracker.update(users)
+    cursor = tracker.cursor
+
+    # Следующий опрос: меняются счетчики у доли пользователей
+    changed = random.sample(range(args.users), max(1, int(args.users * args.changed_ratio)))
+    users = [dict(user) for user in users]
+    for i in changed:
+        users[i]['up'] += random.randint(1, 10 ** 6)
+
+    started = time.perf_counter()
+    tracker.update(users)
+    update_ms = (time.perf_counter() - started) * 1000
+
+    def measure(build):
+        started = time.perf_counter()
+        for _ in range(args.queries):
+            body = json.dumps(build()).encode()
+        return len(body), (time.perf_counter() - started) / args.queries * 1000
+
+    full_size, full_ms = measure(lambda: {'stats': {'users': tracker.snapshot()}, 'cursor': tracker.cursor})
+
+    def delta():
+        changed_users, removed = tracker.changes_since(tracker.parse_cursor(cursor))
+        return {'stats': {'users': changed_users, 'removed_users': removed}, 'cursor': tracker.cursor}
+
+    delta_size, delta_ms = measure(delta)
+
+    return {
+        'users': args.users,
+        'changed': len(changed),
+        'tracker_update_ms': round(update_ms, 2),
+        'full_bytes': full_size,
+        'full_ms': round(full_ms, 2),
+        'delta_bytes': delta_size,
+        'delta_ms': round(delta_ms, 3)
+    }
+
+
+async def bench_ws(args) -> Dict[str, Any]:
+    """Нагрузочный тест /ws: доставка событий смены статуса множеству подписчиков"""
+    workdir = tempfile.mkdtemp(prefix='xeray-bench-')
+    daemon = make_daemon(workdir)
+    runner = None
+    try:
+        await seed_servers(daemon, args.servers)
+        runner, base_url = await serve_api(daemon)
+        servers = list(daemon.servers)
+
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector, headers={'X-Auth-Key': daemon.secret}) as session:
+            # Каждый подписчик следит за watch_count случайными серверами
+            started = time.perf_counter()
+            clients = []
+            for _ in range(args.subscribers):
+                ws = await session.ws_connect(f'{base_url}/ws')
+                watched = random.sample(range(1, args.servers + 1), min(args.watch_count, args.servers))
+                await ws.send_json({'action': 'subscribe', 'server_ids': watched})
+                clients.append((ws, set(watched)))
+            connect_time = time.perf_counter() - started
+
+            # Дожидаемся начальных снимков статуса
+            for ws, watched in clients:
+                for _ in watched:
+                    await ws.receive()
+
+            async def consume(ws, expected):
+                for _ in range(expected):
+                    await ws.receive()
+
+            events = [servers[i % len(servers)] for i in range(args.events)]
+            expected = [sum(1 for server in events if server.server_id in watched) for _, watched in clients]
+            consumers = [asyncio.create_task(consume(ws, count)) for (ws, _), count in zip(clients, expected)]
+
+            started = time.perf_counter()
+            for i, server in enumerate(events):
+                daemon.set_server_status(server, 'offline' if server.status != 'offline' else 'online')
+                if i % 100 == 0:
+                    await asyncio.sleep(0)
+            publish_time = time.perf_counter() - started
+            await asyncio.gather(*consumers)
+            delivery_time = time.perf_counter() - started
+
+            for ws, _ in clients:
+                await ws.close()
+
+        return {
+            'subscribers': args.subscribers,
+            'events': args.events,
+            'messages_delivered': sum(expected),
+            'connect_seconds': round(connect_time, 2),
+            'publish_ms': round(publish_time * 1000, 1),
+            'delivery_seconds': round(delivery_time, 2),
+            'messages_per_sec': round(sum(expected) / delivery_time),
+            'hub': daemon.events.stats()
+        }
+    finally:
+        if runner:
+            await runner.cleanup()
+        daemon.db.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+async def start_stub_node_api(users: int = 0):
+    """Запуск заглушки агента узла (статистика, запись конфигурации, перезапуск XRay, пользователи)"""
+    calls = {'stats': 0, 'config': 0, 'restart': 0, 'users_add': 0, 'users_remove': 0}
+    started = time.time()
+
+    cache = {}
+
+    async def stats(request):
+        # Заглушка работает в том же процессе, поэтому тело ответа строится раз в секунду
+        calls['stats'] += 1
+        elapsed = int(time.time() - started)
+        if elapsed not in cache:
+            cache.clear()
+            cache[elapsed] = json.dumps({
+                'uptime': elapsed,
+                'inbound_connections': users,
+                'outbound_connections': users,
+                'total_up': elapsed * 1000,
+                'total_down': elapsed * 3000,
+                'users': [{'id': i, 'email': f'user{i}@example.com', 'up': elapsed * i, 'down': elapsed * i * 3}
+                          for i in range(users)]
+            }).encode()
+        return aiohttp.web.Response(body=cache[elapsed], content_type='application/json')
+
+    def counter(name):
+        async def handle(request):
+            calls[name] += 1
+            return aiohttp.web.json_response({'success': True})
+        return handle
+
+    app = aiohttp.web.Application()
+    app.router.add_get('/stats', stats)
+    app.router.add_post('/config', counter('config'))
+    app.router.add_post('/restart', counter('restart'))
+    app.router.add_post('/users/add', counter('users_add'))
+    app.router.add_post('/users/remove', counter('users_remove'))
+
+    runner = aiohttp.web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = aiohttp.web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, site._server.sockets[0].getsockname()[1], calls
+
+
+async def bench_hot_reload(args) -> Dict[str, Any]:
+    """Применение изменений пользователей без перезапуска XRay на заглушке API узла"""
+    workdir = tempfile.mkdtemp(prefix='xeray-bench-')
+    daemon = make_daemon(workdir)
+    runner, port, calls = await start_stub_node_api()
+    try:
+        await seed_servers(daemon, args.servers, config_dir=workdir, agent_url=f'http://127.0.0.1:{port}')
+        await daemon.node_client.start()
+        await daemon.jobs.start()
+
+        users_per_server = max(1, args.users // args.servers)
+        base = {
+            'inbounds': [{'tag': 'vless-in', 'port': 443, 'protocol': 'vless', 'settings': {'clients': [
+                {'id': f'uuid-{i}', 'email': f'user{i}@example.com'} for i in range(users_per_server)
+            ]}}],
+            'outbounds': [{'protocol': 'freedom'}]
+        }
+
+        # Начальная конфигурация на всех серверах
+        hashes = {}
+        for server in daemon.servers:
+            result = await daemon.process_command('update_config', {'server_id': server.server_id, 'config': base, 'wait': True})
+            hashes[server.server_id] = result['result']['hash']
+        initial = dict(daemon.reload_stats)
+
+        # Изменения пользователей патчами: добавление и удаление по очереди.
+        # Патч строится от последнего хеша, поэтому изменения одного сервера идут последовательно
+        changes_per_server = max(1, args.requests // args.servers)
+
+        async def change_users(i):
+            server_id = i + 1
+            for step in range(changes_per_server):
+                if step % 2 == 0:
+                    patch = [{'op': 'add', 'path': '/inbounds/0/settings/clients/-',
+                              'value': {'id': f'uuid-new-{step}', 'email': f'new{step}@example.com'}}]
+                else:
+                    patch = [{'op': 'remove', 'path': '/inbounds/0/settings/clients/0'}]
+                result = await daemon.process_command('update_config', {
+                    'server_id': server_id, 'patch': patch, 'base_hash': hashes[server_id], 'wait': True
+                })
+                hashes[server_id] = result['result']['hash']
+
+        elapsed = await run_concurrent(change_users, args.servers, min(args.concurrency, args.servers))
+        hot = {key: value - initial[key] for key, value in daemon.reload_stats.items()}
+
+        # Структурное изменение требует перезапуска
+        structural = await daemon.process_command('update_config', {
+            'server_id': 1, 'patch': [{'op': 'replace', 'path': '/inbounds/0/port', 'value': 8443}],
+            'base_hash': hashes[1], 'wait': True
+        })
+
+        return {
+            'servers': args.servers,
+            'users_per_server': users_per_server,
+            'user_changes': changes_per_server * args.servers,
+            'changes_per_sec': round(changes_per_server * args.servers / elapsed),
+            'user_changes_stats': hot,
+            'structural_restarted': structural['result']['restarted'],
+            'node_calls': calls
+        }
+    finally:
+        await daemon.jobs.stop()
+        await daemon.node_client.close()
+        await runner.cleanup()
+        daemon.db.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+async def bench_auth(args) -> Dict[str, Any]:
+    """Накладные расходы проверки подлинности на один запрос"""
+    key = 'k' * 64
+    auth = RequestAuthenticator('daemon-secret-key', {'panel': key}, max_nonces=args.requests)
+    body = json.dumps({'server_id': 1, 'config': {'inbounds': [{'tag': 'in', 'port': 443}]}, 'pad': 'x' * 400}).encode()
+    path = '/api/update_config'
+
+    timestamp = str(int(time.time()))
+    signed = []
+    for i in range(args.requests):
+        nonce = f'{i:016x}'
+        signed.append({
+            'X-Auth-Caller': 'panel',
+            'X-Auth-Timestamp': timestamp,
+            'X-Auth-Nonce': nonce,
+            'X-Auth-Signature': RequestAuthenticator.sign(key, 'POST', path, timestamp, nonce, body)
+        })
+    legacy = {'X-Auth-Key': 'daemon-secret-key'}
+
+    def measure(func) -> float:
+        started = time.perf_counter()
+        for headers in signed:
+            func(headers)
+        return (time.perf_counter() - started) / len(signed) * 1e6
+
+    plain_us = measure(lambda headers: legacy['X-Auth-Key'] != 'daemon-secret-key')
+    legacy_us = measure(lambda headers: auth.verify('POST', path, legacy, body))
+    hmac_us = measure(lambda headers: auth.verify('POST', path, headers, body))
+    replay_us = measure(lambda headers: auth.verify('POST', path, headers, body))
+
+    # Доля одного ядра, занятая проверкой при 10k запросов в секунду
+    return {
+        'requests': args.requests,
+        'body_bytes': len(body),
+        'plain_compare_us': round(plain_us, 3),
+        'legacy_key_us': round(legacy_us, 3),
+        'hmac_us': round(hmac_us, 3),
+        'replay_reject_us': round(replay_us, 3),
+        'hmac_cpu_share_at_10k_rps': f'{hmac_us * 10000 / 1e6:.1%}',
+        'auth': auth.stats()
+    }
+
+
+def json_payloads(users: int) -> Dict[str, Any]:
+    """Типичные тела запросов и ответов API демона"""
+    clients = [{'id': f'{i:08x}-0000-4000-8000-{i:012x}', 'email': f'user{i}@example.com', 'flow': 'xtls-rprx-vision'}
+               for i in range(users)]
+    return {
+        'command': {'server_id': 123, 'daemon_id': 'daemon_123_1700000000'},
+        'status_response': {'success': True, 'status': 'online', 'last_heartbeat': datetime.now()},
+        'stats_response': {'success': True, 'mode': 'full', 'cursor': 'abcdef12:100', 'stats': {
+            'uptime': 86400, 'inbound_connections': 1200, 'outbound_connections': 1100,
+            'total_up': 10 ** 12, 'total_down': 3 * 10 ** 12,
+            'users': [{'id': i, 'email': f'user{i}@example.com', 'up': i * 1000, 'down': i * 3000} for i in range(users)]
+        }},
+        'update_config': {'server_id': 123, 'config': {
+            'log': {'loglevel': 'warning'},
+            'inbounds': [{'tag': 'vless-in', 'port': 443, 'protocol': 'vless', 'settings': {'clients': clients}}],
+            'outbounds': [{'protocol': 'freedom'}]
+        }}
+    }
+
+
+async def bench_json(args) -> Dict[str, Any]:
+    """Скорость сериализации и разбора JSON на типичных телах запросов и ответов"""
+    codecs = {
+        'json': (lambda value: json.dumps(value, default=str, ensure_ascii=False, separators=(',', ':')).encode(),
+                 json.loads)
+    }
+    if daemon_module.orjson is not None:
+        codecs['orjson'] = (daemon_module.json_dumps, daemon_module.json_loads)
+
+    def timed(func, value, repeat) -> float:
+        started = time.perf_counter()
+        for _ in range(repeat):
+            func(value)
+        return (time.perf_counter() - started) / repeat * 1e6
+
+    result = {'backend': daemon_module.JSON_BACKEND}
+    for users in (100, 1000, 10000, 50000):
+        for name, payload in json_payloads(users).items():
+            if users != 100 and name in ('command', 'status_response'):
+                continue
+            key = name if name in ('command', 'status_response') else f'{name}_{users}_users'
+            encoded = codecs['json'][0](payload)
+            repeat = max(3, min(20000, 2000000 // len(encoded)))
+            result[key] = {'bytes': len(encoded)}
+            for codec, (dumps, loads) in codecs.items():
+                result[key][codec] = {
+                    'encode_us': round(timed(dumps, payload, repeat), 1),
+                    'decode_us': round(timed(loads, encoded, repeat), 1)
+                }
+    return result
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    """Разбор смеси команд вида check_status=70,get_stats=25,update_config=5"""
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def latency_summary(samples) -> Dict[str, float]:
+    """Перцентили задержки в миллисекундах"""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def point(p):
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000, 2)
+
+    return {'p50_ms': point(50), 'p95_ms': point(95), 'p99_ms': point(99), 'max_ms': round(ordered[-1] * 1000, 2)}
+
+
+async def monitor_loop_lag(samples: list, interval: float = 0.01):
+    """Замер отставания цикла событий: насколько позже срабатывает sleep(interval)"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+
+async def bench_load(args) -> Dict[str, Any]:
+    """
+    Нагрузочный тест HTTP API демона
+
+    Демон запускается в этом же процессе на локальном порту с временной базой,
+    серверы указывают на заглушку API узла. Клиент работает в том же цикле
+    событий, поэтому пропускная способность - нижняя оценка.
+    """
+    workdir = tempfile.mkdtemp(prefix='xeray-bench-')
+    daemon = make_daemon(workdir)
+    users_per_server = max(1, args.users // args.servers)
+    stub_runner, stub_port, calls = await start_stub_node_api(users_per_server)
+    runner = None
+    lag_task = None
+    try:
+        await seed_servers(daemon, args.servers, config_dir=workdir, agent_url=f'http://127.0.0.1:{stub_port}')
+        await daemon.node_client.start()
+        await daemon.jobs.start()
+        runner, base_url = await serve_api(daemon)
+
+        mix = parse_mix(args.mix)
+        commands = list(mix)
+        weights = [mix[name] for name in commands]
+        plan = random.Random(42).choices(commands, weights, k=args.requests)
+
+        def payload(name: str, i: int) -> Dict[str, Any]:
+            server_id = i % args.servers + 1
+            if name == 'update_config':
+                # Каждое обновление меняет одного пользователя: путь без перезапуска XRay
+                return {'server_id': server_id, 'wait': True, 'config': {
+                    'inbounds': [{'tag': 'vless-in', 'port': 443, 'settings': {'clients': [
+                        {'id': f'uuid-{i}', 'email': f'load{i}@example.com'}
+                    ]}}]
+                }}
+            return {'server_id': server_id}
+
+        latencies = {name: [] for name in commands}
+        errors = {name: 0 for name in commands}
+        lag = []
+
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector, headers={'X-Auth-Key': daemon.secret}) as session:
+            async def send(i):
+                name = plan[i]
+                started = time.perf_counter()
+                async with session.post(f'{base_url}/api/{name}', json=payload(name, i)) as response:
+                    result = await response.json()
+                latencies[name].append(time.perf_counter() - started)
+                if response.status != 200 or not result.get('success'):
+                    errors[name] += 1
+
+            lag_task = asyncio.create_task(monitor_loop_lag(lag))
+            elapsed = await run_concurrent(send, args.requests, args.concurrency)
+
+        return {
+            'servers': args.servers,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'mix': mix,
+            'rps': round(args.requests / elapsed),
+            'seconds': round(elapsed, 2),
+            'latency': latency_summary([value for samples in latencies.values() for value in samples]),
+            'commands': {
+                name: {'requests': len(latencies[name]), 'errors': errors[name], **latency_summary(latencies[name])}
+                for name in commands
+            },
+            'loop_lag': latency_summary(lag),
+            'node_calls': calls
+        }
+    finally:
+        if lag_task:
+            lag_task.cancel()
+        if runner:
+            await runner.cleanup()
+        await daemon.jobs.stop()
+        await daemon.node_client.close()
+        await stub_runner.cleanup()
+        daemon.db.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+async def bench_logging(args) -> Dict[str, Any]:
+    """Задержка вызова журнала и команды connect при разных настройках журналирования"""
+    workdir = tempfile.mkdtemp(prefix='xeray-bench-')
+    log = logging.getLogger('daemon')
+
+    def sync_file():
+        # Прежняя схема: FileHandler в потоке вызова
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        handler = logging.FileHandler(os.path.join(workdir, 'sync.log'))
+        handler.setFormatter(logging.Formatter(daemon_module.log_format))
+        root.addHandler(handler)
+        root.setLevel(logging.INFO)
+        return None
+
+    modes = {
+        'disabled': lambda: daemon_module.setup_logging('WARNING', workdir, console=False),
+        'sync_file': sync_file,
+        'queue_text': lambda: daemon_module.setup_logging('INFO', workdir, console=False, rate=0),
+        'queue_json': lambda: daemon_module.setup_logging('INFO', workdir, json_lines=True, console=False, rate=0),
+        'queue_rate_limited': lambda: daemon_module.setup_logging('INFO', workdir, console=False, rate=20)
+    }
+
+    result = {}
+    try:
+        for mode, configure in modes.items():
+            listener = configure()
+            mode_dir = os.path.join(workdir, mode)
+            os.makedirs(mode_dir)
+            daemon = make_daemon(mode_dir)
+            try:
+                started = time.perf_counter()
+                for i in range(args.requests):
+                    log.info(f"Сервер node-{i} ({i}) подключен к демону")
+                call_us = (time.perf_counter() - started) / args.requests * 1e6
+
+                # Даем фоновому потоку дописать очередь, чтобы она не влияла на замер команд
+                while listener and not listener.queue.empty():
+                    await asyncio.sleep(0.01)
+
+                # connect пишет в журнал на каждый вызов
+                latencies = []
+                for i in range(args.servers):
+                    started = time.perf_counter()
+                    await daemon.process_command('connect', {
+                        'server_id': i % 100 + 1, 'server_name': f'node-{i}', 'server_ip': '127.0.0.1',
+                        'server_port': 443, 'config_path': '/etc/xray/config.json'
+                    })
+                    latencies.append(time.perf_counter() - started)
+
+                result[mode] = {'log_call_us': round(call_us, 2), 'connect': latency_summary(latencies)}
+            finally:
+                daemon.db.close()
+                if listener:
+                    listener.stop()
+    finally:
+        logging.getLogger().handlers.clear()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {'log_calls': args.requests, 'connects': args.servers, **result}
+
+
+async def bench_deadlines(args) -> Dict[str, Any]:
+    """Стоимость сердцебиения и точность истечения сроков: индекс сроков против полного обхода реестра"""
+    count = args.servers
+    now = datetime.now()
+    workdir = tempfile.mkdtemp(prefix='xeray-bench-')
+    daemon = make_daemon(workdir)
+    try:
+        for server_id in range(1, count + 1):
+            server = ServerRecord(server_id, f'daemon_{server_id}', f'node-{server_id}', '127.0.0.1', 443,
+                                  '/etc/xray/config.json', status='online',
+                                  last_heartbeat=now - timedelta(seconds=random.uniform(0, 30)))
+            daemon.servers.add(server)
+            daemon.schedule_deadlines(server)
+
+        # Сердцебиение: изменение статуса в памяти, буфер записи и перенос сроков
+        servers = [daemon.servers.get(random.randint(1, count)) for _ in range(args.requests)]
+        started = time.perf_counter()
+        for server in servers:
+            daemon.set_server_status(server, 'online', datetime.now())
+        heartbeat_us = (time.perf_counter() - started) / len(servers) * 1e6
+
+        # Перенос срока на более ранний (добавление записи в кучу)
+        index = daemon.offline_deadlines
+        base = time.time()
+        keys = [random.randint(1, count) for _ in range(args.requests)]
+        started = time.perf_counter()
+        for i, key in enumerate(keys):
+            index.schedule(key, base - i)
+        earlier_us = (time.perf_counter() - started) / len(keys) * 1e6
+
+        # Прежний монитор: полный обход реестра раз в минуту
+        current_time = datetime.now()
+        started = time.perf_counter()
+        expired = 0
+        for server_id, server in list(daemon.servers.items()):
+            if server.last_heartbeat and (current_time - server.last_heartbeat).total_seconds() > 300:
+                expired += 1
+        scan_ms = (time.perf_counter() - started) * 1e3
+        heartbeats = daemon.heartbeats.stats()
+        offline_stats = index.stats()
+    finally:
+        daemon.db.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    # Точность: ключи со сроками в ближайшие 2 секунды среди count отдаленных сроков
+    index = DeadlineIndex()
+    for key in range(count):
+        index.schedule(key, time.time() + 3600 + key)
+    base = time.time()
+    due_at = {}
+    for key in range(count, count + args.events):
+        due_at[key] = base + 0.2 + random.uniform(0, 2)
+        index.schedule(key, due_at[key])
+
+    lateness = []
+    fired = asyncio.Event()
+
+    async def on_due(keys):
+        fired_at = time.time()
+        lateness.extend(fired_at - due_at[key] for key in keys)
+        if len(lateness) >= len(due_at):
+            fired.set()
+
+    lag_samples = []
+    lag_task = asyncio.create_task(monitor_loop_lag(lag_samples))
+    task = asyncio.create_task(index.run(on_due))
+    try:
+        await asyncio.wait_for(fired.wait(), timeout=10)
+    finally:
+        task.cancel()
+        lag_task.cancel()
+
+    return {
+        'tracked': count,
+        'heartbeat_us': round(heartbeat_us, 2),
+        'reschedule_earlier_us': round(earlier_us, 2),
+        'full_scan_ms': round(scan_ms, 2),
+        'full_scan_max_delay_s': 60,
+        'heap_size': offline_stats['heap_size'],
+        'compactions': offline_stats['compactions'],
+        'heartbeat_writes': heartbeats['writes'],
+        'expiry_lateness': latency_summary(lateness),
+        'loop_lag': latency_summary(lag_samples)
+    }
+
+
+async def start_cluster_node(workdir: str, node_id: str, port: int, peers: Dict[str, str], interval: float):
+    """Запуск узла кластера в этом процессе, возвращает (демон, runner)"""
+    node_dir = os.path.join(workdir, node_id)
+    os.makedirs(node_dir)
+    daemon = make_daemon(node_dir)
+    daemon.enable_cluster(node_id, f'http://127.0.0.1:{port}', peers, interval=interval, max_failures=2)
+    await daemon.node_client.start()
+    await daemon.jobs.start()
+    runner, _ = await serve_api(daemon, port=port)
+    await daemon.start_cluster()
+    return daemon, runner
+
+
+async def stop_cluster_node(daemon: XrayDaemon, runner, handoff: bool = False):
+    """Остановка узла кластера (с передачей серверов или без)"""
+    for task in daemon.monitoring_tasks:
+        task.cancel()
+    await asyncio.gather(*daemon.monitoring_tasks, return_exceptions=True)
+    daemon.cluster_handoff_on_stop = handoff
+    await daemon.stop_cluster()
+    await runner.cleanup()
+    await daemon.jobs.stop()
+    await daemon.node_client.close()
+    daemon.db.close()
+
+
+async def wait_until(predicate, timeout: float = 30.0) -> float:
+    """Ожидание выполнения условия, возвращает затраченное время в секундах"""
+    started = time.perf_counter()
+    while not predicate():
+        if time.perf_counter() - started > timeout:
+            raise TimeoutError('Условие не выполнено за отведенное время')
+        await asyncio.sleep(0.01)
+    return time.perf_counter() - started
+
+
+async def bench_cluster(args) -> Dict[str, Any]:
+    """
+    Кластер из нескольких демонов на локальных портах
+
+    Замеряет распределение серверов по узлам, задержку команды у владельца и
+    с пересылкой, а также перебалансировку при подключении нового узла и при
+    уходе узла с передачей серверов. Все узлы работают в одном цикле событий.
+    """
+    workdir = tempfile.mkdtemp(prefix='xeray-bench-')
+    interval = 0.2
+    node_ids = [f'node-{chr(ord("a") + i)}' for i in range(args.nodes + 1)]
+    ports = {node_id: free_port() for node_id in node_ids}
+    urls = {node_id: f'http://127.0.0.1:{port}' for node_id, port in ports.items()}
+    initial, joining = node_ids[:-1], node_ids[-1]
+    nodes = {}
+    logging.getLogger().setLevel(logging.WARNING)
+    try:
+        for node_id in initial:
+            peers = {peer: url for peer, url in urls.items() if peer in initial and peer != node_id}
+            nodes[node_id] = await start_cluster_node(workdir, node_id, ports[node_id], peers, interval)
+        first = nodes[initial[0]][0]
+        await wait_until(lambda: all(len(daemon.cluster.ring.nodes) == len(initial) for daemon, _ in nodes.values()))
+
+        def counts():
+            return {node_id: len(daemon.servers) for node_id, (daemon, _) in nodes.items()}
+
+        # Подключение всех серверов через один узел: пакеты пересылаются владельцам
+        started = time.perf_counter()
+        for start in range(1, args.servers + 1, first.batch_max_items):
+            items = [{'command': 'connect', 'data': {
+                'server_id': server_id, 'server_name': f'node-{server_id}', 'server_ip': '127.0.0.1',
+                'server_port': 10000 + server_id % 50000, 'config_path': os.path.join(workdir, f'{server_id}.json')
+            }} for server_id in range(start, min(start + first.batch_max_items, args.servers + 1))]
+            results = await first.process_batch(items)
+            failed = [result for result in results if not result.get('success')]
+            if failed:
+                raise RuntimeError(f"Ошибка подключения серверов: {failed[:3]}")
+        connect_seconds = time.perf_counter() - started
+        distribution = counts()
+
+        # Задержка команды у владельца и с пересылкой через другой узел
+        owned = [server.server_id for server in first.servers]
+        foreign = [server_id for server_id in range(1, args.servers + 1) if server_id not in first.servers]
+
+        async def measure(server_ids):
+            samples = []
+            for i in range(args.requests):
+                started = time.perf_counter()
+                result = await first.process_command('get_config', {'server_id': server_ids[i % len(server_ids)]})
+                samples.append(time.perf_counter() - started)
+                if 'message' in result and 'Узел кластера' in result['message']:
+                    raise RuntimeError(result['message'])
+            return latency_summary(samples)
+
+        local_latency = await measure(owned)
+        forwarded_latency = await measure(foreign)
+
+        # Подключение нового узла: ему передаются серверы его части кольца
+        started = time.perf_counter()
+        nodes[joining] = await start_cluster_node(workdir, joining, ports[joining], {initial[0]: urls[initial[0]]},
+                                                  interval)
+        ring = HashRing(node_ids, nodes[joining][0].cluster.vnodes)
+        expected = sum(1 for server_id in range(1, args.servers + 1) if ring.owner(server_id) == joining)
+        await wait_until(lambda: len(nodes[joining][0].servers) == expected and
+                         sum(counts().values()) == args.servers)
+        join_seconds = time.perf_counter() - started
+        after_join = counts()
+
+        # Уход узла с передачей серверов
+        started = time.perf_counter()
+        daemon, runner = nodes.pop(joining)
+        await stop_cluster_node(daemon, runner, handoff=True)
+        await wait_until(lambda: sum(counts().values()) == args.servers and
+                         all(joining not in node.cluster.ring.nodes for node, _ in nodes.values()))
+        leave_seconds = time.perf_counter() - started
+
+        return {
+            'servers': args.servers,
+            'nodes': len(initial),
+            'connect_seconds': round(connect_seconds, 2),
+            'distribution': distribution,
+            'get_config_local': local_latency,
+            'get_config_forwarded': forwarded_latency,
+            'join': {'moved': expected, 'seconds': round(join_seconds, 2), 'distribution': after_join},
+            'leave_with_handoff': {'seconds': round(leave_seconds, 2), 'distribution': counts()}
+        }
+    finally:
+        for daemon, runner in nodes.values():
+            await stop_cluster_node(daemon, runner)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def serve_worker(workdir: str, port: int, workers: int, worker_id: int):
+    """Рабочий процесс сценария workers: демон на общем порту с синхронизацией реестра"""
+    # Супервизор завершает процессы SIGTERM, обработчик демона здесь не нужен
+    daemon = make_daemon(workdir)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    logging.getLogger().setLevel(logging.ERROR)
+    daemon.worker_id = worker_id
+    daemon.workers = workers
+
+    async def serve():
+        daemon.registry_sync.worker_id = worker_id
+        daemon.registry_sync.enabled = workers > 1
+        await daemon.registry_sync.start()
+        await daemon.load_servers()
+        await daemon.node_client.start()
+        await daemon.jobs.start(recover=False)
+        await serve_api(daemon, port=port, reuse_port=workers > 1)
+        tasks = [asyncio.create_task(daemon.heartbeats.run())]
+        if workers > 1:
+            tasks.append(asyncio.create_task(daemon.registry_sync.run(daemon.apply_registry_changes)))
+        await asyncio.gather(*tasks)
+
+    asyncio.run(serve())
+
+
+async def wait_for_port(port: int, timeout: float = 10.0):
+    """Ожидание, пока порт начнет принимать соединения"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+
+
+async def bench_workers(args) -> Dict[str, Any]:
+    """
+    Пропускная способность HTTP API при разном числе рабочих процессов (SO_REUSEPORT)
+
+    Для каждого числа процессов из --worker-counts замеряются запросы check_status в
+    секунду, время появления нового сервера во всех процессах (через журнал
+    изменений реестра) и время восстановления после SIGKILL одного процесса.
+    Клиент работает в процессе бенчмарка и делит с демоном ядра машины.
+    """
+    counts = [int(value) for value in args.worker_counts.split(',')]
+    result = {'servers': args.servers, 'requests': args.requests, 'concurrency': args.concurrency,
+              'cpu_count': os.cpu_count(), 'workers': {}}
+    loop = asyncio.get_running_loop()
+
+    for count in counts:
+        workdir = tempfile.mkdtemp(prefix='xeray-bench-')
+        seeded = make_daemon(workdir)
+        await seed_servers(seeded, args.servers, config_dir=workdir)
+        seeded.db.close()
+
+        port = free_port()
+
+        supervisor = WorkerSupervisor(count, functools.partial(serve_worker, workdir, port, count),
+                                      restart_delay=0.1, stop_timeout=5)
+        supervision = loop.run_in_executor(None, supervisor.run)
+        try:
+            await wait_for_port(port)
+            await asyncio.sleep(0.5)
+            base_url = f'http://127.0.0.1:{port}'
+            headers = {'X-Auth-Key': seeded.secret}
+
+            connector = aiohttp.TCPConnector(limit=0)
+            async with aiohttp.ClientSession(connector=connector, headers=headers) as session:
+                errors = 0
+
+                async def send(i):
+                    nonlocal errors
+                    async with session.post(f'{base_url}/api/check_status',
+                                            json={'server_id': i % args.servers + 1}) as response:
+                        body = await response.json()
+                    if response.status != 200 or not body.get('success'):
+                        errors += 1
+
+                # Соединения клиента распределяются ядром по процессам при установке
+                await run_concurrent(send, args.concurrency * 4, args.concurrency)
+                elapsed = await run_concurrent(send, args.requests, args.concurrency)
+
+            # Новый сервер подключается через один процесс, остальные узнают о нем из журнала
+            async with aiohttp.ClientSession(headers=headers) as session:
+                server_id = args.servers + 1
+                started = time.perf_counter()
+                async with session.post(f'{base_url}/api/connect', json={
+                    'server_id': server_id, 'server_name': 'node-new', 'server_ip': '127.0.0.1',
+                    'server_port': 443, 'config_path': os.path.join(workdir, 'node-new.json')
+                }) as response:
+                    await response.read()
+
+                # Новые соединения попадают в случайные процессы: ждем серию успешных ответов
+                streak = 0
+                while streak < count * 4:
+                    async with session.post(f'{base_url}/api/check_status', json={'server_id': server_id},
+                                            headers={'Connection': 'close'}) as response:
+                        body = await response.json()
+                    streak = streak + 1 if body.get('success') else 0
+                propagation = time.perf_counter() - started
+
+            # Восстановление после падения процесса
+            victim = supervisor.processes[count - 1]
+            started = time.perf_counter()
+            os.kill(victim.pid, signal.SIGKILL)
+            while supervisor.restarts == 0 or not supervisor.processes[count - 1].is_alive():
+                await asyncio.sleep(0.01)
+            await wait_for_port(port)
+            respawn = time.perf_counter() - started
+
+            result['workers'][count] = {
+                'rps': round(args.requests / elapsed),
+                'errors': errors,
+                'propagation_ms': round(propagation * 1000, 1),
+                'respawn_ms': round(respawn * 1000, 1),
+                'restarts': supervisor.restarts
+            }
+        finally:
+            supervisor.stop()
+            await supervision
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    base = result['workers'][counts[0]]['rps']
+    for stats in result['workers'].values():
+        stats['speedup'] = round(stats['rps'] / base, 2)
+    return result
+
+
+async def bench_servers_list(args) -> Dict[str, Any]:
+    """
+    Чтение списка серверов через GET /servers
+
+    Замеряет полный обход списка страницами (первая сборка среза и повторный
+    обход из кеша), опрос с If-None-Match без изменений, пересборку после
+    сердцебиений части серверов и выборку по статусу. Для сравнения приводится
+    сериализация всего реестра в один ответ.
+    """
+    workdir = tempfile.mkdtemp(prefix='xeray-bench-')
+    daemon = make_daemon(workdir)
+    runner = None
+    logging.getLogger().setLevel(logging.WARNING)
+    try:
+        rows = [
+            (i, f'daemon_{i}_1700000000', f'node-{i}', '10.0.0.1', 443, '/etc/xray/config.json', None)
+            for i in range(1, args.servers + 1)
+        ]
+        await daemon.db.executemany(SQL_INSERT_SERVER, rows)
+        del rows
+        await daemon.load_servers()
+        now = datetime.now()
+        for server in daemon.servers:
+            daemon.set_server_status(server, 'offline' if server.server_id % 10 == 0 else 'online', now)
+        runner, base_url = await serve_api(daemon)
+
+        started = time.perf_counter()
+        everything = daemon_module.json_dumps({'success': True, 'servers': [s.to_dict() for s in daemon.servers]})
+        full_dump_seconds = time.perf_counter() - started
+
+        async with aiohttp.ClientSession(headers={'X-Auth-Key': daemon.secret}) as session:
+            async def walk(params):
+                """Обход всех страниц, возвращает (секунды, страницы, серверы, байты)"""
+                started = time.perf_counter()
+                cursor, pages, servers, size = None, 0, 0, 0
+                while True:
+                    query = dict(params, **({'cursor': cursor} if cursor is not None else {}))
+                    async with session.get(f'{base_url}/servers', params=query) as response:
+                        body = await response.read()
+                    result = json.loads(body)
+                    pages += 1
+                    servers += len(result['servers'])
+                    size += len(body)
+                    cursor = result['next_cursor']
+                    if cursor is None:
+                        return {'seconds': round(time.perf_counter() - started, 4), 'pages': pages,
+                                'servers': servers, 'bytes': size}
+
+            page = {'limit': daemon.server_list_max_limit}
+            cold = await walk(page)
+            cold['build_seconds'] = daemon.server_list.stats()['last_build_seconds']
+            warm = await walk(page)
+
+            # Опрос первой страницы с ETag: изменений нет, ответы 304 без тела
+            async with session.get(f'{base_url}/servers', params=page) as response:
+                etag = response.headers['ETag']
+            not_modified = 0
+            samples = []
+            for _ in range(args.requests // 10):
+                started = time.perf_counter()
+                async with session.get(f'{base_url}/servers', params=page,
+                                       headers={'If-None-Match': etag}) as response:
+                    await response.read()
+                samples.append(time.perf_counter() - started)
+                not_modified += response.status == 304
+
+            # Сердцебиения 1% серверов: пересобираются только их записи
+            serialized = daemon.server_list.serialized
+            now = datetime.now()
+            for server_id in range(1, args.servers + 1, 100):
+                daemon.set_server_status(daemon.servers.get(server_id), 'online', now)
+            after_heartbeats = await walk(page)
+            after_heartbeats['build_seconds'] = daemon.server_list.stats()['last_build_seconds']
+            after_heartbeats['reserialized'] = daemon.server_list.serialized - serialized
+
+            offline = await walk(dict(page, status='offline'))
+
+        return {
+            'servers': args.servers,
+            'page_limit': daemon.server_list_max_limit,
+            'full_dump': {'seconds': round(full_dump_seconds, 4), 'bytes': len(everything)},
+            'cold_walk': cold,
+            'cached_walk': warm,
+            'conditional_poll': {'requests': len(samples), 'not_modified': not_modified,
+                                 **latency_summary(samples)},
+            'walk_after_heartbeats': after_heartbeats,
+            'offline_walk': offline,
+            'cache': daemon.server_list.stats()
+        }
+    finally:
+        if runner:
+            await runner.cleanup()
+        daemon.db.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def measure_memory(factory, count: int) -> int:
+    """Объем памяти (в байтах), занятый count объектами из factory(i)"""
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    objects = [factory(i) for i in range(count)]
+    used = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    del objects
+    return used
+
+
+async def bench_memory(args) -> Dict[str, Any]:
+    """Память на один сервер: словарь против ServerRecord в реестре"""
+    now = datetime.now()
+
+    def as_dict(i):
+        return {
+            'daemon_id': f'daemon_{i}_1700000000',
+            'name': f'node-{i}',
+            'ip_address': '10.0.0.1',
+            'port': 443,
+            'config_path': '/etc/xray/config.json',
+            'status': 'online',
+            'last_heartbeat': now
+        }
+
+    def as_record(i):
+        return ServerRecord(i, f'daemon_{i}_1700000000', f'node-{i}', '10.0.0.1', 443,
+                            '/etc/xray/config.json', 'online', now)
+
+    result = {}
+    for count in (10000, 100000):
+        servers = {}
+        registry = ServerRegistry()
+        dict_bytes = measure_memory(lambda i: servers.__setitem__(i, as_dict(i)), count)
+        record_bytes = measure_memory(lambda i: registry.add(as_record(i)), count)
+        result[count] = {
+            'dict_bytes_per_node': round(dict_bytes / count),
+            'record_bytes_per_node': round(record_bytes / count)
+        }
+    return result
+
+
+SCENARIOS = {
+    'aggregate': bench_aggregate,
+    'auth': bench_auth,
+    'batch': bench_batch,
+    'deadlines': bench_deadlines,
+    'check_status': bench_check_status,
+    'cluster': bench_cluster,
+    'delta': bench_delta,
+    'hot_reload': bench_hot_reload,
+    'json': bench_json,
+    'load': bench_load,
+    'logging': bench_logging,
+    'memory': bench_memory,
+    'probe': bench_probe,
+    'servers_list': bench_servers_list,
+    'stats_history': bench_stats_history,
+    'warm_start': bench_warm_start,
+    'workers': bench_workers,
+    'ws': bench_ws,
+}
+
+
+def main():
+    """Основная функция запуска бенчмарков"""
+    parser = argparse.ArgumentParser(description='Xeray UI - Бенчмарки демона')
+    parser.add_argument('scenario', choices=sorted(SCENARIOS), help='Сценарий замера')
+    parser.add_argument('--servers', type=int, default=1000, help='Количество синтетических серверов')
+    parser.add_argument('--requests', type=int, default=20000, help='Количество запросов')
+    parser.add_argument('--concurrency', type=int, default=64, help='Количество параллельных запросов')
+    parser.add_argument('--listeners', type=int, default=50, help='Количество локальных заглушек узлов')
+    parser.add_argument('--timeout', type=float, default=3.0, help='Таймаут сетевой операции (в секундах)')
+    parser.add_argument('--points', type=int, default=1000000, help='Количество синтетических точек статистики')
+    parser.add_argument('--queries', type=int, default=200, help='Количество выборок на каждый вид запроса')
+    parser.add_argument('--users', type=int, default=100000, help='Количество синтетических пользователей')
+    parser.add_argument('--changed-ratio', type=float, default=0.01,
+                        help='Доля пользователей с изменившимися счетчиками между опросами')
+    parser.add_argument('--subscribers', type=int, default=5000, help='Количество подписчиков /ws')
+    parser.add_argument('--watch-count', type=int, default=10, help='Количество серверов у одного подписчика')
+    parser.add_argument('--events', type=int, default=2000, help='Количество публикуемых событий')
+    parser.add_argument('--batch-size', type=int, default=100, help='Количество команд в одном пакете')
+    parser.add_argument('--mix', default='check_status=70,get_stats=25,update_config=5',
+                        help='Смесь команд нагрузочного теста (команда=вес,...)')
+    parser.add_argument('--nodes', type=int, default=3, help='Количество узлов кластера в сценарии cluster')
+    parser.add_argument('--worker-counts', default='1,2,4,8',
+                        help='Количество рабочих процессов для сценария workers (через запятую)')
+    parser.add_argument('--output', help='Файл для сохранения результата в JSON (для сравнения версий)')
+    args = parser.parse_args()
+
+    result = asyncio.run(SCENARIOS[args.scenario](args))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({
+                'scenario': args.scenario,
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'python': sys.version.split()[0],
+                'json_backend': daemon_module.JSON_BACKEND,
+                'args': vars(args),
+                'result': result
+            }, f, ensure_ascii=False, indent=2, default=str)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,21 +6,50 @@ Xeray UI - Демон для управления серверами XRay
 """
 
 import asyncio
+import bisect
+import functools
+import heapq
 import json
 import logging
+import logging.handlers
+import multiprocessing
+import multiprocessing.connection
 import os
+import queue
+import random
+import re
+import secrets
 import signal
+import socket
 import sys
+import threading
 import time
+import traceback
+import uuid
 import hashlib
 import hmac
-from datetime import datetime, timedelta
-from typing import Dict, Any, Optional, List
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, Any, Optional, List, Callable, Iterable
 
 import aiohttp
 import aiohttp.web
 import sqlite3
 
+# NumPy ускоряет агрегацию статистики, но не обязателен
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# orjson ускоряет разбор и сериализацию JSON, но не обязателен
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Добавляем корневую директорию в sys.path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
@@ -35,36 +64,3492 @@ except ImportError:
     LOG_LEVEL = 'INFO'
     LOG_PATH = 'logs'
 
-# Создаем директорию для логов, если ее нет
-os.makedirs(LOG_PATH, exist_ok=True)
-
-# Настройка логирования
 log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-logging.basicConfig(
-    level=getattr(logging, LOG_LEVEL),
-    format=log_format,
-    handlers=[
-        logging.FileHandler(os.path.join(LOG_PATH, 'daemon.log')),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
 
+class RateLimitFilter(logging.Filter):
+    """
+    Ограничение частоты сообщений с одного места вызова (файл и строка)
+
+    Сообщения уровня ниже max_level пропускаются по алгоритму token bucket:
+    не более rate в секунду с запасом burst. Число отброшенных сообщений
+    дописывается к следующему пропущенному сообщению с того же места.
+    """
+
+    def __init__(self, rate: float = 20, burst: int = 100, max_level: int = logging.WARNING):
+        """
+        :param rate: Сообщений в секунду с одного места вызова
+        :param burst: Запас сообщений для кратковременных всплесков
+        :param max_level: Сообщения этого уровня и выше не ограничиваются
+        """
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.max_level = max_level
+        self._buckets = {}  # {(файл, строка): [токены, время, отброшено]}
+        self._lock = threading.Lock()
+        self.suppressed = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= self.max_level:
+            return True
+
+        key = (record.pathname, record.lineno)
+        now = record.created
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self.burst), now, 0]
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+
+            if bucket[0] < 1:
+                bucket[2] += 1
+                self.suppressed += 1
+                return False
+
+            bucket[0] -= 1
+            dropped, bucket[2] = bucket[2], 0
+
+        if dropped:
+            record.msg = f"{record.getMessage()} (пропущено похожих сообщений: {dropped})"
+            record.args = None
+        return True
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Форматирование записей журнала в JSON Lines"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'line': record.lineno
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json_text(entry)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    Передача записей фоновому потоку журналирования
+
+    Очередь работает внутри процесса, поэтому запись не копируется и не
+    форматируется заранее (как в QueueHandler): в вызывающем потоке только
+    подставляются аргументы сообщения, остальное делает QueueListener.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging(level: str = LOG_LEVEL, log_path: Optional[str] = LOG_PATH, json_lines: bool = False,
+                  max_bytes: int = 50 * 1024 * 1024, backup_count: int = 10, rotate_when: Optional[str] = None,
+                  rate: float = 20, burst: int = 100, console: bool = True,
+                  filename: str = 'daemon.log') -> logging.handlers.QueueListener:
+    """
+    Настройка журналирования через очередь
+
+    Вызывающий поток только кладет запись в очередь, запись в файл и консоль
+    выполняет фоновый поток QueueListener. Файл ротируется по размеру или
+    по времени (rotate_when: 'midnight', 'H', ...).
+
+    :param level: Уровень журналирования
+    :param log_path: Каталог файла журнала (None - без файла)
+    :param json_lines: Писать файл в формате JSON Lines
+    :param max_bytes: Размер файла для ротации по размеру
+    :param backup_count: Количество хранимых архивных файлов
+    :param rotate_when: Интервал ротации по времени (вместо ротации по размеру)
+    :param rate: Ограничение сообщений INFO и ниже с одного места вызова в секунду (0 - без ограничения)
+    :param burst: Запас сообщений для кратковременных всплесков
+    :param console: Дублировать журнал в stderr
+    :param filename: Имя файла журнала (у каждого рабочего процесса свой файл)
+    :return: Запущенный QueueListener (остановить при завершении для сброса очереди)
+    """
+    handlers = []
+    if log_path:
+        os.makedirs(log_path, exist_ok=True)
+        filename = os.path.join(log_path, filename)
+        if rotate_when:
+            file_handler = logging.handlers.TimedRotatingFileHandler(
+                filename, when=rotate_when, backupCount=backup_count, encoding='utf-8'
+            )
+        else:
+            file_handler = logging.handlers.RotatingFileHandler(
+                filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8'
+            )
+        file_handler.setFormatter(JsonLinesFormatter() if json_lines else logging.Formatter(log_format))
+        handlers.append(file_handler)
+
+    if console:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(logging.Formatter(log_format))
+        handlers.append(console_handler)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LogQueueHandler(log_queue)
+    if rate:
+        queue_handler.addFilter(RateLimitFilter(rate, burst))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(queue_handler)
+    root.setLevel(getattr(logging, level) if isinstance(level, str) else level)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+# SQL-запросы держим в константах, чтобы sqlite3 переиспользовал подготовленные выражения
+SERVER_COLUMNS = "server_id, daemon_id, name, ip_address, port, config_path, status, last_heartbeat, agent_url"
+SQL_SELECT_SERVER = f"SELECT {SERVER_COLUMNS} FROM servers WHERE server_id = ?"
+SQL_SELECT_ALL_SERVERS = f"SELECT {SERVER_COLUMNS} FROM servers ORDER BY server_id"
+SQL_SELECT_SERVERS_IN = f"SELECT {SERVER_COLUMNS} FROM servers WHERE server_id IN ({{}})"
+SQL_SELECT_DAEMON_ID = "SELECT daemon_id FROM servers WHERE server_id = ?"
+SQL_INSERT_SERVER = """
+    INSERT INTO servers (
+        server_id, daemon_id, name, ip_address, port, config_path, agent_url, status, last_heartbeat
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, 'connected', CURRENT_TIMESTAMP)
+"""
+SQL_UPDATE_SERVER = """
+    UPDATE servers SET
+        daemon_id = ?,
+        name = ?,
+        ip_address = ?,
+        port = ?,
+        config_path = ?,
+        agent_url = ?,
+        status = 'connected',
+        last_heartbeat = CURRENT_TIMESTAMP
+    WHERE server_id = ?
+"""
+# Статистика: сырые точки хранятся в statistics (timestamp - Unix-время в секундах),
+# агрегаты - в таблицах по интервалам (bucket - начало интервала в Unix-времени)
+STATS_ROLLUPS = (
+    ('statistics_1m', 60),
+    ('statistics_1h', 3600),
+    ('statistics_1d', 86400),
+)
+SQL_INSERT_STATISTICS = """
+    INSERT INTO statistics (server_id, timestamp, connections_count, traffic_up, traffic_down)
+    VALUES (?, ?, ?, ?, ?)
+"""
+SQL_UPSERT_ROLLUP = """
+    INSERT INTO {table} (server_id, bucket, samples, connections_sum, connections_max, traffic_up, traffic_down)
+    VALUES (?, ?, 1, ?, ?, ?, ?)
+    ON CONFLICT (server_id, bucket) DO UPDATE SET
+        samples = samples + 1,
+        connections_sum = connections_sum + excluded.connections_sum,
+        connections_max = MAX(connections_max, excluded.connections_max),
+        traffic_up = traffic_up + excluded.traffic_up,
+        traffic_down = traffic_down + excluded.traffic_down
+"""
+SQL_SELECT_STATISTICS = """
+    SELECT timestamp, connections_count, traffic_up, traffic_down FROM statistics
+    WHERE server_id = ? AND timestamp >= ? AND timestamp < ?
+    ORDER BY timestamp
+"""
+SQL_SELECT_ROLLUP = """
+    SELECT bucket, samples, connections_sum, connections_max, traffic_up, traffic_down FROM {table}
+    WHERE server_id = ? AND bucket >= ? AND bucket < ?
+    ORDER BY bucket
+"""
+
+# Фоновые операции хранятся в operation_logs (operation = 'job:<тип>')
+SQL_INSERT_JOB = "INSERT INTO operation_logs (server_id, operation, details, status) VALUES (?, ?, ?, 'queued')"
+SQL_UPDATE_JOB = "UPDATE operation_logs SET details = ?, status = ? WHERE id = ?"
+SQL_SELECT_JOB = """
+    SELECT id, server_id, operation, details, status, created_at FROM operation_logs
+    WHERE id = ? AND operation LIKE 'job:%'
+"""
+SQL_FAIL_INTERRUPTED_JOBS = """
+    UPDATE operation_logs SET status = 'failed'
+    WHERE operation LIKE 'job:%' AND status IN ('queued', 'running', 'retrying')
+"""
+
+# Хранилище конфигураций: тела по sha256 канонического JSON и версии по серверам
+SQL_SELECT_CONFIG = "SELECT body FROM configs WHERE hash = ?"
+SQL_INSERT_CONFIG = "INSERT OR IGNORE INTO configs (hash, body, size) VALUES (?, ?, ?)"
+SQL_SELECT_CURRENT_CONFIG = """
+    SELECT version, hash FROM server_configs WHERE server_id = ? ORDER BY version DESC LIMIT 1
+"""
+SQL_INSERT_SERVER_CONFIG = "INSERT INTO server_configs (server_id, version, hash) VALUES (?, ?, ?)"
+SQL_SELECT_STALE_CONFIGS = """
+    SELECT version, hash FROM server_configs WHERE server_id = ? AND version <= ?
+"""
+SQL_DELETE_STALE_CONFIGS = "DELETE FROM server_configs WHERE server_id = ? AND version <= ?"
+SQL_DELETE_ORPHAN_CONFIG = """
+    DELETE FROM configs WHERE hash = ? AND NOT EXISTS (SELECT 1 FROM server_configs WHERE hash = ?)
+"""
+
+# Ключ идентификатора вызывающей стороны в запросе aiohttp (см. RequestAuthenticator).
+# aiohttp до 3.12 не знает RequestKey и принимает строковые ключи без предупреждений
+CALLER_KEY = aiohttp.web.RequestKey('caller', str) if hasattr(aiohttp.web, 'RequestKey') else 'caller'
+
+# Заголовок запросов, пересланных другим узлом кластера (такие запросы не пересылаются дальше)
+CLUSTER_FORWARDED_HEADER = 'X-Cluster-Forwarded'
+
+# API агента узла - HTTP-сервиса, который работает на узле рядом с XRay и управляет им.
+# Это отдельный от XRay адрес: порт сервера (ServerRecord.port) - порт XRay, его проверяет
+# HealthProber. Адрес агента задается при подключении сервера (agent_url) или общим портом
+# (--agent-port, тогда http://<ip сервера>:<порт>). Без агента перезапуск и обновление
+# конфигурации завершаются ошибкой AgentNotConfigured, а статистика возвращается тестовая,
+# как до появления агента. Тела запросов и ответов - JSON, ошибка - любой статус 4xx/5xx;
+# если задан --agent-key, он передается в заголовке X-Auth-Key.
+#   GET  /stats   -> {"uptime", "inbound_connections", "outbound_connections", "total_up", "total_down",
+#                     "users": [{"id", "email", "up", "down"}]} (размеры - байты числом или строкой "1.2 GB")
+#   POST /config  {"path": config_path сервера, "config": {...}}
+#                 -> атомарная запись конфигурации XRay в path на узле, без перезапуска
+#   POST /restart -> перезапуск процесса XRay, ответ после запуска нового процесса
+#   POST /users/add    {"tag", "users": [объекты clients из конфигурации]}
+#   POST /users/remove {"tag", "emails": [...]}
+#                 -> изменение пользователей входящего подключения tag без перезапуска; агент
+#                    применяет их через gRPC API XRay (HandlerService.AlterInbound с
+#                    AddUserOperation/RemoveUserOperation) на своем узле
+NODE_STATS_PATH = '/stats'
+NODE_CONFIG_PATH = '/config'
+NODE_RESTART_PATH = '/restart'
+NODE_ADD_USERS_PATH = '/users/add'
+NODE_REMOVE_USERS_PATH = '/users/remove'
+
+# Статистика серверов без агента узла
+STUB_XRAY_STATS = {
+    'uptime': '1h 30m',
+    'inbound_connections': 42,
+    'outbound_connections': 38,
+    'total_up': '1.2 GB',
+    'total_down': '3.4 GB',
+    'users': [
+        {'id': 1, 'email': 'user1@example.com', 'up': '500 MB', 'down': '1.2 GB'},
+        {'id': 2, 'email': 'user2@example.com', 'up': '700 MB', 'down': '2.2 GB'}
+    ]
+}
+
+SQL_DELETE_SERVER = "DELETE FROM servers WHERE server_id = ?"
+SQL_FLUSH_HEARTBEAT = "UPDATE servers SET status = ?, last_heartbeat = ? WHERE server_id = ?"
+
+# Журнал изменений реестра для синхронизации рабочих процессов (--workers)
+SQL_INSERT_REGISTRY_CHANGE = "INSERT INTO registry_changes (server_id, kind, worker) VALUES (?, ?, ?)"
+SQL_SELECT_REGISTRY_CHANGES = """
+    SELECT seq, server_id, kind FROM registry_changes WHERE seq > ? AND worker != ? ORDER BY seq LIMIT ?
+"""
+SQL_SELECT_REGISTRY_BOUNDS = "SELECT MIN(seq), MAX(seq) FROM registry_changes"
+SQL_PRUNE_REGISTRY_CHANGES = "DELETE FROM registry_changes WHERE seq <= ?"
+
+# Общий кеш nonce рабочих процессов: строка добавляется, если nonce новый или его срок истек
+SQL_CLAIM_NONCE = """
+    INSERT INTO auth_nonces (caller, nonce, expires) VALUES (?, ?, ?)
+    ON CONFLICT (caller, nonce) DO UPDATE SET expires = excluded.expires WHERE auth_nonces.expires < ?
+"""
+SQL_PRUNE_NONCES = "DELETE FROM auth_nonces WHERE expires < ?"
+
+
+if orjson is not None:
+    JSON_BACKEND = 'orjson'
+
+    def json_dumps(value: Any) -> bytes:
+        """Сериализация в JSON (UTF-8)"""
+        return orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+
+    def json_loads(data) -> Any:
+        """Разбор JSON из bytes или str (ошибка - ValueError)"""
+        return orjson.loads(data)
+else:
+    JSON_BACKEND = 'json'
+
+    def json_dumps(value: Any) -> bytes:
+        """Сериализация в JSON (UTF-8)"""
+        return json.dumps(value, default=str, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def json_loads(data) -> Any:
+        """Разбор JSON из bytes или str (ошибка - ValueError)"""
+        return json.loads(data)
+
+
+def json_text(value: Any) -> str:
+    """Сериализация в JSON-строку"""
+    return json_dumps(value).decode('utf-8')
+
+
+def json_response(data: Any, status: int = 200) -> aiohttp.web.Response:
+    """HTTP-ответ с телом в JSON"""
+    return aiohttp.web.Response(body=json_dumps(data), status=status, content_type='application/json')
+
+
+def db_timestamp(value: Optional[datetime]) -> Optional[str]:
+    """Перевод локального времени в формат CURRENT_TIMESTAMP (UTC) для базы данных"""
+    if value is None:
+        return None
+    return value.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_db_timestamp(value: Optional[str]) -> Optional[datetime]:
+    """
+    Перевод времени из базы данных (UTC) в локальное время
+
+    Результат кэшируется: сброс буфера сердцебиений записывает одно и то же
+    время сразу для многих серверов.
+    """
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone().replace(tzinfo=None)
+
+
+class ServerRecord:
+    """Информация о сервере, подключенном к демону"""
+
+    __slots__ = ('server_id', 'daemon_id', 'name', 'ip_address', 'port', 'config_path', 'status', 'last_heartbeat',
+                 'agent_url', 'revision')
+
+    def __init__(self, server_id: int, daemon_id: str, name: str, ip_address: str, port: int,
+                 config_path: str, status: str = 'offline', last_heartbeat: Optional[datetime] = None,
+                 agent_url: Optional[str] = None):
+        self.server_id = server_id
+        self.daemon_id = daemon_id
+        self.name = name
+        self.ip_address = ip_address
+        self.port = port
+        self.config_path = config_path
+        self.status = status
+        self.last_heartbeat = last_heartbeat
+        self.agent_url = agent_url  # Адрес агента узла (None - общий --agent-port или без агента)
+        self.revision = 0  # Ревизия реестра при последнем изменении записи
+
+    @classmethod
+    def from_row(cls, row: tuple) -> 'ServerRecord':
+        """Создание записи из строки запроса с колонками SERVER_COLUMNS"""
+        server_id, daemon_id, name, ip_address, port, config_path, status, last_heartbeat, agent_url = row
+        return cls(server_id, daemon_id, name, ip_address, port, config_path,
+                   status or 'offline', parse_db_timestamp(last_heartbeat), agent_url)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Представление записи для ответов API"""
+        return {
+            'server_id': self.server_id,
+            'daemon_id': self.daemon_id,
+            'name': self.name,
+            'ip_address': self.ip_address,
+            'port': self.port,
+            'config_path': self.config_path,
+            'status': self.status,
+            'last_heartbeat': self.last_heartbeat.isoformat() if self.last_heartbeat else None,
+            'agent_url': self.agent_url
+        }
+
+    def __repr__(self):
+        return f"ServerRecord(server_id={self.server_id!r}, name={self.name!r}, status={self.status!r})"
+
+
+class ServerRegistry:
+    """Реестр подключенных серверов с поиском по server_id и daemon_id"""
+
+    def __init__(self):
+        self._by_id = {}  # {server_id: ServerRecord}
+        self._by_daemon_id = {}  # {daemon_id: ServerRecord}
+        self.version = 0  # Увеличивается при каждом добавлении или удалении сервера
+        self.revision = 0  # Увеличивается при любом изменении реестра, включая статусы
+
+    @staticmethod
+    def _key(server_id):
+        """Приведение ID сервера к числу (PHP может передать его строкой)"""
+        try:
+            return int(server_id)
+        except (TypeError, ValueError):
+            return server_id
+
+    def add(self, record: ServerRecord):
+        """Добавление или замена записи о сервере"""
+        record.server_id = self._key(record.server_id)
+        previous = self._by_id.get(record.server_id)
+        if previous is not None:
+            self._by_daemon_id.pop(previous.daemon_id, None)
+
+        self._by_id[record.server_id] = record
+        self._by_daemon_id[record.daemon_id] = record
+        self.version += 1
+        self.touch(record)
+
+    def touch(self, record: ServerRecord):
+        """Отметка об изменении полей записи (статуса, сердцебиения, адреса)"""
+        self.revision += 1
+        record.revision = self.revision
+
+    def remove(self, server_id) -> Optional[ServerRecord]:
+        """Удаление записи о сервере"""
+        record = self._by_id.pop(self._key(server_id), None)
+        if record is not None:
+            self._by_daemon_id.pop(record.daemon_id, None)
+            self.version += 1
+            self.revision += 1
+        return record
+
+    def get(self, server_id) -> Optional[ServerRecord]:
+        """Поиск сервера по ID"""
+        return self._by_id.get(self._key(server_id))
+
+    def get_by_daemon_id(self, daemon_id: str) -> Optional[ServerRecord]:
+        """Поиск сервера по ID демона"""
+        return self._by_daemon_id.get(daemon_id)
+
+    def items(self):
+        return self._by_id.items()
+
+    def __contains__(self, server_id) -> bool:
+        return self._key(server_id) in self._by_id
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __iter__(self):
+        return iter(self._by_id.values())
+
+
+def make_etag(body: bytes) -> str:
+    """ETag по содержимому ответа"""
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    """Проверка заголовка If-None-Match (список ETag, слабые ETag и *)"""
+    if not header:
+        return False
+    for value in header.split(','):
+        value = value.strip()
+        if value == '*' or value == etag or value == 'W/' + etag:
+            return True
+    return False
+
+
+class ServerListCache:
+    """
+    Кеш сериализованного списка серверов для GET /servers
+
+    Срез реестра пересобирается при первом запросе после изменения ревизии
+    реестра, так что ответ никогда не отстает от реестра. Записи, не
+    изменившиеся с прошлой сборки, повторно не сериализуются, порядок сортировки
+    пересчитывается только при добавлении и удалении серверов. Готовые страницы
+    вместе с ETag хранятся до следующей сборки.
+    """
+
+    def __init__(self, registry: ServerRegistry, max_pages: int = 256, chunk_size: int = 5000):
+        """
+        :param registry: Реестр серверов
+        :param max_pages: Сколько готовых страниц хранить
+        :param chunk_size: Сколько записей обрабатывать между передачами управления циклу событий
+        """
+        self.registry = registry
+        self.max_pages = max_pages
+        self.chunk_size = chunk_size
+        self.revision = -1  # Ревизия реестра, по которой собран срез
+        self._version = -1  # Версия реестра, по которой отсортированы записи
+        self._records = []  # Записи в порядке выдачи (по server_id)
+        self._ids = []
+        self._keys = []  # Ключи сортировки для поиска по курсору
+        self._items = []  # JSON записей в порядке выдачи
+        self._by_status = {}  # {статус: [позиции в _items]}
+        self._fragments = {}  # {server_id: (ревизия записи, JSON)}
+        self._pages = OrderedDict()  # {(статус, курсор, лимит): (ETag, тело)}
+        self._lock = None
+        self.builds = 0
+        self.page_hits = 0
+        self.page_misses = 0
+        self.serialized = 0
+        self.last_build_seconds = 0.0
+
+    @staticmethod
+    def sort_key(server_id) -> tuple:
+        """Ключ сортировки: сначала числовые ID, затем строковые"""
+        return isinstance(server_id, str), server_id
+
+    def is_fresh(self) -> bool:
+        return self.revision == self.registry.revision
+
+    async def refresh(self):
+        """Пересборка среза, если реестр изменился (одновременные запросы ждут одну сборку)"""
+        if self.is_fresh():
+            return
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not self.is_fresh():
+                await self._build()
+
+    async def _build(self):
+        started = time.perf_counter()
+        revision = self.registry.revision
+        if self._version != self.registry.version:
+            self._version = self.registry.version
+            self._records = sorted(self.registry, key=lambda record: self.sort_key(record.server_id))
+            self._ids = [record.server_id for record in self._records]
+            self._keys = [self.sort_key(server_id) for server_id in self._ids]
+            live = set(self._ids)
+            for server_id in [server_id for server_id in self._fragments if server_id not in live]:
+                del self._fragments[server_id]
+
+        records = self._records
+        fragments = self._fragments
+        items = []
+        by_status = {}
+        for position, record in enumerate(records):
+            if position and position % self.chunk_size == 0:
+                # Первая сборка большого реестра не должна надолго блокировать цикл событий
+                await asyncio.sleep(0)
+            cached = fragments.get(record.server_id)
+            if cached is None or cached[0] != record.revision:
+                cached = fragments[record.server_id] = (record.revision, json_dumps(record.to_dict()))
+                self.serialized += 1
+            items.append(cached[1])
+            by_status.setdefault(record.status, []).append(position)
+
+        self._items = items
+        self._by_status = by_status
+        self._pages.clear()
+        self.revision = revision
+        self.builds += 1
+        self.last_build_seconds = time.perf_counter() - started
+
+    def page(self, status: Optional[str], cursor, limit: int) -> tuple:
+        """
+        Страница списка из текущего среза
+
+        :param status: Фильтр по статусу (None - все серверы)
+        :param cursor: ID последнего сервера предыдущей страницы (None - с начала)
+        :param limit: Размер страницы
+        :return: (ETag, тело ответа)
+        """
+        key = (status, cursor, limit)
+        cached = self._pages.get(key)
+        if cached is not None:
+            self._pages.move_to_end(key)
+            self.page_hits += 1
+            return cached
+        self.page_misses += 1
+
+        start = bisect.bisect_right(self._keys, self.sort_key(cursor)) if cursor is not None else 0
+        if status is None:
+            total = len(self._items)
+            positions = range(start, min(start + limit, total))
+            more = start + limit < total
+        else:
+            matching = self._by_status.get(status, [])
+            total = len(matching)
+            first = bisect.bisect_left(matching, start)
+            positions = matching[first:first + limit]
+            more = first + limit < total
+
+        next_cursor = self._ids[positions[-1]] if more and len(positions) else None
+        body = b''.join((
+            b'{"success":true,"total":', str(total).encode(),
+            b',"next_cursor":', json_dumps(next_cursor),
+            b',"servers":[', b','.join([self._items[position] for position in positions]), b']}'
+        ))
+        cached = self._pages[key] = (make_etag(body), body)
+        while len(self._pages) > self.max_pages:
+            self._pages.popitem(last=False)
+        return cached
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'revision': self.revision,
+            'builds': self.builds,
+            'serialized': self.serialized,
+            'last_build_seconds': round(self.last_build_seconds, 6),
+            'pages_cached': len(self._pages),
+            'page_hits': self.page_hits,
+            'page_misses': self.page_misses
+        }
+
+
+class Database:
+    """
+    Слой доступа к SQLite для демона
+
+    Держит одно долгоживущее подключение в режиме WAL и выполняет все запросы
+    в отдельном потоке, чтобы медленный fsync не блокировал цикл событий.
+    Подготовленные выражения переиспользуются через кэш модуля sqlite3,
+    поэтому SQL-запросы следует держать в константах.
+    """
+
+    def __init__(self, path: str, timeout: float = 30.0, cached_statements: int = 256):
+        """
+        :param path: Путь к файлу базы данных
+        :param timeout: Время ожидания блокировки базы (в секундах)
+        :param cached_statements: Размер кэша подготовленных выражений
+        """
+        self.path = path
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self._conn = None
+        # Один поток гарантирует последовательный доступ к подключению
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='daemon-db')
+        self.queries = 0
+
+    def _open(self):
+        """Открытие подключения (выполняется в потоке базы данных)"""
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.timeout,
+            check_same_thread=False,
+            cached_statements=self.cached_statements
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        self._conn = conn
+
+    def _call(self, func: Callable, *args):
+        """Выполнение функции над подключением (в потоке базы данных)"""
+        if self._conn is None:
+            self._open()
+        self.queries += 1
+        return func(self._conn, *args)
+
+    def run_sync(self, func: Callable, *args):
+        """Синхронное выполнение функции над подключением"""
+        return self._executor.submit(self._call, func, *args).result()
+
+    async def run(self, func: Callable, *args):
+        """Выполнение функции над подключением без блокировки цикла событий"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, func, *args)
+
+    async def transaction(self, func: Callable, *args):
+        """Выполнение функции в транзакции с откатом при ошибке"""
+        def _transaction(conn, *args):
+            with conn:
+                return func(conn, *args)
+
+        return await self.run(_transaction, *args)
+
+    async def execute(self, sql: str, params: Iterable = ()) -> int:
+        """Выполнение изменяющего запроса, возвращает число затронутых строк"""
+        def _execute(conn):
+            with conn:
+                return conn.execute(sql, params).rowcount
+
+        return await self.run(_execute)
+
+    async def executemany(self, sql: str, seq: Iterable) -> int:
+        """Пакетное выполнение запроса в одной транзакции"""
+        def _executemany(conn):
+            with conn:
+                return conn.executemany(sql, seq).rowcount
+
+        return await self.run(_executemany)
+
+    async def fetchone(self, sql: str, params: Iterable = ()) -> Optional[tuple]:
+        """Получение одной строки"""
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params: Iterable = ()) -> List[tuple]:
+        """Получение всех строк"""
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def iterate(self, sql: str, params: Iterable = (), chunk_size: int = 1000):
+        """Потоковое чтение результата запроса порциями по chunk_size строк"""
+        cursor = await self.run(lambda conn: conn.execute(sql, params))
+        try:
+            while True:
+                rows = await self.run(lambda conn: cursor.fetchmany(chunk_size))
+                if not rows:
+                    break
+                yield rows
+        finally:
+            await self.run(lambda conn: cursor.close())
+
+    def close(self):
+        """Закрытие подключения и остановка потока"""
+        def _close(conn):
+            conn.close()
+
+        if self._conn is not None:
+            self._executor.submit(_close, self._conn).result()
+            self._conn = None
+        self._executor.shutdown(wait=True)
+
+
+class HeartbeatBuffer:
+    """
+    Буфер отложенной записи сердцебиений и статусов серверов
+
+    Изменения сразу применяются в памяти вызывающей стороной, а в базу данных
+    попадают пачкой в одной транзакции: по таймеру или при достижении порога.
+    Повторные изменения одного сервера между сбросами схлопываются в одну запись.
+    """
+
+    def __init__(self, db: Database, flush_interval: float = 5.0, flush_size: int = 500,
+                 changes: Optional['RegistrySync'] = None):
+        """
+        :param db: Слой доступа к базе данных
+        :param flush_interval: Интервал сброса буфера (в секундах)
+        :param flush_size: Количество серверов в буфере, при котором сброс выполняется досрочно
+        :param changes: Журнал изменений реестра для других рабочих процессов
+        """
+        self.db = db
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.changes = changes
+        self._pending = {}  # {server_id: (status, last_heartbeat)}
+        self._wakeup = None
+        self._lock = None
+
+        # Статистика
+        self.writes = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.failed_flushes = 0
+        self.last_flush_duration = 0.0
+
+    def record(self, server_id: int, status: str, last_heartbeat: Optional[datetime]):
+        """Постановка изменения статуса сервера в очередь на запись"""
+        self.writes += 1
+        if server_id in self._pending:
+            self.coalesced += 1
+        self._pending[server_id] = (status, last_heartbeat)
+
+        if len(self._pending) >= self.flush_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    def discard(self, server_id: int):
+        """Удаление отложенных изменений сервера (например, при отключении)"""
+        self._pending.pop(server_id, None)
+
+    def has_pending(self, server_id: int) -> bool:
+        """Есть ли у сервера изменения, еще не записанные в базу"""
+        return server_id in self._pending
+
+    async def flush(self) -> int:
+        """Сброс накопленных изменений в базу данных одной транзакцией"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            if not self._pending:
+                return 0
+
+            pending, self._pending = self._pending, {}
+            rows = [
+                (status, db_timestamp(last_heartbeat), server_id)
+                for server_id, (status, last_heartbeat) in pending.items()
+            ]
+
+            def _flush(conn: sqlite3.Connection):
+                conn.executemany(SQL_FLUSH_HEARTBEAT, rows)
+                if self.changes is not None:
+                    self.changes.record(conn, pending, 'status')
+
+            started = time.perf_counter()
+            try:
+                await self.db.transaction(_flush)
+            except Exception:
+                # Возвращаем изменения в буфер, не затирая более свежие
+                for server_id, value in pending.items():
+                    self._pending.setdefault(server_id, value)
+                self.failed_flushes += 1
+                raise
+
+            self.last_flush_duration = time.perf_counter() - started
+            self.flushes += 1
+            self.flushed_rows += len(rows)
+            return len(rows)
+
+    async def run(self):
+        """Фоновый сброс буфера по таймеру или порогу размера"""
+        self._wakeup = asyncio.Event()
+
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка сброса буфера сердцебиений: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        """Статистика буфера"""
+        return {
+            'pending': len(self._pending),
+            'writes': self.writes,
+            'coalesced': self.coalesced,
+            'flushes': self.flushes,
+            'flushed_rows': self.flushed_rows,
+            'failed_flushes': self.failed_flushes,
+            'last_flush_duration': round(self.last_flush_duration, 6)
+        }
+
+
+class DeadlineIndex:
+    """
+    Индекс сроков (дедлайнов) по ключу на min-куче
+
+    Хранит для каждого ключа один срок (время time.time()) и выдает ключи,
+    срок которых наступил. Перенос срока на более позднее время (обычный случай
+    при сердцебиении) только обновляет словарь: запись в куче остается и при
+    извлечении переставляется на актуальный срок. Перенос на более раннее время
+    добавляет новую запись за O(log N), старая отбрасывается при извлечении.
+    """
+
+    def __init__(self, max_sleep: float = 60.0):
+        """
+        :param max_sleep: Максимальное время ожидания в run (защита от перевода системных часов)
+        """
+        self.max_sleep = max_sleep
+        self._deadlines = {}  # {key: актуальный срок}
+        self._queued = {}  # {key: срок действующей записи в куче}
+        self._heap = []  # [(срок, key)]
+        self._wakeup = None
+
+        # Статистика
+        self.scheduled = 0
+        self.pushes = 0
+        self.fired = 0
+        self.compactions = 0
+        self.last_lateness = 0.0
+        self.max_lateness = 0.0
+
+    def schedule(self, key, deadline: float):
+        """Установка или перенос срока ключа"""
+        self.scheduled += 1
+        self._deadlines[key] = deadline
+
+        queued = self._queued.get(key)
+        if queued is not None and queued <= deadline:
+            return
+
+        self._queued[key] = deadline
+        self.pushes += 1
+        heapq.heappush(self._heap, (deadline, key))
+
+        if len(self._heap) > 2 * len(self._deadlines) + 1024:
+            self._compact()
+        # Новый срок раньше ожидаемого: будим run, чтобы он не проспал его
+        if self._wakeup is not None and self._heap[0][1] == key:
+            self._wakeup.set()
+
+    def cancel(self, key):
+        """Снятие срока ключа (запись в куче отбрасывается при извлечении)"""
+        self._deadlines.pop(key, None)
+
+    def get(self, key) -> Optional[float]:
+        """Текущий срок ключа"""
+        return self._deadlines.get(key)
+
+    def next_deadline(self) -> Optional[float]:
+        """Ближайший срок в куче (может оказаться устаревшим и быть перенесен)"""
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: float) -> list:
+        """Извлечение ключей, срок которых наступил к моменту now"""
+        heap = self._heap
+        due = []
+        while heap and heap[0][0] <= now:
+            deadline, key = heapq.heappop(heap)
+            if self._queued.get(key) != deadline:
+                continue  # Запись заменена более ранней
+            del self._queued[key]
+
+            actual = self._deadlines.get(key)
+            if actual is None:
+                continue  # Срок снят
+            if actual > now:
+                # Срок перенесен на более позднее время
+                self._queued[key] = actual
+                heapq.heappush(heap, (actual, key))
+                continue
+
+            del self._deadlines[key]
+            due.append(key)
+            lateness = now - actual
+            self.last_lateness = lateness
+            if lateness > self.max_lateness:
+                self.max_lateness = lateness
+
+        self.fired += len(due)
+        return due
+
+    def _compact(self):
+        """Перестроение кучи из актуальных сроков (удаление снятых и замененных записей)"""
+        self._queued = dict(self._deadlines)
+        self._heap = [(deadline, key) for key, deadline in self._deadlines.items()]
+        heapq.heapify(self._heap)
+        self.compactions += 1
+
+    async def run(self, on_due: Callable):
+        """
+        Вызов on_due(keys) для ключей с наступившим сроком
+
+        Ожидает ровно до ближайшего срока или до появления более раннего.
+
+        :param on_due: Корутина, принимающая список ключей
+        """
+        self._wakeup = asyncio.Event()
+
+        while True:
+            deadline = self.next_deadline()
+            timeout = self.max_sleep if deadline is None else min(max(deadline - time.time(), 0), self.max_sleep)
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+            self._wakeup.clear()
+
+            due = self.pop_due(time.time())
+            if due:
+                await on_due(due)
+
+    def stats(self) -> Dict[str, Any]:
+        """Статистика индекса"""
+        deadline = self.next_deadline()
+        return {
+            'tracked': len(self._deadlines),
+            'heap_size': len(self._heap),
+            'scheduled': self.scheduled,
+            'pushes': self.pushes,
+            'fired': self.fired,
+            'compactions': self.compactions,
+            'next_in': round(deadline - time.time(), 3) if deadline is not None else None,
+            'last_lateness': round(self.last_lateness, 6),
+            'max_lateness': round(self.max_lateness, 6)
+        }
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+
+class RegistrySync:
+    """
+    Журнал изменений реестра серверов для нескольких рабочих процессов
+
+    Каждый процесс держит реестр в памяти и пишет в общую базу (WAL). Вместе с
+    изменением серверов в той же транзакции в registry_changes записывается
+    строка (server_id, вид изменения, номер процесса). Остальные процессы
+    раз в interval проверяют PRAGMA data_version - она меняется только после
+    фиксации транзакций другими подключениями, поэтому в простое опрос не
+    читает таблиц - и применяют новые строки журнала к своему реестру.
+
+    Виды изменений: 'server' (подключение или изменение), 'status'
+    (сердцебиение), 'delete' (удаление), 'config' (новая версия конфигурации).
+    """
+
+    def __init__(self, db: Database, worker_id: int = 0, interval: float = 0.2, batch_size: int = 5000,
+                 keep_changes: int = 100000):
+        """
+        :param db: Слой доступа к базе данных
+        :param worker_id: Номер рабочего процесса (свои изменения не применяются повторно)
+        :param interval: Интервал проверки новых изменений (в секундах)
+        :param batch_size: Сколько изменений читать за один запрос
+        :param keep_changes: Сколько последних изменений хранить в журнале
+        """
+        self.db = db
+        self.worker_id = worker_id
+        self.interval = interval
+        self.batch_size = batch_size
+        self.keep_changes = keep_changes
+        self.enabled = False
+        self.last_seq = 0
+        self._data_version = None
+
+        # Статистика
+        self.recorded = 0
+        self.polls = 0
+        self.applied = 0
+        self.full_reloads = 0
+        self.last_lag = 0.0
+
+    def record(self, conn: sqlite3.Connection, server_ids: Iterable, kind: str):
+        """Запись изменений в журнал (вызывается внутри транзакции изменения)"""
+        if not self.enabled:
+            return
+        rows = [(server_id, kind, self.worker_id) for server_id in server_ids]
+        conn.executemany(SQL_INSERT_REGISTRY_CHANGE, rows)
+        self.recorded += len(rows)
+
+    async def start(self):
+        """Запоминание текущей позиции журнала (вызывать до загрузки реестра)"""
+        _, last_seq = await self.db.fetchone(SQL_SELECT_REGISTRY_BOUNDS)
+        self.last_seq = last_seq or 0
+        self._data_version = await self.db.run(lambda conn: conn.execute('PRAGMA data_version').fetchone()[0])
+
+    async def poll(self) -> Optional[List[tuple]]:
+        """
+        Новые изменения других процессов
+
+        :return: Список (server_id, вид изменения) или None, если часть журнала
+                 уже удалена и реестр нужно перечитать целиком
+        """
+        self.polls += 1
+        version = await self.db.run(lambda conn: conn.execute('PRAGMA data_version').fetchone()[0])
+        if version == self._data_version:
+            return []
+        self._data_version = version
+
+        first_seq, last_seq = await self.db.fetchone(SQL_SELECT_REGISTRY_BOUNDS)
+        if first_seq is not None and first_seq > self.last_seq + 1 and self.last_seq:
+            self.last_seq = last_seq
+            self.full_reloads += 1
+            return None
+
+        changes = []
+        while True:
+            rows = await self.db.fetchall(SQL_SELECT_REGISTRY_CHANGES, (self.last_seq, self.worker_id,
+                                                                      self.batch_size))
+            if not rows:
+                break
+            self.last_seq = rows[-1][0]
+            changes.extend((server_id, kind) for _, server_id, kind in rows)
+            if len(rows) < self.batch_size:
+                break
+
+        self.applied += len(changes)
+        return changes
+
+    async def prune(self) -> int:
+        """Удаление старых записей журнала, возвращает число удаленных строк"""
+        _, last_seq = await self.db.fetchone(SQL_SELECT_REGISTRY_BOUNDS)
+        if not last_seq or last_seq <= self.keep_changes:
+            return 0
+        return await self.db.execute(SQL_PRUNE_REGISTRY_CHANGES, (last_seq - self.keep_changes,))
+
+    async def run(self, apply: Callable, prune_interval: Optional[float] = None):
+        """
+        Фоновое применение изменений других процессов
+
+        :param apply: Корутина apply(changes), changes=None - перечитать реестр целиком
+        :param prune_interval: Интервал очистки журнала (None - не очищать)
+        """
+        last_prune = time.monotonic()
+
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                started = time.perf_counter()
+                changes = await self.poll()
+                if changes is None or changes:
+                    await apply(changes)
+                    self.last_lag = time.perf_counter() - started
+
+                if prune_interval and time.monotonic() - last_prune >= prune_interval:
+                    last_prune = time.monotonic()
+                    await self.prune()
+            except Exception as e:
+                logger.error(f"Ошибка синхронизации реестра: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        """Статистика синхронизации"""
+        return {
+            'enabled': self.enabled,
+            'worker_id': self.worker_id,
+            'last_seq': self.last_seq,
+            'recorded': self.recorded,
+            'polls': self.polls,
+            'applied': self.applied,
+            'full_reloads': self.full_reloads,
+            'last_apply_duration': round(self.last_lag, 6)
+        }
+
+
+class HealthProber:
+    """
+    Проверка доступности серверов по сети
+
+    Каждый сервер проверяется TCP-подключением к ip_address:port (и, если
+    задан http_path, HTTP-запросом). Проверки распределяются по интервалу
+    со случайным смещением, число одновременных проверок ограничено
+    семафором, а недоступные серверы проверяются с экспоненциально растущей
+    паузой.
+    """
+
+    def __init__(self, registry: ServerRegistry, interval: float = 30.0, concurrency: int = 256,
+                 timeout: float = 3.0, max_backoff: float = 600.0, http_path: Optional[str] = None):
+        """
+        :param registry: Реестр серверов
+        :param interval: Интервал проверки доступного сервера (в секундах)
+        :param concurrency: Максимальное число одновременных проверок
+        :param timeout: Таймаут одной проверки (в секундах)
+        :param max_backoff: Максимальная пауза между проверками недоступного сервера (в секундах)
+        :param http_path: Путь для HTTP-проверки (None - только TCP)
+        """
+        self.registry = registry
+        self.interval = interval
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.http_path = http_path
+
+        self._schedule = []  # Куча (время проверки, server_id)
+        self._scheduled = set()
+        self._failures = {}  # {server_id: число неудачных проверок подряд}
+        self._registry_version = -1
+        self._semaphore = None
+        self._wakeup = None
+        self._tasks = set()
+
+        # Статистика
+        self.probes = 0
+        self.failed_probes = 0
+
+    async def probe(self, server: ServerRecord) -> bool:
+        """Однократная проверка доступности сервера"""
+        self.probes += 1
+        writer = None
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(server.ip_address, server.port),
+                timeout=self.timeout
+            )
+
+            if self.http_path:
+                writer.write(
+                    f"GET {self.http_path} HTTP/1.1\r\nHost: {server.ip_address}\r\n"
+                    f"Connection: close\r\n\r\n".encode()
+                )
+                status_line = await asyncio.wait_for(reader.readline(), timeout=self.timeout)
+                parts = status_line.split()
+                if len(parts) < 2 or not parts[1].startswith(b'2'):
+                    raise ConnectionError(f"HTTP-проверка вернула {status_line!r}")
+
+            return True
+
+        except (OSError, asyncio.TimeoutError, ValueError):
+            self.failed_probes += 1
+            return False
+        finally:
+            if writer is not None:
+                writer.close()
+                try:
+                    await writer.wait_closed()
+                except (OSError, asyncio.TimeoutError):
+                    pass
+
+    async def sweep(self, servers: Iterable[ServerRecord]) -> Dict[int, bool]:
+        """Параллельная проверка набора серверов, возвращает {server_id: доступен}"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run(server):
+            async with semaphore:
+                return server.server_id, await self.probe(server)
+
+        return dict(await asyncio.gather(*(run(server) for server in servers)))
+
+    def next_delay(self, server_id: int, ok: bool) -> float:
+        """Пауза до следующей проверки с учетом экспоненциальной задержки"""
+        if ok:
+            self._failures.pop(server_id, None)
+            delay = self.interval
+        else:
+            failures = self._failures.get(server_id, 0) + 1
+            self._failures[server_id] = failures
+            delay = min(self.interval * (2 ** (failures - 1)), self.max_backoff)
+
+        # Случайное смещение не дает проверкам собираться в одну волну
+        return delay * random.uniform(0.9, 1.1)
+
+    def _schedule_new_servers(self, now: float):
+        """Добавление в расписание новых серверов со смещением по интервалу"""
+        if self._registry_version == self.registry.version:
+            return
+        self._registry_version = self.registry.version
+
+        for server in self.registry:
+            if server.server_id not in self._scheduled:
+                self._scheduled.add(server.server_id)
+                heapq.heappush(self._schedule, (now + random.uniform(0, self.interval), server.server_id))
+
+    async def run(self, on_result: Callable):
+        """
+        Фоновый цикл проверок
+
+        :param on_result: Функция on_result(server, ok), вызываемая после каждой проверки
+        """
+        loop = asyncio.get_running_loop()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._wakeup = asyncio.Event()
+
+        async def check(server: ServerRecord):
+            try:
+                ok = await self.probe(server)
+                on_result(server, ok)
+                entry = (loop.time() + self.next_delay(server.server_id, ok), server.server_id)
+                heapq.heappush(self._schedule, entry)
+                if self._schedule[0] is entry:
+                    # Проверка стала ближайшей: цикл мог уснуть до более позднего срока
+                    self._wakeup.set()
+            except Exception as e:
+                logger.error(f"Ошибка проверки сервера {server.server_id}: {e}")
+                self._scheduled.discard(server.server_id)
+            finally:
+                self._semaphore.release()
+
+        try:
+            while True:
+                now = loop.time()
+                self._schedule_new_servers(now)
+
+                while self._schedule and self._schedule[0][0] <= now:
+                    _, server_id = heapq.heappop(self._schedule)
+                    server = self.registry.get(server_id)
+                    if server is None:
+                        # Сервер отключен от демона
+                        self._scheduled.discard(server_id)
+                        self._failures.pop(server_id, None)
+                        continue
+
+                    await self._semaphore.acquire()
+                    task = asyncio.create_task(check(server))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+
+                # Спим до ближайшей проверки, но не дольше секунды, чтобы подхватывать новые серверы
+                delay = self._schedule[0][0] - loop.time() if self._schedule else 1.0
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=min(max(delay, 0.0), 1.0))
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+        finally:
+            for task in list(self._tasks):
+                task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        """Статистика проверок"""
+        return {
+            'scheduled': len(self._scheduled),
+            'in_flight': len(self._tasks),
+            'backing_off': len(self._failures),
+            'probes': self.probes,
+            'failed_probes': self.failed_probes
+        }
+
+
+class NodeClient:
+    """
+    Общий HTTP-клиент для обращений демона к узлам
+
+    Одна сессия aiohttp с пулом соединений создается при запуске демона и
+    закрывается при остановке, поэтому соединения (и TLS-сессии) с узлами
+    переиспользуются между запросами.
+    """
+
+    # Методы, которые безопасно повторять после отправки запроса
+    IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'))
+
+    def __init__(self, limit: int = 1000, limit_per_host: int = 8, keepalive_timeout: float = 60.0,
+                 dns_cache_ttl: int = 300, timeout: float = 10.0, retries: int = 2, retry_backoff: float = 0.2):
+        """
+        :param limit: Общий лимит соединений
+        :param limit_per_host: Лимит соединений с одним узлом
+        :param keepalive_timeout: Время жизни простаивающего соединения (в секундах)
+        :param dns_cache_ttl: Время кэширования DNS (в секундах)
+        :param timeout: Таймаут запроса по умолчанию (в секундах)
+        :param retries: Количество повторов при сетевых ошибках
+        :param retry_backoff: Начальная пауза между повторами (в секундах)
+        """
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+
+        self.session = None
+        self.connector = None
+
+        # Статистика
+        self.requests = 0
+        self.retried = 0
+        self.failures = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+
+    async def start(self):
+        """Создание сессии и пула соединений"""
+        async def on_create(session, context, params):
+            self.connections_created += 1
+
+        async def on_reuse(session, context, params):
+            self.connections_reused += 1
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(on_create)
+        trace_config.on_connection_reuseconn.append(on_reuse)
+
+        self.connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.dns_cache_ttl,
+            use_dns_cache=True
+        )
+        self.session = aiohttp.ClientSession(
+            connector=self.connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            trace_configs=[trace_config]
+        )
+
+    async def close(self):
+        """Закрытие сессии и всех соединений"""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+            self.connector = None
+
+    async def request(self, method: str, url: str, json_data: Any = None,
+                      timeout: Optional[float] = None, retries: Optional[int] = None,
+                      body: Optional[bytes] = None, headers: Optional[Dict[str, str]] = None,
+                      allow_client_errors: bool = False) -> Any:
+        """
+        Запрос к узлу с повтором при сетевых ошибках
+
+        Ошибки установки соединения повторяются для любых методов, обрывы и
+        ответы 5xx - только для идемпотентных.
+
+        :param body: Уже сериализованное JSON-тело (вместо json_data, например для подписи)
+        :param headers: Дополнительные заголовки
+        :param allow_client_errors: Возвращать тело ответов 4xx вместо исключения
+                                    (API демона описывает в нем ошибку)
+        :return: Разобранный JSON-ответ (или None для пустого ответа)
+        """
+        if self.session is None:
+            raise RuntimeError('HTTP-клиент демона не запущен')
+
+        retries = self.retries if retries is None else retries
+        # Без явного таймаута действует таймаут сессии (None в запросе aiohttp означает "без таймаута")
+        request_timeout = aiohttp.ClientTimeout(total=timeout) if timeout else self.session.timeout
+        idempotent = method.upper() in self.IDEMPOTENT_METHODS
+
+        # Тело сериализуется один раз для всех попыток
+        payload = body if body is not None else json_dumps(json_data) if json_data is not None else None
+        headers = dict(headers or {})
+        if payload is not None:
+            headers['Content-Type'] = 'application/json'
+
+        attempt = 0
+        while True:
+            self.requests += 1
+            try:
+                async with self.session.request(method, url, data=payload, headers=headers,
+                                                timeout=request_timeout) as response:
+                    if response.status >= 500 and idempotent and attempt < retries:
+                        raise aiohttp.ServerDisconnectedError(f"HTTP {response.status}")
+                    if not (allow_client_errors and 400 <= response.status < 500):
+                        response.raise_for_status()
+                    body = await response.read()
+                    return json_loads(body) if body else None
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                retryable = isinstance(e, aiohttp.ClientConnectorError) or (
+                    idempotent and not isinstance(e, aiohttp.ClientResponseError)
+                )
+                if not retryable or attempt >= retries:
+                    self.failures += 1
+                    raise
+
+                self.retried += 1
+                await asyncio.sleep(self.retry_backoff * (2 ** attempt))
+                attempt += 1
+
+    def _pool_sizes(self) -> tuple:
+        """
+        Количество простаивающих и занятых соединений пула
+
+        У TCPConnector нет публичного API для этого, поэтому читаются его
+        внутренние поля; если в другой версии aiohttp их нет, возвращается (None, None).
+        """
+        if self.connector is None:
+            return 0, 0
+        try:
+            idle = sum(len(conns) for conns in getattr(self.connector, '_conns').values())
+            in_use = len(getattr(self.connector, '_acquired'))
+        except (AttributeError, TypeError):
+            return None, None
+        return idle, in_use
+
+    def stats(self) -> Dict[str, Any]:
+        """Статистика пула соединений"""
+        idle, in_use = self._pool_sizes()
+        acquired = self.connections_created + self.connections_reused
+        return {
+            'open_connections': idle + in_use if idle is not None else None,
+            'idle_connections': idle,
+            'in_use_connections': in_use,
+            'connections_created': self.connections_created,
+            'connections_reused': self.connections_reused,
+            'reuse_ratio': round(self.connections_reused / acquired, 4) if acquired else 0.0,
+            'requests': self.requests,
+            'retries': self.retried,
+            'failures': self.failures
+        }
+
+
+SIZE_UNITS = {'': 1, 'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'TB': 1024 ** 4, 'PB': 1024 ** 5}
+DURATION_UNITS = {'d': 86400, 'h': 3600, 'm': 60, 's': 1}
+SIZE_PATTERN = re.compile(r'^\s*([\d.]+)\s*([KMGTP]?i?B)?\s*$', re.IGNORECASE)
+DURATION_PATTERN = re.compile(r'(\d+)\s*([dhms])', re.IGNORECASE)
+
+
+def parse_size(value: Any) -> int:
+    """Объем в байтах из числа или строки вида '1.2 GB' (старые версии узлов)"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    if not value:
+        return 0
+    match = SIZE_PATTERN.match(str(value))
+    if not match:
+        raise ValueError(f"Некорректный объем: {value!r}")
+    unit = (match.group(2) or '').upper().replace('I', '')
+    return int(float(match.group(1)) * SIZE_UNITS[unit])
+
+
+def parse_duration(value: Any) -> int:
+    """Длительность в секундах из числа или строки вида '1h 30m' (старые версии узлов)"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    if not value:
+        return 0
+    parts = DURATION_PATTERN.findall(str(value))
+    if not parts:
+        raise ValueError(f"Некорректная длительность: {value!r}")
+    return sum(int(amount) * DURATION_UNITS[unit.lower()] for amount, unit in parts)
+
+
+def normalize_stats(raw: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Приведение статистики узла к числовому виду без единиц измерения
+
+    Объемы - в байтах, время - в секундах, счетчики - целые числа.
+    """
+    users = []
+    for user in raw.get('users') or []:
+        users.append({
+            'id': user.get('id'),
+            'email': user.get('email'),
+            'up': parse_size(user.get('up')),
+            'down': parse_size(user.get('down'))
+        })
+
+    return {
+        'uptime': parse_duration(raw.get('uptime')),
+        'inbound_connections': int(raw.get('inbound_connections') or 0),
+        'outbound_connections': int(raw.get('outbound_connections') or 0),
+        'total_up': parse_size(raw.get('total_up')),
+        'total_down': parse_size(raw.get('total_down')),
+        'users': users
+    }
+
+
+def percentiles(values, points: Iterable[float]) -> Dict[str, float]:
+    """Перцентили с линейной интерполяцией (как numpy.percentile по умолчанию)"""
+    points = list(points)
+    if not len(values):
+        return {f'p{point:g}': 0 for point in points}
+
+    if numpy is not None:
+        result = numpy.percentile(numpy.asarray(values, dtype=numpy.float64), points)
+        return {f'p{point:g}': round(float(value), 2) for point, value in zip(points, result)}
+
+    ordered = sorted(values)
+    result = {}
+    for point in points:
+        rank = (len(ordered) - 1) * point / 100
+        low = int(rank)
+        high = min(low + 1, len(ordered) - 1)
+        result[f'p{point:g}'] = round(ordered[low] + (ordered[high] - ordered[low]) * (rank - low), 2)
+    return result
+
+
+def valid_percentiles(points: list) -> bool:
+    """Список перцентилей для percentiles: числа от 0 до 100"""
+    return all(isinstance(point, (int, float)) and not isinstance(point, bool) and 0 <= point <= 100
+               for point in points)
+
+
+def aggregate_stats(latest: Dict[int, Dict[str, Any]], top_n: int = 10,
+                    percentile_points: Iterable[float] = (50, 90, 95, 99)) -> Dict[str, Any]:
+    """
+    Агрегация последней статистики по всему парку серверов
+
+    Считает итоги по парку, топ пользователей по трафику (суммарно по всем
+    серверам, пользователь определяется по email, а при его отсутствии по id)
+    и перцентили по серверам. Вычисления векторизованы через NumPy, если он
+    установлен, иначе используются массивы array и heapq.
+
+    :param latest: Числовая статистика по серверам {server_id: stats}
+    :param top_n: Размер топа пользователей
+    :param percentile_points: Перцентили для распределений по серверам
+    """
+    server_ids = list(latest)
+    traffic_up = array('q', (latest[sid]['total_up'] for sid in server_ids))
+    traffic_down = array('q', (latest[sid]['total_down'] for sid in server_ids))
+    connections = array('q', (latest[sid]['inbound_connections'] for sid in server_ids))
+    traffic = array('q', (up + down for up, down in zip(traffic_up, traffic_down)))
+
+    # Плоские массивы по всем пользователям всех серверов, пользователи пронумерованы
+    index = {}
+    codes = array('q')
+    user_up = array('q')
+    user_down = array('q')
+    for sid in server_ids:
+        for user in latest[sid]['users']:
+            key = user['email'] or f"id:{user['id']}"
+            codes.append(index.setdefault(key, len(index)))
+            user_up.append(user['up'])
+            user_down.append(user['down'])
+    keys = list(index)
+    count = min(top_n, len(keys))
+
+    if numpy is not None and keys:
+        code_array = numpy.frombuffer(codes, dtype=numpy.int64)
+        up_totals = numpy.bincount(code_array, weights=numpy.frombuffer(user_up, dtype=numpy.int64), minlength=len(keys))
+        down_totals = numpy.bincount(code_array, weights=numpy.frombuffer(user_down, dtype=numpy.int64),
+                                     minlength=len(keys))
+        totals = up_totals + down_totals
+        top_index = numpy.argpartition(-totals, count - 1)[:count] if count else []
+        top_index = sorted(top_index, key=lambda i: -totals[i])
+    else:
+        up_totals = array('q', bytes(8 * len(keys)))
+        down_totals = array('q', bytes(8 * len(keys)))
+        for code, up, down in zip(codes, user_up, user_down):
+            up_totals[code] += up
+            down_totals[code] += down
+        totals = array('q', (up + down for up, down in zip(up_totals, down_totals)))
+        top_index = heapq.nlargest(count, range(len(keys)), key=totals.__getitem__)
+
+    top_users = [
+        {'user': keys[i], 'up': int(up_totals[i]), 'down': int(down_totals[i]), 'total': int(totals[i])}
+        for i in top_index
+    ]
+
+    return {
+        'totals': {
+            'servers': len(server_ids),
+            'users': len(keys),
+            'inbound_connections': sum(connections),
+            'outbound_connections': sum(latest[sid]['outbound_connections'] for sid in server_ids),
+            'total_up': sum(traffic_up),
+            'total_down': sum(traffic_down)
+        },
+        'top_users': top_users,
+        'percentiles': {
+            'traffic': percentiles(traffic, percentile_points),
+            'inbound_connections': percentiles(connections, percentile_points),
+            'uptime': percentiles([latest[sid]['uptime'] for sid in server_ids], percentile_points)
+        }
+    }
+
+
+class UserDeltaTracker:
+    """
+    Отслеживание изменений счетчиков пользователей одного сервера
+
+    Каждое обновление получает номер последовательности. Пользователи
+    хранятся в порядке последнего изменения, поэтому выборка изменений с
+    указанного номера проходит только по измененным записям. Удаленные
+    пользователи хранятся ограниченное время; если курсор клиента старше
+    этой истории (или выдан до перезапуска демона), возвращается полный
+    снимок.
+    """
+
+    def __init__(self, max_removed: int = 10000):
+        """
+        :param max_removed: Сколько удаленных пользователей помнить для выдачи изменений
+        """
+        self.epoch = uuid.uuid4().hex[:8]
+        self.seq = 0
+        self.min_seq = 0  # Самый старый номер, с которого изменения известны полностью
+        self.max_removed = max_removed
+        self._users = OrderedDict()  # {ключ: (пользователь, номер изменения)}
+        self._removed = OrderedDict()  # {ключ: номер удаления}
+
+    @staticmethod
+    def _key(user: Dict[str, Any]):
+        return user.get('email') or user.get('id')
+
+    @property
+    def cursor(self) -> str:
+        return f"{self.epoch}:{self.seq}"
+
+    def update(self, users: List[Dict[str, Any]]):
+        """Применение свежего списка пользователей"""
+        self.seq += 1
+        seen = set()
+
+        for user in users:
+            key = self._key(user)
+            seen.add(key)
+            current = self._users.get(key)
+            if current is None or current[0]['up'] != user['up'] or current[0]['down'] != user['down']:
+                self._users[key] = (user, self.seq)
+                self._users.move_to_end(key)
+                self._removed.pop(key, None)
+
+        # Если число пользователей совпадает с полученным, удалять некого
+        if len(self._users) != len(seen):
+            for key in [key for key in self._users if key not in seen]:
+                del self._users[key]
+                self._removed[key] = self.seq
+
+        while len(self._removed) > self.max_removed:
+            _, removed_seq = self._removed.popitem(last=False)
+            self.min_seq = max(self.min_seq, removed_seq)
+
+    def parse_cursor(self, cursor: Optional[str]) -> Optional[int]:
+        """Номер последовательности из курсора клиента или None, если нужен полный снимок"""
+        if not cursor:
+            return None
+        epoch, _, seq = str(cursor).partition(':')
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        seq = int(seq)
+        if seq < self.min_seq or seq > self.seq:
+            return None
+        return seq
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """Полный список пользователей"""
+        return [user for user, _ in self._users.values()]
+
+    def changes_since(self, seq: int):
+        """Пользователи, изменившиеся после seq, и ключи удаленных пользователей"""
+        changed = []
+        for user, changed_seq in reversed(self._users.values()):
+            if changed_seq <= seq:
+                break
+            changed.append(user)
+        changed.reverse()
+
+        removed = []
+        for key, removed_seq in reversed(self._removed.items()):
+            if removed_seq <= seq:
+                break
+            removed.append(key)
+
+        return changed, removed
+
+
+class Subscription:
+    """Подписчик на события демона с ограниченной очередью"""
+
+    __slots__ = ('queue', 'server_ids', 'all_servers', 'dropped', 'pending_dropped', 'closed')
+
+    def __init__(self, queue_size: int):
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.server_ids = set()
+        self.all_servers = False
+        self.dropped = 0  # Всего потерянных сообщений
+        self.pending_dropped = 0  # Потеряно с момента последнего уведомления подписчика
+        self.closed = False
+
+    def offer(self, message: Optional[str]):
+        """
+        Постановка сообщения в очередь без ожидания
+
+        При переполнении (медленный подписчик) вытесняется самое старое
+        сообщение, а подписчик получит уведомление о потерях. None в очереди
+        означает отключение подписчика.
+        """
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+            self.pending_dropped += 1
+        self.queue.put_nowait(message)
+
+
+class EventHub:
+    """
+    Рассылка событий (смена статуса, статистика) подписчикам
+
+    Публикация никогда не ждет подписчиков: сообщение сериализуется один
+    раз и кладется в очередь каждого подписчика. Подписчик, потерявший
+    слишком много сообщений, отключается.
+    """
+
+    def __init__(self, queue_size: int = 256, max_dropped: int = 10000):
+        """
+        :param queue_size: Размер очереди одного подписчика
+        :param max_dropped: Число потерянных сообщений, после которого подписчик отключается
+        """
+        self.queue_size = queue_size
+        self.max_dropped = max_dropped
+        self._subscribers = set()
+        self._all_servers = set()
+        self._by_server = {}  # {server_id: {Subscription}}
+
+        # Статистика
+        self.published = 0
+        self.delivered = 0
+        self.disconnected_slow = 0
+
+    def subscribe(self) -> Subscription:
+        subscription = Subscription(self.queue_size)
+        self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscription.closed = True
+        self._subscribers.discard(subscription)
+        self._all_servers.discard(subscription)
+        for server_id in subscription.server_ids:
+            watchers = self._by_server.get(server_id)
+            if watchers is not None:
+                watchers.discard(subscription)
+                if not watchers:
+                    del self._by_server[server_id]
+        subscription.server_ids.clear()
+
+    def watch(self, subscription: Subscription, server_ids):
+        """Подписка на серверы ('*' - на все)"""
+        if server_ids == '*':
+            subscription.all_servers = True
+            self._all_servers.add(subscription)
+            return
+        for server_id in server_ids:
+            subscription.server_ids.add(server_id)
+            self._by_server.setdefault(server_id, set()).add(subscription)
+
+    def unwatch(self, subscription: Subscription, server_ids):
+        """Отписка от серверов ('*' - от всех)"""
+        if server_ids == '*':
+            subscription.all_servers = False
+            self._all_servers.discard(subscription)
+            server_ids = list(subscription.server_ids)
+        for server_id in server_ids:
+            subscription.server_ids.discard(server_id)
+            watchers = self._by_server.get(server_id)
+            if watchers is not None:
+                watchers.discard(subscription)
+                if not watchers:
+                    del self._by_server[server_id]
+
+    def publish(self, server_id: int, event: Dict[str, Any]):
+        """Отправка события всем подписчикам сервера"""
+        watchers = self._by_server.get(server_id)
+        if not watchers and not self._all_servers:
+            return
+
+        self.published += 1
+        message = json_text(dict(event, server_id=server_id))
+        for subscription in (watchers or set()) | self._all_servers:
+            subscription.offer(message)
+            self.delivered += 1
+            if subscription.dropped > self.max_dropped and not subscription.closed:
+                self.disconnected_slow += 1
+                self.unsubscribe(subscription)
+                subscription.offer(None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'subscribers': len(self._subscribers),
+            'watched_servers': len(self._by_server),
+            'published': self.published,
+            'delivered': self.delivered,
+            'dropped': sum(subscription.dropped for subscription in self._subscribers),
+            'disconnected_slow': self.disconnected_slow
+        }
+
+
+def canonical_json(value: Any) -> str:
+    """
+    Каноническое представление JSON: сортированные ключи, без пробелов
+
+    Всегда через стандартный json: от представления зависят хеши в хранилище
+    конфигураций, и оно не должно меняться при установке orjson.
+    """
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+
+def config_hash(body: str) -> str:
+    """Адрес конфигурации в хранилище: sha256 канонического JSON"""
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+
+def _pointer_parts(pointer: str) -> List[str]:
+    """Разбор JSON Pointer (RFC 6901)"""
+    if pointer == '':
+        return []
+    if not pointer.startswith('/'):
+        raise ValueError(f"Некорректный путь: {pointer}")
+    return [part.replace('~1', '/').replace('~0', '~') for part in pointer[1:].split('/')]
+
+
+def _list_index(target: list, part: str, allow_end: bool = False) -> int:
+    """
+    Индекс элемента списка из части JSON Pointer
+
+    Допускаются только неотрицательные десятичные числа без ведущих нулей в пределах
+    списка; при allow_end (операция add) - и позиция сразу за последним элементом.
+    """
+    if not part.isdigit() or (part != '0' and part.startswith('0')):
+        raise ValueError(f"Некорректный индекс списка: {part}")
+    index = int(part)
+    if index > len(target) or (index == len(target) and not allow_end):
+        raise ValueError(f"Индекс списка за пределами: {part}")
+    return index
+
+
+def _pointer_parent(document: Any, pointer: str):
+    """Родительский контейнер и последний ключ пути"""
+    parts = _pointer_parts(pointer)
+    if not parts:
+        raise ValueError('Операция над корнем документа не поддерживается')
+
+    target = document
+    for part in parts[:-1]:
+        if isinstance(target, list):
+            target = target[_list_index(target, part)]
+        elif isinstance(target, dict):
+            target = target[part]
+        else:
+            raise ValueError(f"Путь не найден: {pointer}")
+    return target, parts[-1]
+
+
+def _pointer_get(document: Any, pointer: str) -> Any:
+    target = document
+    for part in _pointer_parts(pointer):
+        target = target[_list_index(target, part)] if isinstance(target, list) else target[part]
+    return target
+
+
+# Операции JSON Patch и их обязательные поля, кроме op и path
+JSON_PATCH_OPERATIONS = {
+    'add': ('value',), 'remove': (), 'replace': ('value',), 'move': ('from',), 'copy': ('from',), 'test': ('value',)
+}
+
+
+def validate_json_patch(patch: Any):
+    """Проверка структуры JSON Patch до применения, при ошибке - ValueError"""
+    if not isinstance(patch, list):
+        raise ValueError('Патч должен быть списком операций')
+    for number, operation in enumerate(patch):
+        if not isinstance(operation, dict):
+            raise ValueError(f"Операция {number} патча должна быть объектом")
+        op = operation.get('op')
+        if op not in JSON_PATCH_OPERATIONS:
+            raise ValueError(f"Неизвестная операция {number} патча: {op}")
+        for field in ('path',) + JSON_PATCH_OPERATIONS[op]:
+            if field not in operation:
+                raise ValueError(f"В операции {number} патча ({op}) нет поля {field}")
+        for field in ('path', 'from'):
+            if field in operation and not isinstance(operation[field], str):
+                raise ValueError(f"Поле {field} операции {number} патча должно быть строкой")
+
+
+def apply_json_patch(document: Any, patch: List[Dict[str, Any]]) -> Any:
+    """
+    Применение JSON Patch (RFC 6902) к документу
+
+    Документ изменяется на месте, поэтому передавать нужно копию.
+
+    :param document: Исходный документ
+    :param patch: Список операций add/remove/replace/move/copy/test
+    :return: Измененный документ
+    """
+    validate_json_patch(patch)
+    for operation in patch:
+        op = operation.get('op')
+        path = operation.get('path')
+        try:
+            if op == 'test':
+                if _pointer_get(document, path) != operation['value']:
+                    raise ValueError(f"Проверка не прошла: {path}")
+                continue
+
+            if op in ('move', 'copy'):
+                value = _pointer_get(document, operation['from'])
+                if op == 'move':
+                    parent, key = _pointer_parent(document, operation['from'])
+                    del parent[_list_index(parent, key) if isinstance(parent, list) else key]
+                else:
+                    value = json_loads(json_dumps(value))
+                op, operation = 'add', {'path': path, 'value': value}
+
+            parent, key = _pointer_parent(document, path)
+            if isinstance(parent, list):
+                if op == 'add':
+                    parent.insert(len(parent) if key == '-' else _list_index(parent, key, allow_end=True),
+                                  operation['value'])
+                elif op == 'remove':
+                    del parent[_list_index(parent, key)]
+                else:
+                    parent[_list_index(parent, key)] = operation['value']
+            elif isinstance(parent, dict):
+                if op == 'add':
+                    parent[key] = operation['value']
+                elif op == 'remove':
+                    del parent[key]
+                else:
+                    if key not in parent:
+                        raise KeyError(key)
+                    parent[key] = operation['value']
+            else:
+                raise ValueError(f"Путь не найден: {path}")
+
+        except (KeyError, IndexError, TypeError) as e:
+            raise ValueError(f"Ошибка применения патча ({op} {path}): {e}")
+
+    return document
+
+
+def _split_clients(config: Dict[str, Any]):
+    """
+    Отделение списков клиентов от остальной конфигурации
+
+    Возвращает (конфигурация без клиентов, {тег inbound: {email: клиент}})
+    или None, если клиентов нельзя адресовать (нет тега или email, дубликаты).
+    """
+    # Копируются только контейнеры на пути к спискам клиентов, сами клиенты не копируются
+    skeleton = dict(config)
+    inbounds = []
+    if isinstance(config.get('inbounds'), list):
+        skeleton['inbounds'] = inbounds = [dict(inbound) if isinstance(inbound, dict) else inbound
+                                           for inbound in config['inbounds']]
+    clients = {}
+    for inbound in inbounds:
+        settings = inbound.get('settings') if isinstance(inbound, dict) else None
+        if not isinstance(settings, dict) or 'clients' not in settings:
+            continue
+        inbound['settings'] = settings = dict(settings)
+
+        tag = inbound.get('tag')
+        if not tag or tag in clients:
+            return None
+
+        by_email = {}
+        for client in settings['clients'] or []:
+            email = client.get('email') if isinstance(client, dict) else None
+            if not email or email in by_email:
+                return None
+            by_email[email] = client
+
+        clients[tag] = by_email
+        settings['clients'] = None
+
+    return skeleton, clients
+
+
+def classify_config_change(old: Dict[str, Any], new: Dict[str, Any]) -> Optional[Dict[str, Dict[str, list]]]:
+    """
+    Классификация изменения конфигурации XRay
+
+    Если изменились только списки клиентов inbound'ов, возвращает изменения
+    для применения без перезапуска: {тег: {'add': [клиенты], 'remove': [email]}}.
+    Для структурных изменений возвращает None.
+    """
+    old_split = _split_clients(old)
+    new_split = _split_clients(new)
+    if old_split is None or new_split is None:
+        return None
+
+    old_skeleton, old_clients = old_split
+    new_skeleton, new_clients = new_split
+    if canonical_json(old_skeleton) != canonical_json(new_skeleton) or old_clients.keys() != new_clients.keys():
+        return None
+
+    changes = {}
+    for tag, old_users in old_clients.items():
+        new_users = new_clients[tag]
+        # Измененный клиент удаляется и добавляется заново
+        remove = [email for email, client in old_users.items() if new_users.get(email) != client]
+        add = [client for email, client in new_users.items() if old_users.get(email) != client]
+        if add or remove:
+            changes[tag] = {'add': add, 'remove': remove}
+
+    return changes
+
+
+class ConfigStore:
+    """
+    Версионированное хранилище конфигураций XRay с адресацией по содержимому
+
+    Тело конфигурации хранится один раз на хеш (одинаковые конфигурации разных
+    серверов не дублируются), для каждого сервера ведется список версий.
+    """
+
+    def __init__(self, db: Database, keep_versions: int = 20, cache_size: int = 64,
+                 changes: Optional['RegistrySync'] = None):
+        """
+        :param db: Слой доступа к базе данных
+        :param keep_versions: Сколько последних версий хранить для сервера
+        :param cache_size: Сколько разобранных конфигураций держать в памяти
+        :param changes: Журнал изменений для сброса кеша версий в других рабочих процессах
+        """
+        self.db = db
+        self.keep_versions = keep_versions
+        self.cache_size = cache_size
+        self.changes = changes
+        self._cache = OrderedDict()  # {hash: конфигурация}
+        self._current = {}  # {server_id: (версия, хеш)}
+
+    async def get(self, digest: str) -> Optional[Dict[str, Any]]:
+        """Конфигурация по хешу (возвращается копия)"""
+        config = self._cache.get(digest)
+        if config is None:
+            row = await self.db.fetchone(SQL_SELECT_CONFIG, (digest,))
+            if not row:
+                return None
+            config = json_loads(row[0])
+            self._remember(digest, config)
+        else:
+            self._cache.move_to_end(digest)
+        return json_loads(json_dumps(config))
+
+    def _remember(self, digest: str, config: Dict[str, Any]):
+        self._cache[digest] = config
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def current(self, server_id: int) -> Optional[tuple]:
+        """Текущая версия конфигурации сервера: (версия, хеш) или None"""
+        if server_id not in self._current:
+            row = await self.db.fetchone(SQL_SELECT_CURRENT_CONFIG, (server_id,))
+            self._current[server_id] = tuple(row) if row else None
+        return self._current[server_id]
+
+    async def put(self, server_id: int, config: Dict[str, Any], body: str, digest: str) -> int:
+        """Сохранение новой версии конфигурации сервера, возвращает номер версии"""
+        current = await self.current(server_id)
+        version = current[0] + 1 if current else 1
+        stale = version - self.keep_versions
+
+        def _put(conn):
+            conn.execute(SQL_INSERT_CONFIG, (digest, body, len(body)))
+            conn.execute(SQL_INSERT_SERVER_CONFIG, (server_id, version, digest))
+
+            # Удаляем старые версии и тела, на которые больше никто не ссылается
+            if stale > 0:
+                hashes = {row[1] for row in conn.execute(SQL_SELECT_STALE_CONFIGS, (server_id, stale))}
+                conn.execute(SQL_DELETE_STALE_CONFIGS, (server_id, stale))
+                for stale_hash in hashes - {digest}:
+                    conn.execute(SQL_DELETE_ORPHAN_CONFIG, (stale_hash, stale_hash))
+
+            if self.changes is not None:
+                self.changes.record(conn, (server_id,), 'config')
+
+        try:
+            await self.db.transaction(_put)
+        except sqlite3.IntegrityError:
+            # Версию уже записал другой рабочий процесс: кеш устарел
+            self.forget(server_id)
+            raise
+        self._current[server_id] = (version, digest)
+        self._remember(digest, config)
+        return version
+
+    def forget(self, server_id: int):
+        """Сброс кеша текущей версии сервера"""
+        self._current.pop(server_id, None)
+
+
+class PermanentJobError(Exception):
+    """Ошибка операции, которую бессмысленно повторять (сервер не найден, неверные данные)"""
+
+
+class AgentNotConfigured(PermanentJobError):
+    """Для сервера не настроен агент узла (см. NODE_STATS_PATH)"""
+
+
+class Job:
+    """Фоновая операция над сервером"""
+
+    __slots__ = ('id', 'kind', 'server_id', 'data', 'status', 'result', 'error', 'attempts',
+                 'created', 'started', 'finished', 'done')
+
+    def __init__(self, job_id: int, kind: str, server_id: int, data: Dict[str, Any]):
+        self.id = job_id
+        self.kind = kind
+        self.server_id = server_id
+        self.data = data
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.attempts = 0
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.done = asyncio.get_running_loop().create_future()
+
+    def details(self) -> str:
+        """Описание операции для operation_logs (без тела конфигурации и патча)"""
+        return json.dumps({
+            'data': {key: value for key, value in self.data.items() if key not in ('config', 'patch')},
+            'result': self.result,
+            'error': self.error,
+            'attempts': self.attempts,
+            'started': self.started,
+            'finished': self.finished
+        }, ensure_ascii=False, default=str)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'job_id': self.id,
+            'type': self.kind,
+            'server_id': self.server_id,
+            'status': self.status,
+            'result': self.result,
+            'error': self.error,
+            'attempts': self.attempts,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished
+        }
+
+
+class JobQueue:
+    """
+    Очередь фоновых операций над серверами (перезапуск, обновление конфигурации)
+
+    Операции выполняются пулом обработчиков: число одновременных операций
+    ограничено числом обработчиков, а операции одного сервера выполняются
+    строго по очереди. Для этого у каждого сервера своя очередь, а в общую
+    очередь попадает только сервер, у которого нет выполняющейся операции.
+    Состояние операций сохраняется в operation_logs.
+
+    Неудачная операция повторяется с экспоненциальной паузой (кроме
+    PermanentJobError). Пока она ждет повтора, сервер остается занятым, так что
+    следующие операции сервера ее не обгоняют, а обработчик свободен для других
+    серверов. Операции, исчерпавшие попытки, попадают в список dead_letter.
+    """
+
+    def __init__(self, db: Database, handlers: Dict[str, Callable], workers: int = 16, max_recent: int = 10000,
+                 max_attempts: int = 3, retry_delay: float = 1.0, max_retry_delay: float = 60.0,
+                 max_dead: int = 1000):
+        """
+        :param db: Слой доступа к базе данных
+        :param handlers: Обработчики операций {тип: корутина handler(job)}
+        :param workers: Количество обработчиков (глобальный лимит параллельных операций)
+        :param max_recent: Сколько завершенных операций держать в памяти
+        :param max_attempts: Максимальное число попыток выполнения операции
+        :param retry_delay: Пауза перед первым повтором (в секундах), дальше удваивается
+        :param max_retry_delay: Максимальная пауза между попытками (в секундах)
+        :param max_dead: Сколько операций, исчерпавших попытки, держать в dead_letter
+        """
+        self.db = db
+        self.handlers = handlers
+        self.workers = workers
+        self.max_recent = max_recent
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+        self.jobs = OrderedDict()  # {job_id: Job}
+        self.dead_letter = deque(maxlen=max_dead)  # Операции, исчерпавшие попытки
+        self._pending = {}  # {server_id: deque(Job)}
+        self._active = set()  # Серверы с выполняющейся операцией или операцией, ждущей повтора
+        self._retry_timers = {}  # {server_id: TimerHandle}
+        self._ready = None  # Очередь серверов, готовых к выполнению следующей операции
+        self._tasks = []
+
+        # Статистика
+        self.submitted = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.retried = 0
+
+    async def start(self, recover: bool = True):
+        """
+        Запуск обработчиков и пометка операций, прерванных прошлым перезапуском
+
+        :param recover: Помечать незавершенные операции прерванными (нельзя, если
+                        их могут выполнять другие рабочие процессы)
+        """
+        if recover:
+            interrupted = await self.db.execute(SQL_FAIL_INTERRUPTED_JOBS)
+            if interrupted:
+                logger.warning(f"Операций, прерванных перезапуском демона: {interrupted}")
+
+        self._ready = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Остановка обработчиков"""
+        for timer in self._retry_timers.values():
+            timer.cancel()
+        self._retry_timers.clear()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, kind: str, server_id: int, data: Dict[str, Any]) -> Job:
+        """Постановка операции в очередь"""
+        if kind not in self.handlers:
+            raise ValueError(f"Неизвестный тип операции: {kind}")
+        if self._ready is None:
+            raise RuntimeError('Очередь операций не запущена')
+
+        job_id = await self.db.transaction(
+            lambda conn: conn.execute(SQL_INSERT_JOB, (server_id, f'job:{kind}', None)).lastrowid
+        )
+
+        job = Job(job_id, kind, server_id, data)
+        self.jobs[job.id] = job
+        self.submitted += 1
+
+        self._pending.setdefault(server_id, deque()).append(job)
+        if server_id not in self._active and len(self._pending[server_id]) == 1:
+            self._ready.put_nowait(server_id)
+
+        return job
+
+    async def _save(self, job: Job):
+        try:
+            await self.db.execute(SQL_UPDATE_JOB, (job.details(), job.status, job.id))
+        except Exception as e:
+            logger.error(f"Ошибка сохранения состояния операции {job.id}: {e}")
+
+    async def _worker(self):
+        while True:
+            server_id = await self._ready.get()
+            self._retry_timers.pop(server_id, None)
+            queue = self._pending.get(server_id)
+            if not queue:
+                continue
+
+            # Операция остается в начале очереди сервера, пока не завершится окончательно
+            job = queue[0]
+            self._active.add(server_id)
+            retry_in = None
+            try:
+                retry_in = await self._execute(job)
+            finally:
+                if retry_in is not None:
+                    self._retry_timers[server_id] = asyncio.get_running_loop().call_later(
+                        retry_in, self._ready.put_nowait, server_id
+                    )
+                else:
+                    queue.popleft()
+                    self._active.discard(server_id)
+                    if queue:
+                        self._ready.put_nowait(server_id)
+                    else:
+                        self._pending.pop(server_id, None)
+
+    async def _execute(self, job: Job) -> Optional[float]:
+        """
+        Одна попытка выполнения операции
+
+        :return: Пауза до следующей попытки или None, если операция завершена
+        """
+        job.status = 'running'
+        job.attempts += 1
+        if job.started is None:
+            job.started = time.time()
+        await self._save(job)
+
+        try:
+            job.result = await self.handlers[job.kind](job)
+            job.status = 'success'
+            job.error = None
+            self.succeeded += 1
+        except asyncio.CancelledError:
+            job.status = 'failed'
+            job.error = 'Операция прервана'
+            await self._finish(job)
+            raise
+        except Exception as e:
+            job.error = str(e)
+            if not isinstance(e, PermanentJobError) and job.attempts < self.max_attempts:
+                delay = min(self.retry_delay * (2 ** (job.attempts - 1)), self.max_retry_delay)
+                job.status = 'retrying'
+                self.retried += 1
+                logger.warning(f"Ошибка операции {job.kind} ({job.id}) на сервере {job.server_id}, "
+                               f"попытка {job.attempts} из {self.max_attempts}, повтор через {delay:.1f} с: {e}")
+                await self._save(job)
+                return delay
+
+            job.status = 'failed'
+            self.failed += 1
+            if not isinstance(e, PermanentJobError):
+                self.dead_letter.append(job)
+            logger.error(f"Ошибка операции {job.kind} ({job.id}) на сервере {job.server_id}: {e}")
+
+        await self._finish(job)
+        return None
+
+    async def _finish(self, job: Job):
+        """Окончательное завершение операции"""
+        job.finished = time.time()
+        if not job.done.done():
+            job.done.set_result(job)
+        await self._save(job)
+        self._forget_old()
+
+    def _forget_old(self):
+        """Удаление из памяти самых старых завершенных операций"""
+        while len(self.jobs) > self.max_recent:
+            job_id, job = next(iter(self.jobs.items()))
+            if job.finished is None:
+                break
+            del self.jobs[job_id]
+
+    async def get(self, job_id: int) -> Optional[Dict[str, Any]]:
+        """Состояние операции из памяти или из operation_logs"""
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+
+        row = await self.db.fetchone(SQL_SELECT_JOB, (job_id,))
+        if not row:
+            return None
+
+        job_id, server_id, operation, details, status, created_at = row
+        details = json.loads(details) if details else {}
+        return {
+            'job_id': job_id,
+            'type': operation.split(':', 1)[1],
+            'server_id': server_id,
+            'status': status,
+            'result': details.get('result'),
+            'error': details.get('error'),
+            'attempts': details.get('attempts'),
+            'created': created_at,
+            'started': details.get('started'),
+            'finished': details.get('finished')
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'workers': self.workers,
+            'queued': sum(len(queue) for queue in self._pending.values()) - len(self._active),
+            'running': len(self._active) - len(self._retry_timers),
+            'retrying': len(self._retry_timers),
+            'submitted': self.submitted,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'retried': self.retried,
+            'dead_letter': len(self.dead_letter)
+        }
+
+
+class Rollout:
+    """
+    Поэтапное применение конфигурации к набору серверов
+
+    Серверы разбиваются на волны по накопленной доле (например, 5%, 25%, 100%).
+    Волна применяется параллельно через очередь операций, затем серверы волны
+    проверяются пробой. Если доля сбоев в волне превышает порог, раскатка
+    останавливается.
+    """
+
+    DEFAULT_WAVES = (5, 25, 100)
+
+    def __init__(self, rollout_id: str, server_ids: List[int], config: Dict[str, Any],
+                 waves: Iterable[float] = DEFAULT_WAVES, max_failure_rate: float = 0.1,
+                 health_delay: float = 5.0):
+        """
+        :param rollout_id: Идентификатор раскатки
+        :param server_ids: Целевые серверы в порядке применения
+        :param config: Применяемая конфигурация
+        :param waves: Накопленные доли серверов по волнам в процентах
+        :param max_failure_rate: Доля сбоев в волне, при превышении которой раскатка останавливается
+        :param health_delay: Пауза перед проверкой серверов волны
+        """
+        self.id = rollout_id
+        self.server_ids = server_ids
+        self.config = config
+        self.max_failure_rate = max_failure_rate
+        self.health_delay = health_delay
+        self.waves = self.split_waves(server_ids, waves)
+
+        self.status = 'pending'
+        self.current_wave = 0
+        self.succeeded = []
+        self.failed = {}  # {server_id: причина}
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.task = None
+
+    @staticmethod
+    def split_waves(server_ids: List[int], waves: Iterable[float]) -> List[List[int]]:
+        """Разбиение серверов на волны по накопленным долям"""
+        total = len(server_ids)
+        bounds = sorted(min(max(float(wave), 0.0), 100.0) for wave in waves)
+        if not bounds or bounds[-1] < 100:
+            bounds.append(100.0)
+
+        result = []
+        start = 0
+        for bound in bounds:
+            # В каждой волне хотя бы один сервер
+            end = max(start + 1, -(-total * int(bound * 100) // 10000))
+            end = min(end, total)
+            if end > start:
+                result.append(server_ids[start:end])
+                start = end
+        return result
+
+    async def run(self, apply: Callable, check: Callable):
+        """
+        Выполнение раскатки
+
+        :param apply: Корутина apply(server_ids) -> {server_id: ошибка или None}
+        :param check: Корутина check(server_ids) -> {server_id: доступен}
+        """
+        self.status = 'running'
+        try:
+            for index, wave in enumerate(self.waves, 1):
+                self.current_wave = index
+
+                errors = await apply(wave)
+                applied = [server_id for server_id in wave if errors.get(server_id) is None]
+                for server_id in wave:
+                    if errors.get(server_id) is not None:
+                        self.failed[server_id] = errors[server_id]
+
+                # Даем XRay подняться после перезапуска и проверяем серверы волны
+                if applied:
+                    if self.health_delay:
+                        await asyncio.sleep(self.health_delay)
+                    health = await check(applied)
+                    for server_id in applied:
+                        if health.get(server_id):
+                            self.succeeded.append(server_id)
+                        else:
+                            self.failed[server_id] = 'Сервер недоступен после применения'
+
+                wave_failures = sum(1 for server_id in wave if server_id in self.failed)
+                if wave_failures / len(wave) > self.max_failure_rate:
+                    self.status = 'aborted'
+                    self.error = f"Доля сбоев в волне {index}: {wave_failures}/{len(wave)}"
+                    logger.warning(f"Раскатка {self.id} остановлена. {self.error}")
+                    return
+
+            self.status = 'completed'
+
+        except asyncio.CancelledError:
+            self.status = 'cancelled'
+            raise
+        except Exception as e:
+            self.status = 'failed'
+            self.error = str(e)
+            logger.error(f"Ошибка раскатки {self.id}: {e}")
+        finally:
+            self.finished = time.time()
+
+    def to_dict(self) -> Dict[str, Any]:
+        done = len(self.succeeded) + len(self.failed)
+        return {
+            'rollout_id': self.id,
+            'status': self.status,
+            'total': len(self.server_ids),
+            'waves': [len(wave) for wave in self.waves],
+            'current_wave': self.current_wave,
+            'done': done,
+            'succeeded': len(self.succeeded),
+            'failed': len(self.failed),
+            'failures': {str(server_id): reason for server_id, reason in list(self.failed.items())[:100]},
+            'error': self.error,
+            'created': self.created,
+            'finished': self.finished
+        }
+
+
+class StatsCollector:
+    """
+    Сбор статистики с узлов в таблицу statistics
+
+    Периодически опрашивает все серверы, превращает накопительные счетчики
+    трафика в приращения и записывает точки пачкой в одной транзакции.
+    В той же транзакции точки добавляются в агрегаты по минутам, часам и
+    дням, поэтому выборки за большие периоды идут по небольшим таблицам.
+    Старые точки и агрегаты удаляются по срокам хранения.
+    """
+
+    # Сроки хранения по умолчанию (в секундах)
+    DEFAULT_RETENTION = {
+        'statistics': 2 * 86400,
+        'statistics_1m': 7 * 86400,
+        'statistics_1h': 90 * 86400,
+        'statistics_1d': 5 * 365 * 86400,
+    }
+
+    def __init__(self, db: Database, registry: ServerRegistry, fetch: Callable, interval: float = 60.0,
+                 concurrency: int = 64, retention: Optional[Dict[str, int]] = None, prune_interval: float = 600.0,
+                 on_point: Optional[Callable] = None):
+        """
+        :param db: Слой доступа к базе данных
+        :param registry: Реестр серверов
+        :param fetch: Корутина fetch(server), возвращающая статистику узла (None - сервер пропускается)
+        :param on_point: Функция on_point(point), вызываемая для каждой записанной точки
+        :param interval: Интервал сбора статистики (в секундах)
+        :param concurrency: Максимальное число одновременных запросов к узлам
+        :param retention: Сроки хранения по таблицам (в секундах)
+        :param prune_interval: Интервал удаления устаревших данных (в секундах)
+        """
+        self.db = db
+        self.registry = registry
+        self.fetch = fetch
+        self.interval = interval
+        self.concurrency = concurrency
+        self.retention = dict(self.DEFAULT_RETENTION, **(retention or {}))
+        self.prune_interval = prune_interval
+        self.on_point = on_point
+
+        self.latest = {}  # {server_id: последняя статистика узла}
+        self.last_collect = 0.0  # Время последнего опроса (time.monotonic())
+        self._counters = {}  # {server_id: (total_up, total_down)}
+        self._last_prune = 0.0
+
+        # Статистика
+        self.collections = 0
+        self.points_written = 0
+        self.fetch_errors = 0
+        self.pruned_rows = 0
+
+    @staticmethod
+    def _counter(stats: Dict[str, Any], key: str) -> int:
+        value = stats.get(key) or 0
+        if not isinstance(value, (int, float)):
+            raise ValueError(f"Нечисловой счетчик {key}: {value!r}")
+        return int(value)
+
+    def make_point(self, server_id: int, timestamp: int, stats: Dict[str, Any]) -> tuple:
+        """
+        Превращение статистики узла в точку (server_id, timestamp, connections, up, down)
+
+        Трафик на узле накопительный, в точку попадает приращение с прошлого
+        опроса. Если счетчик уменьшился (узел перезапущен), приращением
+        считается текущее значение.
+        """
+        connections = self._counter(stats, 'inbound_connections')
+        total_up = self._counter(stats, 'total_up')
+        total_down = self._counter(stats, 'total_down')
+
+        previous = self._counters.get(server_id)
+        self._counters[server_id] = (total_up, total_down)
+        self.latest[server_id] = stats
+
+        if previous is None:
+            return server_id, timestamp, connections, 0, 0
+
+        up = total_up - previous[0] if total_up >= previous[0] else total_up
+        down = total_down - previous[1] if total_down >= previous[1] else total_down
+        return server_id, timestamp, connections, up, down
+
+    async def write(self, points: List[tuple]):
+        """Запись точек и обновление агрегатов одной транзакцией"""
+        if not points:
+            return
+
+        def _write(conn: sqlite3.Connection):
+            conn.executemany(SQL_INSERT_STATISTICS, points)
+            for table, size in STATS_ROLLUPS:
+                conn.executemany(SQL_UPSERT_ROLLUP.format(table=table), [
+                    (server_id, timestamp - timestamp % size, connections, connections, up, down)
+                    for server_id, timestamp, connections, up, down in points
+                ])
+
+        await self.db.transaction(_write)
+        self.points_written += len(points)
+
+        if self.on_point is not None:
+            for point in points:
+                self.on_point(point)
+
+    async def collect_once(self, write: bool = True) -> int:
+        """
+        Однократный опрос всех серверов
+
+        :param write: Записывать точки в базу (без записи обновляется только latest)
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        timestamp = int(time.time())
+
+        async def collect(server: ServerRecord):
+            async with semaphore:
+                try:
+                    stats = await self.fetch(server)
+                    if stats is None:
+                        return None
+                    return self.make_point(server.server_id, timestamp, stats)
+                except Exception as e:
+                    self.fetch_errors += 1
+                    logger.debug(f"Не удалось получить статистику сервера {server.server_id}: {e}")
+                    return None
+
+        results = await asyncio.gather(*(collect(server) for server in list(self.registry)))
+        points = [point for point in results if point is not None]
+        if write:
+            await self.write(points)
+        self.last_collect = time.monotonic()
+
+        # Забываем счетчики отключенных серверов
+        for server_id in list(self._counters):
+            if server_id not in self.registry:
+                self._counters.pop(server_id, None)
+                self.latest.pop(server_id, None)
+
+        self.collections += 1
+        return len(points)
+
+    async def prune(self, now: Optional[int] = None) -> int:
+        """Удаление данных старше срока хранения"""
+        now = int(time.time()) if now is None else now
+
+        def _prune(conn: sqlite3.Connection):
+            # Удаляем по каждому серверу, чтобы использовать индексы (server_id, время)
+            server_ids = [row[0] for row in conn.execute("SELECT DISTINCT server_id FROM statistics_1d")]
+            deleted = 0
+            for table, column in (('statistics', 'timestamp'), ('statistics_1m', 'bucket'),
+                                  ('statistics_1h', 'bucket'), ('statistics_1d', 'bucket')):
+                cutoff = now - self.retention[table]
+                deleted += conn.executemany(
+                    f"DELETE FROM {table} WHERE server_id = ? AND {column} < ?",
+                    [(server_id, cutoff) for server_id in server_ids]
+                ).rowcount
+            return deleted
+
+        deleted = await self.db.transaction(_prune)
+        self.pruned_rows += deleted
+        return deleted
+
+    async def query(self, server_id: int, start: int, end: int, resolution: str = 'auto') -> Dict[str, Any]:
+        """
+        Выборка статистики сервера за период
+
+        :param resolution: raw, 1m, 1h, 1d или auto (по длине периода)
+        """
+        if resolution == 'auto':
+            span = end - start
+            resolution = '1m' if span <= 6 * 3600 else '1h' if span <= 14 * 86400 else '1d'
+
+        if resolution == 'raw':
+            rows = await self.db.fetchall(SQL_SELECT_STATISTICS, (server_id, start, end))
+            points = [
+                {'timestamp': ts, 'connections': connections, 'traffic_up': up, 'traffic_down': down}
+                for ts, connections, up, down in rows
+            ]
+        else:
+            table = f'statistics_{resolution}'
+            if table not in self.retention:
+                raise ValueError(f"Неизвестное разрешение: {resolution}")
+
+            rows = await self.db.fetchall(SQL_SELECT_ROLLUP.format(table=table), (server_id, start, end))
+            points = [
+                {
+                    'timestamp': bucket,
+                    'samples': samples,
+                    'connections_avg': round(connections_sum / samples, 2) if samples else 0,
+                    'connections_max': connections_max,
+                    'traffic_up': up,
+                    'traffic_down': down
+                }
+                for bucket, samples, connections_sum, connections_max, up, down in rows
+            ]
+
+        return {'resolution': resolution, 'points': points}
+
+    async def run(self):
+        """Фоновый сбор статистики и удаление устаревших данных"""
+        while True:
+            started = time.monotonic()
+            try:
+                await self.collect_once()
+
+                if started - self._last_prune >= self.prune_interval:
+                    self._last_prune = started
+                    await self.prune()
+            except Exception as e:
+                logger.error(f"Ошибка сбора статистики: {e}")
+
+            await asyncio.sleep(max(self.interval - (time.monotonic() - started), 0))
+
+    def stats(self) -> Dict[str, Any]:
+        """Статистика сборщика"""
+        return {
+            'collections': self.collections,
+            'points_written': self.points_written,
+            'fetch_errors': self.fetch_errors,
+            'pruned_rows': self.pruned_rows
+        }
+
+
+# Код ошибки в ответе команды с некорректными параметрами (HTTP 400 для /api/<команда>)
+ERROR_INVALID_PARAMS = 'invalid_params'
+
+
+class InvalidParams(ValueError):
+    """Некорректные параметры команды"""
+
+
+class CommandSpec:
+    """Описание команды API: обработчик и схема параметров"""
+
+    __slots__ = ('name', 'handler', 'schema', 'required', 'checks', 'primary')
+
+    def __init__(self, name: str, handler: Callable, schema: Dict[str, Any], required: Dict[str, str],
+                 checks: Optional[Dict[str, tuple]] = None, primary: bool = False):
+        self.name = name
+        self.handler = handler
+        self.schema = schema
+        self.required = required
+        self.checks = checks or {}
+        self.primary = primary
+
+    def validate(self, data: Dict[str, Any]) -> Optional[str]:
+        """Проверка параметров команды, возвращает сообщение об ошибке или None"""
+        for field, message in self.required.items():
+            if data.get(field) in (None, '', [], {}):
+                return message
+
+        for field, types in self.schema.items():
+            value = data.get(field)
+            if value is None:
+                continue
+            # bool - подкласс int, но true/false вместо числа - ошибка клиента
+            types = types if isinstance(types, tuple) else (types,)
+            if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+                return f"Некорректный тип параметра {field}"
+
+        # Проверки значений выполняются после проверки типов
+        for field, (check, message) in self.checks.items():
+            value = data.get(field)
+            if value is not None and not check(value):
+                return message
+
+        return None
+
+
+# Реестр команд API {имя: CommandSpec}, заполняется декоратором command
+COMMANDS = {}
+
+# Параметры, которыми команды ссылаются на сервер
+SERVER_PARAMS = {'server_id': (int, str), 'daemon_id': str}
+
+
+def parse_timestamp(value: Any) -> int:
+    """Unix-время из числа или строки с числом"""
+    return int(float(value))
+
+
+def is_timestamp(value: Any) -> bool:
+    """Значение можно разобрать parse_timestamp"""
+    try:
+        parse_timestamp(value)
+        return True
+    except (TypeError, ValueError, OverflowError):
+        return False
+
+
+def command(name: str, schema: Optional[Dict[str, Any]] = None, required: Optional[Dict[str, str]] = None,
+            checks: Optional[Dict[str, tuple]] = None, primary: bool = False):
+    """
+    Регистрация обработчика команды API
+
+    :param name: Имя команды (/api/<name>)
+    :param schema: Допустимые типы параметров {параметр: тип или кортеж типов}
+    :param required: Обязательные параметры {параметр: сообщение об ошибке}
+    :param checks: Проверки значений {параметр: (функция value -> bool, сообщение об ошибке)}
+    :param primary: Команда работает с состоянием в памяти процесса (очередь операций,
+                    раскатки) и в режиме --workers выполняется только процессом 0
+    """
+    def decorator(func: Callable) -> Callable:
+        COMMANDS[name] = CommandSpec(name, func, schema or {}, required or {}, checks, primary)
+        return func
+    return decorator
+
+
+class LatencyMetrics:
+    """
+    Метрики задержки с гистограммой по метке (команде или обработчику)
+
+    Выводятся в текстовом формате Prometheus.
+    """
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, label: str, description: str):
+        """
+        :param name: Префикс имен метрик
+        :param label: Имя метки (command, handler)
+        :param description: Описание для HELP
+        """
+        self.name = name
+        self.label = label
+        self.description = description
+        self._buckets = {}  # {метка: [счетчики по корзинам (последняя - +Inf)]}
+        self._sum = {}
+        self._errors = {}
+        self._in_flight = {}
+
+    def start(self, key: str):
+        """Начало выполнения"""
+        self._in_flight[key] = self._in_flight.get(key, 0) + 1
+
+    def finish(self, key: str, seconds: float, error: bool = False):
+        """Завершение выполнения с длительностью seconds"""
+        self._in_flight[key] -= 1
+
+        buckets = self._buckets.get(key)
+        if buckets is None:
+            buckets = self._buckets[key] = [0] * (len(self.BUCKETS) + 1)
+            self._sum[key] = 0.0
+            self._errors[key] = 0
+        buckets[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self._sum[key] += seconds
+        if error:
+            self._errors[key] += 1
+
+    def render(self) -> List[str]:
+        """Строки метрик в текстовом формате Prometheus"""
+        name, label = self.name, self.label
+        lines = [
+            f"# HELP {name}_duration_seconds {self.description}",
+            f"# TYPE {name}_duration_seconds histogram"
+        ]
+        for key in sorted(self._buckets):
+            total = 0
+            for bound, count in zip(self.BUCKETS + ('+Inf',), self._buckets[key]):
+                total += count
+                lines.append(f'{name}_duration_seconds_bucket{{{label}="{key}",le="{bound}"}} {total}')
+            lines.append(f'{name}_duration_seconds_sum{{{label}="{key}"}} {self._sum[key]:.6f}')
+            lines.append(f'{name}_duration_seconds_count{{{label}="{key}"}} {total}')
+
+        lines += [f"# HELP {name}_errors_total Количество завершившихся ошибкой", f"# TYPE {name}_errors_total counter"]
+        lines += [f'{name}_errors_total{{{label}="{key}"}} {self._errors[key]}' for key in sorted(self._errors)]
+
+        lines += [f"# HELP {name}_in_flight Количество выполняющихся сейчас", f"# TYPE {name}_in_flight gauge"]
+        lines += [f'{name}_in_flight{{{label}="{key}"}} {count}' for key, count in sorted(self._in_flight.items())]
+        return lines
+
+
+class LoopMonitor:
+    """
+    Диагностика блокировок цикла событий
+
+    Задача в цикле событий раз в interval замеряет отставание таймера. Отдельный
+    поток-сторож проверяет, давно ли задача отмечалась: если цикл занят дольше
+    threshold, сторож снимает стек потока цикла и запоминает, какая задача
+    (команда или обработчик) выполнялась. Когда цикл освобождается, отчет с
+    длительностью блокировки пишется в журнал и доступен командой loop_stats.
+    """
+
+    def __init__(self, interval: float = 0.05, threshold: float = 0.1, max_reports: int = 100,
+                 stack_depth: int = 20):
+        """
+        :param interval: Период замера отставания (в секундах)
+        :param threshold: Длительность блокировки, о которой сообщается (в секундах)
+        :param max_reports: Сколько последних отчетов о блокировках хранить
+        :param stack_depth: Сколько кадров стека сохранять в отчете
+        """
+        self.enabled = False
+        self.interval = interval
+        self.threshold = threshold
+        self.stack_depth = stack_depth
+
+        self.lags = deque(maxlen=1000)  # Последние замеры отставания (в секундах)
+        self.reports = deque(maxlen=max_reports)
+        self.blocks = 0
+        self.max_lag = 0.0
+
+        self._labels = {}  # {задача: команда или обработчик}
+        self._loop = None
+        self._loop_thread_id = None
+        self._beat = 0.0
+        self._pending = None  # Отчет о текущей блокировке, снятый сторожем
+        self._stop = threading.Event()
+        self._thread = None
+
+    def set_label(self, label: str) -> Optional[str]:
+        """Пометка текущей задачи, возвращает предыдущую метку для reset_label"""
+        if not self.enabled:
+            return None
+        task = asyncio.current_task()
+        previous = self._labels.get(task)
+        self._labels[task] = label
+        return previous
+
+    def reset_label(self, previous: Optional[str]):
+        """Восстановление метки текущей задачи"""
+        if not self.enabled:
+            return
+        task = asyncio.current_task()
+        if previous is None:
+            self._labels.pop(task, None)
+        else:
+            self._labels[task] = previous
+
+    async def run(self):
+        """Замер отставания цикла событий (задача в цикле)"""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watchdog, name='loop-watchdog', daemon=True)
+        self._thread.start()
+        try:
+            while True:
+                started = time.monotonic()
+                await asyncio.sleep(self.interval)
+                self._beat = now = time.monotonic()
+                lag = now - started - self.interval
+                self.lags.append(lag)
+                self.max_lag = max(self.max_lag, lag)
+                if lag >= self.threshold:
+                    self._report(lag)
+        finally:
+            self._stop.set()
+
+    def _watchdog(self):
+        """Поток-сторож: снимок стека, пока цикл событий заблокирован"""
+        while not self._stop.wait(self.threshold / 2):
+            blocked = time.monotonic() - self._beat - self.interval
+            if blocked < self.threshold or self._pending is not None:
+                continue
+
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = traceback.format_stack(frame, limit=self.stack_depth) if frame is not None else []
+
+            # Чтение текущей задачи из другого потока: только словарь, без изменения состояния цикла
+            task = asyncio.current_task(self._loop)
+            label = self._labels.get(task)
+            if label is None and task is not None:
+                label = getattr(task.get_coro(), '__qualname__', task.get_name())
+
+            self._pending = {'label': label or 'callback', 'stack': [line.rstrip() for line in stack]}
+
+    def _report(self, lag: float):
+        """Отчет о блокировке после освобождения цикла"""
+        report, self._pending = self._pending or {'label': 'unknown', 'stack': []}, None
+        report = {'time': datetime.now().isoformat(timespec='seconds'), 'blocked_ms': round(lag * 1000, 1), **report}
+        self.reports.append(report)
+        self.blocks += 1
+
+        stack = '\n'.join(report['stack'][-5:])
+        logger.warning(f"Цикл событий заблокирован на {report['blocked_ms']} мс ({report['label']})\n{stack}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'enabled': self.enabled,
+            'threshold_ms': self.threshold * 1000,
+            'lag_ms': percentiles([lag * 1000 for lag in self.lags], (50, 99)),
+            'max_lag_ms': round(self.max_lag * 1000, 1),
+            'blocks': self.blocks
+        }
+
+
+class RequestAuthenticator:
+    """
+    Проверка подлинности запросов к API демона
+
+    Основной способ - подпись HMAC-SHA256 с ключом вызывающей стороны:
+        X-Auth-Caller: <идентификатор ключа>
+        X-Auth-Timestamp: <unix-время в секундах>
+        X-Auth-Nonce: <случайная строка>
+        X-Auth-Signature: hex(HMAC-SHA256(key, "METHOD\\nPATH\\nTIMESTAMP\\nNONCE\\n" + тело))
+
+    Подпись действительна в окне max_skew секунд, повторное использование
+    nonce в этом окне отклоняется. Для совместимости принимается и общий
+    секрет в X-Auth-Key (вызывающая сторона 'legacy').
+
+    Nonce хранится, пока подпись с ним может пройти проверку времени. Если кеш
+    заполнен действующими nonce, новые подписанные запросы отклоняются
+    (NONCE_CACHE_FULL, HTTP 503): вытеснение действующей записи позволило бы
+    повторить запрос. Размер кеша должен быть не меньше 2 * max_skew * пиковое
+    число подписанных запросов в секунду.
+    """
+
+    NONCE_CACHE_FULL = 'Кеш nonce заполнен, повторите запрос позже'
+
+    def __init__(self, secret: str, keys: Optional[Dict[str, str]] = None, allow_legacy: bool = True,
+                 max_skew: int = 300, max_nonces: int = 100000):
+        """
+        :param secret: Общий секретный ключ (X-Auth-Key)
+        :param keys: Ключи вызывающих сторон {идентификатор: ключ}
+        :param allow_legacy: Принимать ли общий секрет в X-Auth-Key
+        :param max_skew: Допустимое расхождение времени подписи (в секундах)
+        :param max_nonces: Максимальный размер кеша использованных nonce (см. NONCE_CACHE_FULL)
+        """
+        self.secret = secret.encode('utf-8')
+        self.allow_legacy = allow_legacy
+        self.max_skew = max_skew
+        self.max_nonces = max_nonces
+
+        # Подготовленные HMAC-объекты: на каждый запрос копируется объект
+        # с уже обработанным ключом вместо повторной инициализации
+        self._keys = {}
+        for caller, key in (keys or {}).items():
+            self.add_key(caller, key)
+
+        self._nonces = OrderedDict()  # {(caller, nonce): срок действия}
+
+        # Статистика
+        self.verified = 0
+        self.legacy = 0
+        self.rejected = 0
+        self.replays = 0
+        self.overflows = 0
+
+    def add_key(self, caller: str, key: str):
+        """Добавление или замена ключа вызывающей стороны"""
+        self._keys[caller] = hmac.new(key.encode('utf-8'), digestmod=hashlib.sha256)
+
+    def remove_key(self, caller: str):
+        """Отзыв ключа вызывающей стороны"""
+        self._keys.pop(caller, None)
+
+    @staticmethod
+    def sign(key: str, method: str, path: str, timestamp: str, nonce: str, body: bytes = b'') -> str:
+        """Подпись запроса (для клиентов и проверок)"""
+        message = f"{method.upper()}\n{path}\n{timestamp}\n{nonce}\n".encode('utf-8') + body
+        return hmac.new(key.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+    @classmethod
+    def signed_headers(cls, caller: str, key: str, method: str, path: str, body: bytes = b'') -> Dict[str, str]:
+        """Заголовки подписанного запроса со свежими временем и nonce"""
+        timestamp = str(int(time.time()))
+        nonce = uuid.uuid4().hex
+        return {
+            'X-Auth-Caller': caller,
+            'X-Auth-Timestamp': timestamp,
+            'X-Auth-Nonce': nonce,
+            'X-Auth-Signature': cls.sign(key, method, path, timestamp, nonce, body)
+        }
+
+    def _remember_nonce(self, caller: str, nonce: str, now: float) -> Optional[str]:
+        """Запоминание nonce, возвращает причину отказа для повтора или переполнения кеша"""
+        entry = (caller, nonce)
+        if entry in self._nonces:
+            self.replays += 1
+            return 'Повторный запрос'
+
+        # Вытесняем только записи с истекшим окном: срок действия растет
+        # в порядке добавления, поэтому они всегда в начале
+        nonces = self._nonces
+        while nonces and next(iter(nonces.values())) < now:
+            nonces.popitem(last=False)
+        if len(nonces) >= self.max_nonces:
+            self.overflows += 1
+            return self.NONCE_CACHE_FULL
+
+        nonces[entry] = now + 2 * self.max_skew
+        return None
+
+    def verify_key(self, key: Optional[str]) -> tuple:
+        """
+        Проверка общего секрета (X-Auth-Key или параметр key канала /ws)
+
+        :return: ('legacy', None) или (None, причина отказа)
+        """
+        if self.allow_legacy and key and hmac.compare_digest(key.encode('utf-8'), self.secret):
+            self.legacy += 1
+            return 'legacy', None
+        self.rejected += 1
+        return None, 'Неверный секретный ключ'
+
+    def verify(self, method: str, path: str, headers, body: bytes = b'') -> tuple:
+        """
+        Проверка запроса
+
+        :return: (идентификатор вызывающей стороны, None) или (None, причина отказа)
+        """
+        signature = headers.get('X-Auth-Signature')
+        if signature is None:
+            return self.verify_key(headers.get('X-Auth-Key'))
+
+        caller = headers.get('X-Auth-Caller', '')
+        timestamp = headers.get('X-Auth-Timestamp', '')
+        nonce = headers.get('X-Auth-Nonce', '')
+
+        prototype = self._keys.get(caller)
+        if prototype is None or not nonce:
+            self.rejected += 1
+            return None, 'Неизвестный ключ или неполная подпись'
+
+        now = time.time()
+        try:
+            if abs(now - int(timestamp)) > self.max_skew:
+                raise ValueError
+        except ValueError:
+            self.rejected += 1
+            return None, 'Подпись просрочена'
+
+        mac = prototype.copy()
+        mac.update(f"{method.upper()}\n{path}\n{timestamp}\n{nonce}\n".encode('utf-8'))
+        mac.update(body)
+        if not hmac.compare_digest(mac.hexdigest(), signature.lower()):
+            self.rejected += 1
+            return None, 'Неверная подпись'
+
+        # Nonce запоминается только после проверки подписи, иначе кеш можно забить мусором
+        error = self._remember_nonce(caller, nonce, now)
+        if error:
+            self.rejected += 1
+            return None, error
+
+        self.verified += 1
+        return caller, None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'callers': len(self._keys),
+            'verified': self.verified,
+            'legacy': self.legacy,
+            'rejected': self.rejected,
+            'replays': self.replays,
+            'overflows': self.overflows,
+            'nonces': len(self._nonces)
+        }
+
+
+class HashRing:
+    """
+    Кольцо консистентного хеширования
+
+    Каждый узел занимает vnodes точек на кольце, ключ принадлежит узлу первой
+    точки по часовой стрелке от хеша ключа. При добавлении или удалении узла
+    меняют владельца только ключи, соседние с его точками (около 1/N всех).
+    """
+
+    def __init__(self, nodes: Iterable[str] = (), vnodes: int = 128):
+        """
+        :param nodes: Идентификаторы узлов
+        :param vnodes: Количество точек на кольце на один узел
+        """
+        self.vnodes = vnodes
+        self.nodes = frozenset(nodes)
+        points = sorted((self._hash(f'{node}#{i}'), node) for node in self.nodes for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+    def owner(self, key) -> Optional[str]:
+        """Узел-владелец ключа (None для пустого кольца)"""
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, self._hash(str(key)))
+        return self._owners[index % len(self._owners)]
+
+
+class ClusterMembership:
+    """
+    Участники кластера демонов и владение server_id
+
+    Каждый узел знает адреса остальных (из --peers и от других узлов) и раз в
+    interval опрашивает их. Узел, не ответивший max_failures раз подряд или
+    сообщивший об уходе, исключается из кольца; ответивший снова возвращается.
+    Запросы к другим узлам подписываются общим ключом кластера и идут через
+    отдельный пул соединений.
+    """
+
+    PING_PATH = '/cluster/ping'
+
+    def __init__(self, node_id: str, url: str, peers: Dict[str, str], secret: str, interval: float = 2.0,
+                 max_failures: int = 3, vnodes: int = 128, timeout: float = 5.0):
+        """
+        :param node_id: Идентификатор этого узла
+        :param url: Адрес API этого узла для других узлов
+        :param peers: Известные узлы {идентификатор: адрес}
+        :param secret: Ключ подписи запросов внутри кластера
+        :param interval: Интервал опроса узлов (в секундах)
+        :param max_failures: Число неудачных опросов подряд до исключения узла
+        :param vnodes: Количество точек на кольце на один узел
+        :param timeout: Таймаут запросов к узлам (в секундах)
+        """
+        self.node_id = node_id
+        self.url = url.rstrip('/')
+        self.secret = secret
+        self.interval = interval
+        self.max_failures = max_failures
+        self.vnodes = vnodes
+        self.members = {peer_id: peer_url.rstrip('/') for peer_id, peer_url in peers.items()}
+        self.members[node_id] = self.url
+        self.alive = {node_id}
+        self.leaving = False
+        self.ring = HashRing(self.alive, vnodes)
+        self.client = NodeClient(limit_per_host=64, timeout=timeout, retries=1)
+        self._failures = {}
+
+        # Статистика
+        self.forwarded = 0
+        self.forward_errors = 0
+        self.pings = 0
+        self.ping_failures = 0
+        self.ring_changes = 0
+
+    def owner(self, server_id) -> str:
+        """Узел-владелец сервера"""
+        return self.ring.owner(ServerRegistry._key(server_id))
+
+    def _headers(self, path: str, body: bytes) -> Dict[str, str]:
+        headers = RequestAuthenticator.signed_headers('cluster', self.secret, 'POST', path, body)
+        headers[CLUSTER_FORWARDED_HEADER] = self.node_id
+        return headers
+
+    async def request(self, node_id: str, path: str, payload: Any) -> Any:
+        """Подписанный запрос к узлу кластера (помечен как пересланный)"""
+        body = json_dumps(payload)
+        return await self.client.request('POST', self.members[node_id] + path, body=body,
+                                         headers=self._headers(path, body))
+
+    async def forward(self, node_id: str, command: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Пересылка команды узлу-владельцу"""
+        self.forwarded += 1
+        try:
+            return await self.request(node_id, f'/api/{command}', data)
+        except Exception as e:
+            self.forward_errors += 1
+            raise RuntimeError(f"Узел кластера {node_id} недоступен: {e}") from e
+
+    def _set_alive(self, node_id: str, alive: bool):
+        if alive:
+            self._failures.pop(node_id, None)
+            self.alive.add(node_id)
+        else:
+            self.alive.discard(node_id)
+
+    def _update_ring(self) -> bool:
+        """Перестроение кольца при изменении состава, возвращает True, если состав изменился"""
+        nodes = set(self.alive)
+        if self.leaving:
+            nodes.discard(self.node_id)
+        if nodes == self.ring.nodes:
+            return False
+        self.ring = HashRing(nodes, self.vnodes)
+        self.ring_changes += 1
+        logger.info(f"Состав кластера изменился: {sorted(nodes)}")
+        return True
+
+    def ping_payload(self) -> Dict[str, Any]:
+        return {'node_id': self.node_id, 'url': self.url, 'members': self.members, 'leaving': self.leaving}
+
+    def handle_ping(self, payload: Dict[str, Any]) -> tuple:
+        """
+        Обработка опроса от другого узла
+
+        :return: (ответ, изменился ли состав кольца)
+        """
+        sender = payload.get('node_id')
+        if isinstance(sender, str) and sender != self.node_id and payload.get('url'):
+            self.members[sender] = str(payload['url']).rstrip('/')
+            self._set_alive(sender, not payload.get('leaving'))
+        self._merge(payload.get('members'))
+        return self.ping_payload(), self._update_ring()
+
+    def _merge(self, members: Any):
+        """Добавление узлов, о которых сообщил другой участник (живыми их сделает опрос)"""
+        if isinstance(members, dict):
+            for node_id, url in members.items():
+                if isinstance(node_id, str) and isinstance(url, str):
+                    self.members.setdefault(node_id, url.rstrip('/'))
+
+    async def _ping(self, node_id: str):
+        self.pings += 1
+        try:
+            response = await self.request(node_id, self.PING_PATH, self.ping_payload())
+            self._set_alive(node_id, not response.get('leaving'))
+            self._merge(response.get('members'))
+        except Exception as e:
+            self.ping_failures += 1
+            failures = self._failures[node_id] = self._failures.get(node_id, 0) + 1
+            if failures >= self.max_failures and node_id in self.alive:
+                logger.warning(f"Узел кластера {node_id} не отвечает: {e}")
+                self._set_alive(node_id, False)
+
+    async def ping_all(self) -> bool:
+        """Опрос всех известных узлов, возвращает True, если состав кольца изменился"""
+        peers = [node_id for node_id in self.members if node_id != self.node_id]
+        await asyncio.gather(*(self._ping(node_id) for node_id in peers))
+        return self._update_ring()
+
+    async def run(self, on_change: Callable):
+        """Периодический опрос узлов, on_change() вызывается при изменении кольца"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                if await self.ping_all():
+                    on_change()
+            except Exception as e:
+                logger.error(f"Ошибка опроса узлов кластера: {e}")
+
+    def mark_leaving(self):
+        """Исключение этого узла из кольца (серверы переходят к остальным узлам)"""
+        self.leaving = True
+        self._update_ring()
+
+    async def leave(self):
+        """Уведомление остальных узлов об уходе из кластера"""
+        self.mark_leaving()
+        await self.ping_all()
+
+    def stats(self) -> Dict[str, Any]:
+        nodes = sorted(self.ring.nodes)
+        return {
+            'node_id': self.node_id,
+            'members': dict(self.members),
+            'ring': nodes,
+            'forwarded': self.forwarded,
+            'forward_errors': self.forward_errors,
+            'pings': self.pings,
+            'ping_failures': self.ping_failures,
+            'ring_changes': self.ring_changes
+        }
+
+
+class WorkerSupervisor:
+    """
+    Запуск и перезапуск рабочих процессов демона
+
+    Процессы создаются через fork и слушают один порт (SO_REUSEPORT), ядро
+    распределяет между ними входящие соединения. Завершившийся процесс
+    перезапускается; если он упал вскоре после запуска, задержка перед
+    следующим перезапуском удваивается.
+    """
+
+    def __init__(self, count: int, target: Callable, restart_delay: float = 1.0, max_restart_delay: float = 30.0,
+                 min_uptime: float = 10.0, stop_timeout: float = 30.0):
+        """
+        :param count: Количество рабочих процессов
+        :param target: Функция target(worker_id), выполняемая в рабочем процессе
+        :param restart_delay: Начальная задержка перед перезапуском (в секундах)
+        :param max_restart_delay: Максимальная задержка перед перезапуском
+        :param min_uptime: Время работы, после которого процесс считается стабильным
+        :param stop_timeout: Время на корректное завершение процессов при остановке
+        """
+        self.count = count
+        self.target = target
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.min_uptime = min_uptime
+        self.stop_timeout = stop_timeout
+        self.processes = {}  # {worker_id: Process}
+        self.restarts = 0
+        self._started = {}  # {worker_id: time.monotonic() запуска}
+        self._delays = {}  # {worker_id: текущая задержка перезапуска}
+        self._restart_at = {}  # {worker_id: время запланированного перезапуска}
+        self._context = multiprocessing.get_context('fork')
+        self._stopping = threading.Event()
+
+    @staticmethod
+    def _worker_main(target: Callable, worker_id: int):
+        # Обработчики сигналов супервизора рабочему процессу не нужны
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        target(worker_id)
+
+    def _spawn(self, worker_id: int):
+        process = self._context.Process(target=self._worker_main, args=(self.target, worker_id),
+                                        name=f'xeray-worker-{worker_id}', daemon=False)
+        process.start()
+        self.processes[worker_id] = process
+        self._started[worker_id] = time.monotonic()
+        logger.info(f"Рабочий процесс {worker_id} запущен (pid {process.pid})")
+
+    def start(self):
+        """Запуск всех рабочих процессов"""
+        for worker_id in range(self.count):
+            self._spawn(worker_id)
+
+    def check(self):
+        """Перезапуск завершившихся процессов (с учетом задержки)"""
+        now = time.monotonic()
+        for worker_id, process in list(self.processes.items()):
+            if process.is_alive() or self._stopping.is_set():
+                continue
+
+            if worker_id not in self._restart_at:
+                uptime = now - self._started[worker_id]
+                delay = self._delays.get(worker_id, self.restart_delay)
+                if uptime >= self.min_uptime:
+                    delay = self.restart_delay
+                self._delays[worker_id] = min(delay * 2, self.max_restart_delay)
+                self._restart_at[worker_id] = now + delay
+                logger.warning(f"Рабочий процесс {worker_id} (pid {process.pid}) завершился с кодом "
+                               f"{process.exitcode}, перезапуск через {delay:.1f} с")
+
+            if now >= self._restart_at[worker_id]:
+                del self._restart_at[worker_id]
+                process.close()
+                self.restarts += 1
+                self._spawn(worker_id)
+
+    def run(self):
+        """Наблюдение за процессами до вызова stop()"""
+        self.start()
+        try:
+            while not self._stopping.is_set():
+                sentinels = [process.sentinel for process in self.processes.values() if process.is_alive()]
+                timeout = 1.0 if not self._restart_at else 0.1
+                multiprocessing.connection.wait(sentinels, timeout=timeout)
+                self.check()
+        finally:
+            self.terminate()
+
+    def stop(self):
+        """Запрос остановки (можно вызывать из обработчика сигнала или другого потока)"""
+        self._stopping.set()
+
+    def terminate(self):
+        """Корректное завершение всех процессов (SIGTERM, затем SIGKILL по таймауту)"""
+        self._stopping.set()
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+
+        deadline = time.monotonic() + self.stop_timeout
+        for worker_id, process in self.processes.items():
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning(f"Рабочий процесс {worker_id} не завершился за {self.stop_timeout} с, SIGKILL")
+                process.kill()
+                process.join()
+
+    def stats(self) -> Dict[str, Any]:
+        """Состояние рабочих процессов"""
+        return {
+            'workers': self.count,
+            'restarts': self.restarts,
+            'alive': sum(process.is_alive() for process in self.processes.values()),
+            'pids': {worker_id: process.pid for worker_id, process in self.processes.items()}
+        }
+
+
 class XrayDaemon:
-    def __init__(self, host: str = '0.0.0.0', port: int = 8080, secret: str = 'daemon-secret-key'):
+    def __init__(self, host: str = '0.0.0.0', port: int = 8080, secret: str = 'daemon-secret-key',
+                 db_path: str = 'daemon.db'):
         """
         Инициализация демона
 
         :param host: Хост для запуска сервера
         :param port: Порт для запуска сервера
         :param secret: Секретный ключ для аутентификации
+        :param db_path: Путь к базе данных демона
         """
         self.host = host
         self.port = port
         self.secret = secret
+        self.auth = RequestAuthenticator(secret)  # Проверка подписей и ключей запросов
         self.running = False
-        self.servers = {}  # Словарь подключенных серверов {server_id: server_info}
+        self.servers = ServerRegistry()  # Реестр подключенных серверов
+        self.started_at = None
         self.app = None
         self.runner = None
         self.site = None
@@ -78,9 +3563,102 @@ class XrayDaemon:
         # Счетчик для отслеживания времени последней проверки
         self.last_status_check = 0
 
+        # Ограничения пакетного выполнения команд
+        self.batch_max_items = 1000
+        self.batch_concurrency = 32
+
+        # Максимальный размер тела запроса (конфигурации с большими списками пользователей)
+        self.max_body_size = 32 * 1024 * 1024
+
+        # Кешированный список серверов для GET /servers и размеры его страниц
+        self.server_list = ServerListCache(self.servers)
+        self.server_list_limit = 1000
+        self.server_list_max_limit = 10000
+
+        # Режим нескольких рабочих процессов (enable_workers): номер процесса и их количество.
+        # Фоновые задачи (проверка доступности, сбор статистики, сроки) и команды с состоянием
+        # в памяти (CommandSpec.primary) выполняет процесс 0
+        self.worker_id = 0
+        self.workers = 1
+        self.primary_port = None  # Внутренний порт процесса 0 на 127.0.0.1
+        self.primary_url = None  # Адрес процесса 0 для остальных процессов
+        self.primary_client = None
+        self.worker_key = None  # Ключ подписи команд, пересылаемых процессу 0
+        self.primary_forwarded = 0
+        self.internal_site = None
+
+        # Режим кластера (enable_cluster): серверы распределены между демонами по server_id
+        self.cluster = None
+        self.cluster_handoff_on_stop = False  # Передать серверы другим узлам при остановке
+        self.rebalance_stats = {'rebalances': 0, 'moved': 0, 'failed': 0}
+        self._rebalance_wakeup = None
+
+        # Метрики команд и HTTP-запросов для /metrics (без аутентификации, если metrics_public)
+        self.command_metrics = LatencyMetrics('xeray_daemon_command', 'command', 'Время выполнения команд API')
+        self.http_metrics = LatencyMetrics('xeray_daemon_http_request', 'handler', 'Время обработки HTTP-запросов')
+        self.metrics_public = False
+
+        # Диагностика блокировок цикла событий (включается --loop-monitor)
+        self.loop_monitor = LoopMonitor()
+
         # Инициализация базы данных
+        self.db_path = db_path
+        self.db = Database(db_path)
         self.init_database()
 
+        # Журнал изменений реестра для других рабочих процессов
+        self.registry_sync = RegistrySync(self.db)
+
+        # Буфер отложенной записи сердцебиений
+        self.heartbeats = HeartbeatBuffer(self.db, changes=self.registry_sync)
+
+        # Сроки сердцебиений: перевод в offline и удаление давно неактивных серверов
+        self.heartbeat_timeout = 300  # секунд без сердцебиения до перевода в offline
+        self.inactive_server_ttl = 0  # секунд без сердцебиения до удаления (0 - не удалять, по умолчанию)
+        self.offline_deadlines = DeadlineIndex()
+        self.cleanup_deadlines = DeadlineIndex()
+        self.removed_inactive = 0
+
+        # Проверка доступности серверов
+        self.prober = HealthProber(self.servers, interval=self.status_check_interval)
+
+        # Отслеживание изменений пользователей для инкрементальной выдачи get_stats
+        self.user_trackers = {}  # {server_id: UserDeltaTracker}
+
+        # Общий HTTP-клиент для обращений к узлам
+        self.node_client = NodeClient()
+
+        # Агент узла (см. NODE_STATS_PATH): общий порт для серверов без agent_url и ключ доступа
+        self.agent_port = None
+        self.agent_key = None
+
+        # Хранилище конфигураций XRay
+        self.configs = ConfigStore(self.db, changes=self.registry_sync)
+
+        # Счетчики применения конфигураций: перезапуски и изменения без перезапуска
+        self.reload_stats = {'restarts': 0, 'restarts_avoided': 0, 'hot_reload_failures': 0}
+
+        # Очередь фоновых операций над серверами
+        self.jobs = JobQueue(self.db, {
+            'restart_xray': self.job_restart_xray,
+            'update_config': self.job_update_config
+        })
+
+        # Поэтапные раскатки конфигурации {rollout_id: Rollout}
+        self.rollouts = OrderedDict()
+        self.max_rollouts = 100
+
+        # Рассылка событий подписчикам /ws
+        self.events = EventHub()
+
+        # Сбор статистики с узлов
+        self.collector = StatsCollector(self.db, self.servers, self.collect_xray_stats,
+                                        on_point=self.publish_stats_point)
+
+        # Событие завершения работы и цикл событий, в котором работает демон
+        self.loop = None
+        self.shutdown_event = None
+
         # Обработка сигналов завершения
         signal.signal(signal.SIGINT, self.signal_handler)
         signal.signal(signal.SIGTERM, self.signal_handler)
@@ -88,15 +3666,60 @@ class XrayDaemon:
         logger.info(f"Демон инициализирован с хостом {host} и портом {port}")
 
 
+    def enable_cluster(self, node_id: str, url: str, peers: Dict[str, str], secret: Optional[str] = None,
+                       **options):
+        """
+        Включение режима кластера
+
+        :param node_id: Идентификатор этого узла
+        :param url: Адрес API этого узла для других узлов
+        :param peers: Известные узлы {идентификатор: адрес}
+        :param secret: Общий ключ подписи запросов внутри кластера (по умолчанию секретный ключ демона)
+        :param options: Дополнительные параметры ClusterMembership
+        """
+        secret = secret or self.secret
+        self.cluster = ClusterMembership(node_id, url, peers, secret, **options)
+        self.auth.add_key('cluster', secret)
+
+    def enable_workers(self, worker_id: int, workers: int, primary_port: int, key: str, timeout: float = 600.0):
+        """
+        Режим нескольких рабочих процессов на одном порту
+
+        Очередь операций, раскатки и список dead_letter живут в памяти процесса,
+        поэтому команды с ними (CommandSpec.primary) выполняет процесс 0: он
+        дополнительно слушает 127.0.0.1:primary_port, остальные процессы
+        пересылают ему такие команды, подписывая их ключом key.
+
+        :param worker_id: Номер этого процесса
+        :param workers: Количество рабочих процессов
+        :param primary_port: Внутренний порт процесса 0
+        :param key: Ключ подписи запросов между процессами
+        :param timeout: Таймаут пересланной команды (в секундах, с учетом wait)
+        """
+        self.worker_id = worker_id
+        self.workers = workers
+        self.worker_key = key
+        self.auth.add_key('worker', key)
+        if worker_id == 0:
+            self.primary_port = primary_port
+        else:
+            self.primary_url = f'http://127.0.0.1:{primary_port}'
+            self.primary_client = NodeClient(limit_per_host=256, timeout=timeout)
+
     def init_database(self):
         """Инициализация базы данных для хранения информации о серверах"""
-        self.db_path = 'daemon.db'
-
         # Убедимся, что директория для базы данных существует
-        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        self.db.run_sync(self._create_schema)
+
+        logger.info("База данных демона инициализирована")
 
-        # Создаем базу данных, если ее нет
-        conn = sqlite3.connect(self.db_path)
+    @staticmethod
+    def _create_schema(conn: sqlite3.Connection):
+        """Создание таблиц и индексов базы данных"""
         cursor = conn.cursor()
 
         # Создаем таблицу серверов
@@ -112,10 +3735,15 @@ class XrayDaemon:
                 status TEXT DEFAULT 'offline',
                 last_heartbeat DATETIME,
                 created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                agent_url TEXT
             )
         """)
 
+        # Базы, созданные до появления агента узла, дополняем колонкой
+        if 'agent_url' not in {row[1] for row in cursor.execute("PRAGMA table_info(servers)")}:
+            cursor.execute("ALTER TABLE servers ADD COLUMN agent_url TEXT")
+
         # Создаем таблицу статистики
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS statistics (
@@ -147,9 +3775,48 @@ class XrayDaemon:
             CREATE UNIQUE INDEX IF NOT EXISTS idx_server_id ON servers(server_id)
         """)
 
-        # Создаем индекс для таблицы статистики
+        # Составной индекс для выборок статистики по серверу и диапазону времени
+        # (заменяет индекс только по server_id)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_statistics_server_time ON statistics(server_id, timestamp)
+        """)
+        cursor.execute("DROP INDEX IF EXISTS idx_statistics_server")
+
+        # Создаем таблицы агрегатов статистики (по минутам, часам и дням)
+        for table, _ in STATS_ROLLUPS:
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    server_id INTEGER NOT NULL,
+                    bucket INTEGER NOT NULL,
+                    samples INTEGER NOT NULL DEFAULT 0,
+                    connections_sum INTEGER NOT NULL DEFAULT 0,
+                    connections_max INTEGER NOT NULL DEFAULT 0,
+                    traffic_up INTEGER NOT NULL DEFAULT 0,
+                    traffic_down INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (server_id, bucket)
+                ) WITHOUT ROWID
+            """)
+
+        # Создаем хранилище конфигураций (тела по хешу и версии по серверам)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS configs (
+                hash TEXT PRIMARY KEY,
+                body TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS server_configs (
+                server_id INTEGER NOT NULL,
+                version INTEGER NOT NULL,
+                hash TEXT NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (server_id, version)
+            ) WITHOUT ROWID
+        """)
         cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_statistics_server ON statistics(server_id)
+            CREATE INDEX IF NOT EXISTS idx_server_configs_hash ON server_configs(hash)
         """)
 
         # Создаем индекс для таблицы логов
@@ -157,43 +3824,120 @@ class XrayDaemon:
             CREATE INDEX IF NOT EXISTS idx_logs_server ON operation_logs(server_id)
         """)
 
-        conn.commit()
-        conn.close()
+        # Создаем журнал изменений реестра (ведется только в режиме нескольких процессов)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS registry_changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                server_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                worker INTEGER NOT NULL
+            )
+        """)
 
-        logger.info("База данных демона инициализирована")
+        # Создаем общий кеш nonce подписанных запросов (используется в режиме нескольких процессов)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS auth_nonces (
+                caller TEXT NOT NULL,
+                nonce TEXT NOT NULL,
+                expires REAL NOT NULL,
+                PRIMARY KEY (caller, nonce)
+            ) WITHOUT ROWID
+        """)
+
+        conn.commit()
 
 
     def signal_handler(self, signum, frame):
         """Обработчик сигналов для корректного завершения работы"""
         logger.info(f"Получен сигнал {signum}, завершение работы...")
-        self.stop()
+        if self.loop is not None and self.shutdown_event is not None:
+            self.loop.call_soon_threadsafe(self.shutdown_event.set)
+
+    async def run(self):
+        """Запуск демона и ожидание сигнала завершения"""
+        self.loop = asyncio.get_running_loop()
+        self.shutdown_event = asyncio.Event()
+
+        try:
+            await self.start()
+            await self.shutdown_event.wait()
+        finally:
+            await self.stop()
+
+    def build_app(self) -> aiohttp.web.Application:
+        """aiohttp-приложение API демона со всеми маршрутами"""
+        app = aiohttp.web.Application(client_max_size=self.max_body_size, middlewares=[self.metrics_middleware])
+
+        # Пакетный маршрут должен идти раньше общего
+        app.router.add_post('/api/batch', self.handle_batch)
+        app.router.add_post('/api/{command}', self.handle_command)
+        app.router.add_get('/ws', self.handle_ws)
+        app.router.add_get('/metrics', self.handle_metrics)
+        if self.cluster is not None:
+            app.router.add_post(ClusterMembership.PING_PATH, self.handle_cluster_ping)
+        app.router.add_get('/health', self.health_check)
+        app.router.add_get('/servers', self.list_servers)
+        app.router.add_get('/server/{server_id}', self.get_server_info)
+        return app
 
     async def start(self):
         """Запуск демона"""
         logger.info(f"Запуск демона на {self.host}:{self.port}")
 
-        # Создаем aiohttp приложение
-        self.app = aiohttp.web.Application()
+        # Позицию журнала изменений запоминаем до загрузки, чтобы не пропустить изменения
+        if self.workers > 1:
+            self.registry_sync.worker_id = self.worker_id
+            self.registry_sync.enabled = True
+            await self.registry_sync.start()
+
+        # Загружаем реестр серверов до начала обработки запросов
+        await self.load_servers()
+
+        # Открываем пул соединений с узлами
+        await self.node_client.start()
 
-        # Регистрируем маршруты
-        self.app.router.add_post('/api/{command}', self.handle_command)
-        self.app.router.add_get('/health', self.health_check)
-        self.app.router.add_get('/servers', self.list_servers)
-        self.app.router.add_get('/server/{server_id}', self.get_server_info)
+        # Запускаем обработчики фоновых операций (прерванные операции помечает супервизор)
+        await self.jobs.start(recover=self.workers == 1)
+
+        # Создаем aiohttp приложение
+        self.app = self.build_app()
 
         # Запускаем сервер
         self.runner = aiohttp.web.AppRunner(self.app)
         await self.runner.setup()
 
-        self.site = aiohttp.web.TCPSite(self.runner, self.host, self.port)
+        self.site = aiohttp.web.TCPSite(self.runner, self.host, self.port, reuse_port=self.workers > 1 or None)
         await self.site.start()
 
+        if self.primary_port is not None:
+            self.internal_site = aiohttp.web.TCPSite(self.runner, '127.0.0.1', self.primary_port)
+            await self.internal_site.start()
+        if self.primary_client is not None:
+            await self.primary_client.start()
+
         self.running = True
+        self.started_at = time.time()
         logger.info("Демон запущен успешно")
 
+        if self.cluster is not None:
+            await self.start_cluster()
+
         # Запускаем задачи мониторинга
-        asyncio.create_task(self.monitor_servers())
-        asyncio.create_task(self.cleanup_inactive_servers())
+        if self.loop_monitor.enabled:
+            self.monitoring_tasks.append(asyncio.create_task(self.loop_monitor.run()))
+        self.monitoring_tasks.append(asyncio.create_task(self.heartbeats.run()))
+        if self.workers > 1:
+            prune_interval = 60 if self.worker_id == 0 else None
+            self.monitoring_tasks.append(asyncio.create_task(
+                self.registry_sync.run(self.apply_registry_changes, prune_interval)
+            ))
+        if self.worker_id == 0:
+            self.monitoring_tasks.append(asyncio.create_task(self.prober.run(self.apply_probe_result)))
+            self.monitoring_tasks.append(asyncio.create_task(self.collector.run()))
+            self.monitoring_tasks.append(asyncio.create_task(self.monitor_servers()))
+            self.monitoring_tasks.append(asyncio.create_task(self.cleanup_inactive_servers()))
+            if self.workers > 1:
+                self.monitoring_tasks.append(asyncio.create_task(self.prune_nonces()))
 
         logger.info("Все задачи мониторинга запущены")
 
@@ -205,64 +3949,570 @@ class XrayDaemon:
 
         if self.site:
             await self.site.stop()
+        if self.internal_site:
+            await self.internal_site.stop()
 
         if self.runner:
             await self.runner.cleanup()
 
-        logger.info("Демон остановлен")
+        # Останавливаем фоновые задачи
+        for task in self.monitoring_tasks:
+            task.cancel()
+        await asyncio.gather(*self.monitoring_tasks, return_exceptions=True)
+        self.monitoring_tasks = []
+
+        for rollout in self.rollouts.values():
+            if rollout.task and not rollout.task.done():
+                rollout.task.cancel()
+
+        if self.cluster is not None:
+            await self.stop_cluster()
+
+        await self.jobs.stop()
+        await self.node_client.close()
+        if self.primary_client is not None:
+            await self.primary_client.close()
+
+        # Сбрасываем отложенные изменения перед закрытием базы данных
+        try:
+            flushed = await self.heartbeats.flush()
+            logger.info(f"Сброшено отложенных изменений статусов: {flushed}")
+        except Exception as e:
+            logger.error(f"Ошибка сброса буфера сердцебиений при остановке: {e}")
+
+        self.db.close()
+
+        logger.info("Демон остановлен")
+
+    async def check_auth(self, request: aiohttp.web.Request) -> Optional[aiohttp.web.Response]:
+        """
+        Проверка подписи или секретного ключа, возвращает ответ с ошибкой или None
+
+        Идентификатор вызывающей стороны сохраняется в request[CALLER_KEY].
+        """
+        body = b''
+        if 'X-Auth-Signature' in request.headers:
+            # Подпись охватывает тело, поэтому оно читается здесь с тем же лимитом, что и в read_json
+            if request.content_length is not None and request.content_length > self.max_body_size:
+                return self.body_too_large()
+            try:
+                body = await request.read()
+            except aiohttp.web.HTTPRequestEntityTooLarge:
+                return self.body_too_large()
+
+        caller, error = self.auth.verify(request.method, request.raw_path, request.headers, body)
+        if error:
+            status = 503 if error == RequestAuthenticator.NONCE_CACHE_FULL else 401
+            return json_response({'success': False, 'message': error}, status=status)
+
+        # Кеш nonce у каждого процесса свой: повтор, попавший в соседний процесс, ловит общая таблица
+        if self.workers > 1 and 'X-Auth-Signature' in request.headers:
+            if not await self.claim_nonce(caller, request.headers['X-Auth-Nonce']):
+                self.auth.replays += 1
+                return json_response({'success': False, 'message': 'Повторный запрос'}, status=401)
+
+        request[CALLER_KEY] = caller
+        return None
+
+    async def claim_nonce(self, caller: str, nonce: str) -> bool:
+        """Регистрация nonce в общей таблице рабочих процессов, False - nonce уже использован"""
+        now = time.time()
+        expires = now + 2 * self.auth.max_skew
+        return await self.db.execute(SQL_CLAIM_NONCE, (caller, nonce, expires, now)) > 0
+
+    async def health_check(self, request: aiohttp.web.Request):
+        """Проверка работоспособности (без аутентификации, для балансировщиков и мониторинга)"""
+        return json_response({
+            'status': 'ok' if self.running else 'stopping',
+            'uptime': round(time.time() - self.started_at, 3) if self.started_at else 0,
+            'servers': len(self.servers),
+            'worker_id': self.worker_id,
+            'node_id': self.cluster.node_id if self.cluster is not None else None
+        }, status=200 if self.running else 503)
+
+    def body_too_large(self) -> aiohttp.web.Response:
+        """Ответ 413 для тела запроса больше max_body_size"""
+        return json_response({'success': False, 'message': f'Тело запроса больше {self.max_body_size} байт'},
+                             status=413)
+
+    @aiohttp.web.middleware
+    async def metrics_middleware(self, request: aiohttp.web.Request, handler: Callable):
+        """Учет времени обработки, выполняющихся запросов и ошибок по обработчикам"""
+        resource = request.match_info.route.resource
+        key = resource.canonical if resource is not None else 'unmatched'
+        if key == '/api/{command}':
+            # Неизвестные команды не создают новых меток
+            command_name = request.match_info.get('command')
+            key = f'/api/{command_name}' if command_name in COMMANDS else key
+
+        self.http_metrics.start(key)
+        label = self.loop_monitor.set_label(key)
+        started = time.perf_counter()
+        failed = True
+        try:
+            response = await handler(request)
+            failed = response.status >= 500
+            return response
+        finally:
+            self.http_metrics.finish(key, time.perf_counter() - started, failed)
+            self.loop_monitor.reset_label(label)
+
+    async def handle_cluster_ping(self, request: aiohttp.web.Request):
+        """Опрос от другого узла кластера: обмен составом кластера"""
+        error = await self.check_auth(request)
+        if error:
+            return error
+        if request.get(CALLER_KEY) != 'cluster':
+            return json_response({'success': False, 'message': 'Требуется ключ кластера'}, status=403)
+
+        payload, error = await self.read_json(request)
+        if error:
+            return error
+        if not isinstance(payload, dict):
+            return json_response({'success': False, 'message': 'Ожидается JSON-объект'}, status=400)
+
+        response, changed = self.cluster.handle_ping(payload)
+        if changed:
+            self.on_cluster_change()
+        return json_response(response)
+
+    async def handle_metrics(self, request: aiohttp.web.Request):
+        """Метрики демона в текстовом формате Prometheus"""
+        if not self.metrics_public:
+            error = await self.check_auth(request)
+            if error:
+                return error
+
+        jobs = self.jobs.stats()
+        lines = self.command_metrics.render() + self.http_metrics.render() + [
+            '# HELP xeray_daemon_servers Количество подключенных серверов',
+            '# TYPE xeray_daemon_servers gauge',
+            f'xeray_daemon_servers {len(self.servers)}',
+            '# HELP xeray_daemon_jobs Фоновые операции по состоянию',
+            '# TYPE xeray_daemon_jobs gauge',
+            f'xeray_daemon_jobs{{state="queued"}} {jobs["queued"]}',
+            f'xeray_daemon_jobs{{state="running"}} {jobs["running"]}',
+            f'xeray_daemon_jobs{{state="retrying"}} {jobs["retrying"]}',
+            '# HELP xeray_daemon_ws_subscribers Количество подписчиков /ws',
+            '# TYPE xeray_daemon_ws_subscribers gauge',
+            f'xeray_daemon_ws_subscribers {self.events.stats()["subscribers"]}'
+        ]
+        if self.loop_monitor.enabled:
+            lines += [
+                '# HELP xeray_daemon_loop_lag_max_seconds Максимальное отставание цикла событий',
+                '# TYPE xeray_daemon_loop_lag_max_seconds gauge',
+                f'xeray_daemon_loop_lag_max_seconds {self.loop_monitor.max_lag:.6f}',
+                '# HELP xeray_daemon_loop_blocks_total Количество блокировок цикла событий дольше порога',
+                '# TYPE xeray_daemon_loop_blocks_total counter',
+                f'xeray_daemon_loop_blocks_total {self.loop_monitor.blocks}'
+            ]
+        return aiohttp.web.Response(
+            body=('\n'.join(lines) + '\n').encode('utf-8'),
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+        )
+
+    @staticmethod
+    def cached_response(request: aiohttp.web.Request, etag: str, body: bytes) -> aiohttp.web.Response:
+        """Ответ с ETag: 304 без тела, если клиент уже получил это содержимое"""
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if etag_matches(request.headers.get('If-None-Match'), etag):
+            return aiohttp.web.Response(status=304, headers=headers)
+        return aiohttp.web.Response(body=body, content_type='application/json', headers=headers)
+
+    async def list_servers(self, request: aiohttp.web.Request):
+        """
+        Список серверов из реестра в памяти
+
+        Параметры запроса: status - фильтр по статусу, limit - размер страницы,
+        cursor - next_cursor из предыдущего ответа. В режиме кластера
+        возвращаются только серверы этого узла.
+        """
+        error = await self.check_auth(request)
+        if error:
+            return error
+
+        query = request.query
+        status = query.get('status') or None
+        cursor = query.get('cursor') or None
+        try:
+            limit = int(query.get('limit', self.server_list_limit))
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= self.server_list_max_limit:
+            return json_response(
+                {'success': False, 'message': f'limit должен быть от 1 до {self.server_list_max_limit}'},
+                status=400
+            )
+        if cursor is not None:
+            cursor = ServerRegistry._key(cursor)
+
+        await self.server_list.refresh()
+        etag, body = self.server_list.page(status, cursor, limit)
+        return self.cached_response(request, etag, body)
+
+    async def get_server_info(self, request: aiohttp.web.Request):
+        """Информация о сервере из реестра и текущая версия его конфигурации"""
+        error = await self.check_auth(request)
+        if error:
+            return error
+
+        server, error = self.find_server(request.match_info['server_id'])
+        if error:
+            return json_response({'success': False, 'message': error}, status=404)
+
+        current = await self.configs.current(server.server_id)
+        body = json_dumps({
+            'success': True,
+            'server': server.to_dict(),
+            'config': {'version': current[0], 'hash': current[1]} if current else None
+        })
+        return self.cached_response(request, make_etag(body), body)
+
+    async def read_json(self, request: aiohttp.web.Request) -> tuple:
+        """
+        Чтение и разбор JSON-тела запроса
+
+        Пустое тело считается пустым объектом.
+
+        :return: (данные, None) или (None, ответ с ошибкой 400/413)
+        """
+        if request.content_length is not None and request.content_length > self.max_body_size:
+            return None, self.body_too_large()
+
+        try:
+            body = await request.read()
+        except aiohttp.web.HTTPRequestEntityTooLarge:
+            return None, self.body_too_large()
+
+        if not body.strip():
+            return {}, None
+
+        try:
+            return json_loads(body), None
+        except ValueError as e:
+            return None, json_response({'success': False, 'message': f'Некорректный JSON: {e}'}, status=400)
+
+    async def handle_command(self, request: aiohttp.web.Request):
+        """Обработка входящих команд"""
+        try:
+            # Проверка секретного ключа
+            error = await self.check_auth(request)
+            if error:
+                return error
+
+            # Получение команды и параметров
+            command = request.match_info['command']
+            data, error = await self.read_json(request)
+            if error:
+                return error
+            if not isinstance(data, dict):
+                return json_response({'success': False, 'message': 'Ожидается JSON-объект'}, status=400)
+
+            # Обработка команды
+            result = await self.process_command(command, data, forwarded=self.is_forwarded(request))
+
+            return json_response(result, status=400 if result.get('error') == ERROR_INVALID_PARAMS else 200)
+
+        except Exception as e:
+            logger.error(f"Ошибка обработки команды: {e}")
+            return json_response(
+                {'success': False, 'message': str(e)},
+                status=500
+            )
+
+    async def handle_ws(self, request: aiohttp.web.Request):
+        """
+        WebSocket-канал событий о серверах
+
+        Клиент отправляет {"action": "subscribe" | "unsubscribe", "server_ids": [...] | "*"}
+        и получает события {"type": "status" | "stats", "server_id": ..., ...}.
+        При подписке сразу приходит текущий статус серверов. Если клиент не
+        успевает читать, старые события вытесняются, и клиент получает
+        {"type": "lagged", "dropped": N}.
+        """
+        # Браузерные клиенты не могут передать заголовок, поэтому общий секрет принимается
+        # и в параметре key (с теми же ограничениями, что и X-Auth-Key)
+        if 'key' in request.query:
+            caller, error = self.auth.verify_key(request.query['key'])
+            if error:
+                return json_response({'success': False, 'message': error}, status=401)
+            request[CALLER_KEY] = caller
+        else:
+            error = await self.check_auth(request)
+            if error:
+                return error
+
+        ws = aiohttp.web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+
+        subscription = self.events.subscribe()
+
+        async def sender():
+            while True:
+                message = await subscription.queue.get()
+                if message is None:
+                    # Подписчик отключен из-за слишком большого отставания
+                    break
+                if subscription.pending_dropped:
+                    await ws.send_str(json_text({'type': 'lagged', 'dropped': subscription.pending_dropped}))
+                    subscription.pending_dropped = 0
+                await ws.send_str(message)
+            await ws.close(code=aiohttp.WSCloseCode.POLICY_VIOLATION, message=b'slow consumer')
+
+        sender_task = asyncio.create_task(sender())
+        try:
+            async for message in ws:
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                try:
+                    request_data = json_loads(message.data)
+                    action = request_data['action']
+                    server_ids = request_data.get('server_ids', '*')
+                    if server_ids != '*':
+                        server_ids = [ServerRegistry._key(server_id) for server_id in server_ids]
+                except (ValueError, KeyError, TypeError):
+                    await ws.send_str(json_text({'type': 'error', 'message': 'Некорректное сообщение'}))
+                    continue
+
+                if action == 'subscribe':
+                    self.events.watch(subscription, server_ids)
+                    servers = self.servers if server_ids == '*' else filter(None, map(self.servers.get, server_ids))
+                    for server in servers:
+                        subscription.offer(json_text(self.status_event(server)))
+                elif action == 'unsubscribe':
+                    self.events.unwatch(subscription, server_ids)
+                else:
+                    await ws.send_str(json_text({'type': 'error', 'message': f'Неизвестное действие: {action}'}))
+        finally:
+            self.events.unsubscribe(subscription)
+            sender_task.cancel()
+
+        return ws
+
+    async def handle_batch(self, request: aiohttp.web.Request):
+        """
+        Пакетная обработка команд за один запрос
+
+        Тело запроса: список [{"command": ..., "data": {...}}, ...] или
+        {"commands": [...]}. Команды выполняются параллельно с ограничением
+        batch_concurrency, результаты возвращаются в исходном порядке.
+        Ошибка отдельной команды не прерывает выполнение пакета.
+        """
+        try:
+            # Проверка секретного ключа
+            error = await self.check_auth(request)
+            if error:
+                return error
+
+            payload, error = await self.read_json(request)
+            if error:
+                return error
+
+            items = payload.get('commands') if isinstance(payload, dict) else payload
+            if not isinstance(items, list):
+                return json_response(
+                    {'success': False, 'message': 'Ожидается список команд'},
+                    status=400
+                )
+
+            if len(items) > self.batch_max_items:
+                return json_response(
+                    {'success': False, 'message': f'Слишком много команд в пакете (максимум {self.batch_max_items})'},
+                    status=400
+                )
+
+            results = await self.process_batch(items, forwarded=self.is_forwarded(request))
+
+            return json_response({'success': True, 'results': results})
+
+        except Exception as e:
+            logger.error(f"Ошибка обработки пакета команд: {e}")
+            return json_response(
+                {'success': False, 'message': str(e)},
+                status=500
+            )
+
+    async def process_batch(self, items: List[Any], forwarded: bool = False) -> List[Dict[str, Any]]:
+        """
+        Параллельное выполнение списка команд с сохранением порядка результатов
+
+        В режиме кластера команды серверов других узлов пересылаются владельцам
+        одним пакетом на узел.
+
+        :param forwarded: Пакет переслан другим узлом кластера (не пересылать дальше)
+        """
+        results = [None] * len(items)
+        remote = {}  # {node_id: [индексы команд]}
+        if self.cluster is not None and not forwarded:
+            for index, item in enumerate(items):
+                data = item.get('data') if isinstance(item, dict) else None
+                owner = self.remote_owner(data) if isinstance(data, dict) else None
+                if owner is not None:
+                    remote.setdefault(owner, []).append(index)
+
+        semaphore = asyncio.Semaphore(self.batch_concurrency)
+
+        async def run_item(index: int):
+            item = items[index]
+            if not isinstance(item, dict) or not isinstance(item.get('command'), str):
+                results[index] = {'success': False, 'message': 'Некорректный элемент пакета'}
+                return
+
+            command = item['command']
+            data = item.get('data') or {}
+            if command == 'batch':
+                results[index] = {'success': False, 'message': 'Вложенные пакеты не поддерживаются'}
+                return
+            if not isinstance(data, dict):
+                results[index] = {'success': False, 'message': 'Некорректные параметры команды'}
+                return
+
+            async with semaphore:
+                results[index] = await self.process_command(command, data, forwarded=True)
+
+        async def run_remote(node_id: str, indexes: List[int]):
+            self.cluster.forwarded += len(indexes)
+            try:
+                response = await self.cluster.request(node_id, '/api/batch',
+                                                      {'commands': [items[index] for index in indexes]})
+                remote_results = response['results']
+            except Exception as e:
+                self.cluster.forward_errors += 1
+                remote_results = [{'success': False, 'message': f"Узел кластера {node_id} недоступен: {e}"}] * len(indexes)
+            for index, result in zip(indexes, remote_results):
+                results[index] = result
+
+        # Владельцы уже определены выше: локальные команды не пересылаются повторно
+        remote_indexes = {index for indexes in remote.values() for index in indexes}
+        await asyncio.gather(
+            *(run_item(index) for index in range(len(items)) if index not in remote_indexes),
+            *(run_remote(node_id, indexes) for node_id, indexes in remote.items())
+        )
+        return results
+
+    def remote_owner(self, data: Dict[str, Any]) -> Optional[str]:
+        """Узел кластера, которому принадлежит сервер команды, если это не этот узел"""
+        if self.cluster is None or data.get('server_id') is None:
+            return None
+        owner = self.cluster.owner(data['server_id'])
+        return owner if owner != self.cluster.node_id else None
+
+    def is_forwarded(self, request: aiohttp.web.Request) -> bool:
+        """
+        Запрос переслан другим узлом кластера или рабочим процессом
+
+        Учитывается только с подписью ключом кластера или рабочих процессов.
+        """
+        caller = request.get(CALLER_KEY)
+        return caller == 'worker' or (caller == 'cluster' and CLUSTER_FORWARDED_HEADER in request.headers)
+
+    async def process_command(self, command: str, data: Dict[str, Any], forwarded: bool = False) -> Dict[str, Any]:
+        """
+        Обработка конкретной команды через реестр COMMANDS
+
+        В режиме кластера команда сервера, принадлежащего другому узлу,
+        пересылается владельцу. В режиме --workers команды с состоянием в
+        памяти (CommandSpec.primary) пересылаются процессу 0.
+
+        :param forwarded: Команда переслана другим узлом кластера (не пересылать дальше)
+        """
+        spec = COMMANDS.get(command)
+        if spec is None:
+            return {'success': False, 'message': f'Неизвестная команда: {command}'}
+
+        self.command_metrics.start(command)
+        label = self.loop_monitor.set_label(command)
+        started = time.perf_counter()
+        result = None
+        try:
+            error = spec.validate(data)
+            owner = None if error or forwarded else self.remote_owner(data)
+            if error:
+                result = {'success': False, 'message': error, 'error': ERROR_INVALID_PARAMS}
+            elif owner is not None:
+                result = await self.cluster.forward(owner, command, data)
+            elif spec.primary and self.primary_url is not None:
+                result = await self.forward_to_primary(command, data)
+            else:
+                result = await spec.handler(self, data)
+            return result
+
+        except InvalidParams as e:
+            result = {'success': False, 'message': str(e), 'error': ERROR_INVALID_PARAMS}
+            return result
 
-    async def handle_command(self, request: aiohttp.web.Request):
-        """Обработка входящих команд"""
+        except Exception as e:
+            logger.error(f"Ошибка выполнения команды {command}: {e}")
+            result = {'success': False, 'message': str(e)}
+            return result
+
+        finally:
+            failed = not (isinstance(result, dict) and result.get('success'))
+            self.command_metrics.finish(command, time.perf_counter() - started, failed)
+            self.loop_monitor.reset_label(label)
+
+    async def forward_to_primary(self, command: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Выполнение команды процессом 0 (ответ 400 с описанием ошибки возвращается как есть)"""
+        path = f'/api/{command}'
+        body = json_dumps(data)
+        self.primary_forwarded += 1
         try:
-            # Проверка секретного ключа
-            auth_header = request.headers.get('X-Auth-Key')
-            if not auth_header or auth_header != self.secret:
-                return aiohttp.web.json_response(
-                    {'success': False, 'message': 'Неверный секретный ключ'},
-                    status=401
-                )
+            return await self.primary_client.request(
+                'POST', self.primary_url + path, body=body, allow_client_errors=True,
+                headers=RequestAuthenticator.signed_headers('worker', self.worker_key, 'POST', path, body)
+            )
+        except Exception as e:
+            raise RuntimeError(f"Рабочий процесс 0 недоступен: {e}") from e
 
-            # Получение команды и параметров
-            command = request.match_info['command']
-            try:
-                data = await request.json()
-            except:
-                data = {}
+    def find_server(self, server_id, daemon_id: Optional[str] = None):
+        """
+        Поиск сервера в реестре
 
-            # Обработка команды
-            result = await self.process_command(command, data)
+        Реестр загружается из базы данных при запуске и дальше остается
+        единственным источником данных о серверах.
 
-            return aiohttp.web.json_response(result)
+        :param server_id: ID сервера
+        :param daemon_id: ID демона для проверки (необязательно)
+        :return: Кортеж (запись о сервере, сообщение об ошибке)
+        """
+        server = self.servers.get(server_id)
+        if server is None:
+            return None, 'Сервер не найден'
 
-        except Exception as e:
-            logger.error(f"Ошибка обработки команды: {e}")
-            return aiohttp.web.json_response(
-                {'success': False, 'message': str(e)},
-                status=500
-            )
+        # Если указан daemon_id, проверяем его
+        if daemon_id and server.daemon_id != daemon_id:
+            return None, 'Неверный ID демона'
 
-    async def process_command(self, command: str, data: Dict[str, Any]) -> Dict[str, Any]:
-        """Обработка конкретной команды"""
-        try:
-            if command == 'connect':
-                return await self.cmd_connect(data)
-            elif command == 'disconnect':
-                return await self.cmd_disconnect(data)
-            elif command == 'check_status':
-                return await self.cmd_check_status(data)
-            elif command == 'restart_xray':
-                return await self.cmd_restart_xray(data)
-            elif command == 'get_stats':
-                return await self.cmd_get_stats(data)
-            elif command == 'update_config':
-                return await self.cmd_update_config(data)
-            else:
-                return {'success': False, 'message': f'Неизвестная команда: {command}'}
+        return server, None
 
-        except Exception as e:
-            logger.error(f"Ошибка выполнения команды {command}: {e}")
-            return {'success': False, 'message': str(e)}
+    async def load_servers(self, chunk_size: int = 1000) -> int:
+        """
+        Загрузка всех серверов из базы данных в реестр
 
+        :param chunk_size: Количество строк, читаемых из базы за один раз
+        :return: Количество загруженных серверов
+        """
+        started = time.perf_counter()
+        loaded = 0
+        # Пока демон не работал, сердцебиения не приходили: даем проверке доступности
+        # время обновить их, прежде чем удалять серверы как неактивные
+        cleanup_floor = time.time() + self.heartbeat_timeout
+
+        async for rows in self.db.iterate(SQL_SELECT_ALL_SERVERS, chunk_size=chunk_size):
+            for row in rows:
+                server = ServerRecord.from_row(row)
+                self.servers.add(server)
+                self.schedule_deadlines(server, cleanup_floor)
+            loaded += len(rows)
+
+        logger.info(f"Загружено серверов из базы данных: {loaded} за {time.perf_counter() - started:.3f} с")
+        return loaded
+
+    @command('connect',
+             schema={'server_id': (int, str), 'server_name': str, 'server_ip': str, 'server_port': (int, str),
+                     'config_path': str, 'daemon_id': str, 'agent_url': str},
+             required=dict.fromkeys(('server_id', 'server_name', 'server_ip', 'server_port', 'config_path'),
+                                    'Недостаточно данных для подключения'))
     async def cmd_connect(self, data: Dict[str, Any]) -> Dict[str, Any]:
         """Команда подключения сервера"""
         server_id = data.get('server_id')
@@ -270,521 +4520,1122 @@ class XrayDaemon:
         server_ip = data.get('server_ip')
         server_port = data.get('server_port')
         config_path = data.get('config_path')
+        agent_url = data.get('agent_url') or None
+        if agent_url is not None and not agent_url.startswith(('http://', 'https://')):
+            return {'success': False, 'message': 'agent_url должен начинаться с http:// или https://'}
 
-        if not all([server_id, server_name, server_ip, server_port, config_path]):
-            return {'success': False, 'message': 'Недостаточно данных для подключения'}
-
-        # Генерируем уникальный ID для демона
-        daemon_id = f"daemon_{server_id}_{int(time.time())}"
+        # Генерируем уникальный ID для демона (при переносе между узлами кластера он сохраняется)
+        daemon_id = data.get('daemon_id') or f"daemon_{server_id}_{int(time.time())}"
 
         # Сохраняем информацию о сервере в базе данных
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        try:
+        def _save(conn: sqlite3.Connection):
             # Проверяем, не подключен ли уже сервер
-            cursor.execute("SELECT daemon_id FROM servers WHERE server_id = ?", (server_id,))
-            existing = cursor.fetchone()
+            existing = conn.execute(SQL_SELECT_DAEMON_ID, (server_id,)).fetchone()
 
             if existing:
                 # Обновляем существующую запись
-                cursor.execute("""
-                    UPDATE servers SET
-                        daemon_id = ?,
-                        name = ?,
-                        ip_address = ?,
-                        port = ?,
-                        config_path = ?,
-                        status = 'connected',
-                        last_heartbeat = CURRENT_TIMESTAMP
-                    WHERE server_id = ?
-                """, (daemon_id, server_name, server_ip, server_port, config_path, server_id))
+                conn.execute(SQL_UPDATE_SERVER, (daemon_id, server_name, server_ip, server_port, config_path,
+                                                 agent_url, server_id))
             else:
                 # Добавляем новую запись
-                cursor.execute("""
-                    INSERT INTO servers (
-                        server_id, daemon_id, name, ip_address, port, config_path, status, last_heartbeat
-                    ) VALUES (?, ?, ?, ?, ?, ?, 'connected', CURRENT_TIMESTAMP)
-                """, (server_id, daemon_id, server_name, server_ip, server_port, config_path))
+                conn.execute(SQL_INSERT_SERVER, (server_id, daemon_id, server_name, server_ip, server_port, config_path,
+                                                 agent_url))
 
-            conn.commit()
+            self.registry_sync.record(conn, (ServerRegistry._key(server_id),), 'server')
+
+        try:
+            await self.db.transaction(_save)
 
             # Сохраняем информацию в память
-            self.servers[server_id] = {
-                'daemon_id': daemon_id,
-                'name': server_name,
-                'ip_address': server_ip,
-                'port': server_port,
-                'config_path': config_path,
-                'status': 'connected',
-                'last_heartbeat': datetime.now()
-            }
+            server = ServerRecord(
+                server_id, daemon_id, server_name, server_ip, server_port, config_path,
+                status='connected', last_heartbeat=datetime.now(), agent_url=agent_url
+            )
+            self.servers.add(server)
+            self.schedule_deadlines(server)
 
             logger.info(f"Сервер {server_name} ({server_id}) подключен к демону")
 
             return {'success': True, 'daemon_id': daemon_id}
 
         except Exception as e:
-            conn.rollback()
             logger.error(f"Ошибка подключения сервера: {e}")
             return {'success': False, 'message': str(e)}
-        finally:
-            conn.close()
 
+    @command('disconnect', schema=SERVER_PARAMS, required={'server_id': 'Не указан ID сервера'})
     async def cmd_disconnect(self, data: Dict[str, Any]) -> Dict[str, Any]:
         """Команда отключения сервера"""
         server_id = data.get('server_id')
         daemon_id = data.get('daemon_id')
 
-        if not server_id:
-            return {'success': False, 'message': 'Не указан ID сервера'}
-
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
         try:
-            # Проверяем, существует ли сервер
-            cursor.execute("SELECT daemon_id FROM servers WHERE server_id = ?", (server_id,))
-            existing = cursor.fetchone()
-
-            if not existing:
-                return {'success': False, 'message': 'Сервер не найден'}
-
-            # Если указан daemon_id, проверяем его
-            if daemon_id and existing[0] != daemon_id:
-                return {'success': False, 'message': 'Неверный ID демона'}
-
-            # Удаляем сервер из базы данных
-            cursor.execute("DELETE FROM servers WHERE server_id = ?", (server_id,))
-            conn.commit()
+            server, error = self.find_server(server_id, daemon_id)
+            if error:
+                return {'success': False, 'message': error}
 
-            # Удаляем из памяти
-            if server_id in self.servers:
-                del self.servers[server_id]
+            await self.remove_servers([server])
 
             logger.info(f"Сервер {server_id} отключен от демона")
 
             return {'success': True}
 
         except Exception as e:
-            conn.rollback()
             logger.error(f"Ошибка отключения сервера: {e}")
             return {'success': False, 'message': str(e)}
-        finally:
-            conn.close()
 
+    @command('check_status', schema=SERVER_PARAMS, required={'server_id': 'Не указан ID сервера'})
     async def cmd_check_status(self, data: Dict[str, Any]) -> Dict[str, Any]:
         """Команда проверки статуса сервера"""
         server_id = data.get('server_id')
         daemon_id = data.get('daemon_id')
 
-        if not server_id:
-            return {'success': False, 'message': 'Не указан ID сервера'}
-
-        # Проверяем в памяти
-        if server_id in self.servers:
-            server = self.servers[server_id]
-
-            # Обновляем время последнего сердцебиения
-            server['last_heartbeat'] = datetime.now()
+        try:
+            server, error = self.find_server(server_id, daemon_id)
+            if error:
+                return {'success': False, 'message': error}
 
             # Проверяем доступность XRay
             xray_status = await self.check_xray_status(server)
 
-            # Обновляем статус
-            server['status'] = xray_status
+            # Обновляем статус и время сердцебиения в памяти, запись в базу данных выполнит буфер
+            self.apply_probe_result(server, xray_status == 'online')
 
             return {
                 'success': True,
                 'status': xray_status,
-                'last_heartbeat': server['last_heartbeat'].isoformat()
-            }
-
-        # Проверяем в базе данных
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        try:
-            cursor.execute("SELECT * FROM servers WHERE server_id = ?", (server_id,))
-            server_data = cursor.fetchone()
-
-            if not server_data:
-                return {'success': False, 'message': 'Сервер не найден'}
-
-            # Если указан daemon_id, проверяем его
-            if daemon_id and server_data[1] != daemon_id:
-                return {'success': False, 'message': 'Неверный ID демона'}
-
-            # Загружаем данные в память
-            server_info = {
-                'daemon_id': server_data[1],
-                'name': server_data[2],
-                'ip_address': server_data[3],
-                'port': server_data[4],
-                'config_path': server_data[5],
-                'status': server_data[6],
-                'last_heartbeat': datetime.fromisoformat(server_data[7]) if server_data[7] else None
+                'last_heartbeat': server.last_heartbeat.isoformat() if server.last_heartbeat else None
             }
 
-            # Проверяем доступность XRay
-            xray_status = await self.check_xray_status(server_info)
+        except Exception as e:
+            logger.error(f"Ошибка проверки статуса сервера: {e}")
+            return {'success': False, 'message': str(e)}
 
-            # Обновляем статус в базе данных
-            cursor.execute("""
-                UPDATE servers SET status = ?, last_heartbeat = CURRENT_TIMESTAMP
-                WHERE server_id = ?
-            """, (xray_status, server_id))
-            conn.commit()
+    async def submit_job(self, kind: str, server: ServerRecord, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Постановка операции над сервером в очередь
 
-            # Сохраняем в память
-            self.servers[server_id] = server_info
+        Возвращает ID операции сразу; с параметром wait ждет ее завершения.
+        """
+        job = await self.jobs.submit(kind, server.server_id, data)
 
-            return {
-                'success': True,
-                'status': xray_status,
-                'last_heartbeat': datetime.now().isoformat()
-            }
+        if not data.get('wait'):
+            return {'success': True, 'job_id': job.id, 'status': job.status}
 
-        except Exception as e:
-            conn.rollback()
-            logger.error(f"Ошибка проверки статуса сервера: {e}")
-            return {'success': False, 'message': str(e)}
-        finally:
-            conn.close()
+        await job.done
+        if job.status != 'success':
+            return {'success': False, 'job_id': job.id, 'status': job.status, 'message': job.error}
+        return {'success': True, 'job_id': job.id, 'status': job.status, 'result': job.result}
 
+    @command('restart_xray', schema={**SERVER_PARAMS, 'wait': bool}, required={'server_id': 'Не указан ID сервера'},
+             primary=True)
     async def cmd_restart_xray(self, data: Dict[str, Any]) -> Dict[str, Any]:
-        """Команда перезапуска XRay на сервере"""
+        """Команда перезапуска XRay на сервере (выполняется в очереди операций)"""
         server_id = data.get('server_id')
         daemon_id = data.get('daemon_id')
 
-        if not server_id:
-            return {'success': False, 'message': 'Не указан ID сервера'}
-
-        # Проверяем в памяти
-        if server_id in self.servers:
-            server = self.servers[server_id]
+        try:
+            server, error = self.find_server(server_id, daemon_id)
+            if error:
+                return {'success': False, 'message': error}
 
-            # Проверяем ID демона
-            if daemon_id and server['daemon_id'] != daemon_id:
-                return {'success': False, 'message': 'Неверный ID демона'}
+            return await self.submit_job('restart_xray', server, data)
 
-            try:
-                # Перезапускаем XRay
-                await self.restart_xray_process(server)
+        except Exception as e:
+            logger.error(f"Ошибка перезапуска XRay: {e}")
+            return {'success': False, 'message': str(e)}
 
-                # Обновляем статус
-                server['status'] = 'restarting'
+    async def job_restart_xray(self, job: Job):
+        """Выполнение операции перезапуска XRay"""
+        server, error = self.find_server(job.server_id)
+        if error:
+            raise PermanentJobError(error)
 
-                logger.info(f"XRay на сервере {server['name']} перезапущен")
+        # Перезапускаем XRay
+        await self.restart_xray_process(server)
 
-                return {'success': True}
+        # Обновляем статус
+        self.set_server_status(server, 'restarting', datetime.now())
 
-            except Exception as e:
-                logger.error(f"Ошибка перезапуска XRay: {e}")
-                return {'success': False, 'message': str(e)}
+        logger.info(f"XRay на сервере {server.name} перезапущен")
+        return {'restarted': True}
 
-        # Проверяем в базе данных
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    @command('get_stats', schema={**SERVER_PARAMS, 'since': str}, required={'server_id': 'Не указан ID сервера'})
+    async def cmd_get_stats(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Команда получения статистики с сервера"""
+        server_id = data.get('server_id')
+        daemon_id = data.get('daemon_id')
 
         try:
-            cursor.execute("SELECT * FROM servers WHERE server_id = ?", (server_id,))
-            server_data = cursor.fetchone()
-
-            if not server_data:
-                return {'success': False, 'message': 'Сервер не найден'}
-
-            # Если указан daemon_id, проверяем его
-            if daemon_id and server_data[1] != daemon_id:
-                return {'success': False, 'message': 'Неверный ID демона'}
-
-            # Загружаем данные
-            server_info = {
-                'daemon_id': server_data[1],
-                'name': server_data[2],
-                'ip_address': server_data[3],
-                'port': server_data[4],
-                'config_path': server_data[5],
-                'status': server_data[6]
-            }
+            server, error = self.find_server(server_id, daemon_id)
+            if error:
+                return {'success': False, 'message': error}
 
-            # Перезапускаем XRay
-            await self.restart_xray_process(server_info)
-
-            # Обновляем статус в базе данных
-            cursor.execute("""
-                UPDATE servers SET status = 'restarting', last_heartbeat = CURRENT_TIMESTAMP
-                WHERE server_id = ?
-            """, (server_id,))
-            conn.commit()
+            # Получаем статистику
+            stats = await self.get_xray_stats(server)
 
-            # Сохраняем в память
-            self.servers[server_id] = server_info
+            tracker = self.user_trackers.get(server.server_id)
+            if tracker is None:
+                tracker = self.user_trackers[server.server_id] = UserDeltaTracker()
+            tracker.update(stats['users'])
 
-            logger.info(f"XRay на сервере {server_info['name']} перезапущен")
+            # Инкрементальный режим: только пользователи, изменившиеся после курсора клиента
+            since = tracker.parse_cursor(data.get('since'))
+            if since is None:
+                mode = 'full'
+            else:
+                mode = 'delta'
+                stats['users'], stats['removed_users'] = tracker.changes_since(since)
 
-            return {'success': True}
+            return {
+                'success': True,
+                'stats': stats,
+                'mode': mode,
+                'cursor': tracker.cursor
+            }
 
         except Exception as e:
-            conn.rollback()
-            logger.error(f"Ошибка перезапуска XRay: {e}")
+            logger.error(f"Ошибка получения статистики: {e}")
             return {'success': False, 'message': str(e)}
-        finally:
-            conn.close()
 
-    async def cmd_get_stats(self, data: Dict[str, Any]) -> Dict[str, Any]:
-        """Команда получения статистики с сервера"""
+    @command('update_config',
+             schema={**SERVER_PARAMS, 'config': dict, 'patch': list, 'base_hash': str, 'wait': bool, 'hot_reload': bool},
+             required={'server_id': 'Недостаточно данных'}, primary=True)
+    async def cmd_update_config(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Команда обновления конфигурации XRay (выполняется в очереди операций)
+
+        Принимает полную конфигурацию (config) или JSON Patch (patch) относительно
+        известной версии (base_hash).
+        """
         server_id = data.get('server_id')
         daemon_id = data.get('daemon_id')
+        config_data = data.get('config')
+        patch = data.get('patch')
 
-        if not server_id:
-            return {'success': False, 'message': 'Не указан ID сервера'}
-
-        # Проверяем в памяти
-        if server_id in self.servers:
-            server = self.servers[server_id]
+        if config_data is not None and patch is not None:
+            raise InvalidParams('Укажите либо config, либо patch, но не оба')
+        if not (config_data or (patch is not None and data.get('base_hash'))):
+            raise InvalidParams('Недостаточно данных')
+        if patch is not None:
+            try:
+                validate_json_patch(patch)
+            except ValueError as e:
+                raise InvalidParams(str(e))
 
-            # Проверяем ID демона
-            if daemon_id and server['daemon_id'] != daemon_id:
-                return {'success': False, 'message': 'Неверный ID демона'}
+        try:
+            server, error = self.find_server(server_id, daemon_id)
+            if error:
+                return {'success': False, 'message': error}
 
-            try:
-                # Получаем статистику
-                stats = await self.get_xray_stats(server)
+            return await self.submit_job('update_config', server, data)
 
-                return {
-                    'success': True,
-                    'stats': stats
-                }
+        except Exception as e:
+            logger.error(f"Ошибка обновления конфигурации: {e}")
+            return {'success': False, 'message': str(e)}
 
-            except Exception as e:
-                logger.error(f"Ошибка получения статистики: {e}")
-                return {'success': False, 'message': str(e)}
+    async def job_update_config(self, job: Job):
+        """
+        Выполнение операции обновления конфигурации XRay
 
-        # Проверяем в базе данных
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        Если итоговая конфигурация совпадает с текущей, запись и перезапуск
+        не выполняются. Изменения только в списках клиентов применяются через
+        API узла без перезапуска XRay.
+        """
+        server, error = self.find_server(job.server_id)
+        if error:
+            raise PermanentJobError(error)
+
+        current = await self.configs.current(server.server_id)
+        current_hash = current[1] if current else None
+
+        # Собираем итоговую конфигурацию из патча относительно базовой версии
+        if job.data.get('patch') is not None:
+            base_hash = job.data.get('base_hash')
+            if base_hash != current_hash:
+                raise PermanentJobError(f"Базовая версия {base_hash} не совпадает с текущей {current_hash}")
+            try:
+                config_data = apply_json_patch(await self.configs.get(base_hash), job.data['patch'])
+            except ValueError as e:
+                raise PermanentJobError(str(e))
+        else:
+            config_data = job.data['config']
+
+        body = canonical_json(config_data)
+        digest = config_hash(body)
+        if digest == current_hash:
+            logger.info(f"Конфигурация XRay на сервере {server.name} не изменилась")
+            return {'changed': False, 'hash': digest, 'version': current[0]}
+
+        # Если изменились только списки клиентов, применяем их без перезапуска
+        changes = None
+        if current_hash and job.data.get('hot_reload', True):
+            changes = classify_config_change(await self.configs.get(current_hash), config_data)
+
+        # Передаем конфигурацию на узел. Версия сохраняется только после применения:
+        # если перезапуск не удался, повтор той же конфигурации не должен считаться
+        # "без изменений"
+        await self.update_xray_config(server, config_data)
+
+        if changes is not None and await self.apply_user_changes(server, changes):
+            version = await self.configs.put(server.server_id, config_data, body, digest)
+            self.reload_stats['restarts_avoided'] += 1
+            logger.info(f"Пользователи XRay на сервере {server.name} обновлены без перезапуска (версия {version})")
+            return {'changed': True, 'hash': digest, 'version': version, 'restarted': False}
+
+        # Перезапускаем XRay для применения новой конфигурации
+        await self.restart_xray_process(server)
+        self.reload_stats['restarts'] += 1
+        version = await self.configs.put(server.server_id, config_data, body, digest)
+
+        logger.info(f"Конфигурация XRay на сервере {server.name} обновлена до версии {version}")
+        return {'changed': True, 'hash': digest, 'version': version, 'restarted': True}
+
+    async def apply_user_changes(self, server: ServerRecord, changes: Dict[str, Dict[str, list]]) -> bool:
+        """
+        Добавление и удаление пользователей через агент узла без перезапуска XRay
 
+        При ошибке возвращает False: конфигурация уже записана, и ее применит перезапуск.
+        """
         try:
-            cursor.execute("SELECT * FROM servers WHERE server_id = ?", (server_id,))
-            server_data = cursor.fetchone()
+            for tag, change in changes.items():
+                if change['remove']:
+                    await self.agent_request(server, 'POST', NODE_REMOVE_USERS_PATH,
+                                             {'tag': tag, 'emails': change['remove']})
+                if change['add']:
+                    await self.agent_request(server, 'POST', NODE_ADD_USERS_PATH,
+                                             {'tag': tag, 'users': change['add']})
+            return True
 
-            if not server_data:
-                return {'success': False, 'message': 'Сервер не найден'}
+        except Exception as e:
+            self.reload_stats['hot_reload_failures'] += 1
+            logger.warning(f"Не удалось применить пользователей на сервере {server.name} без перезапуска: {e}")
+            return False
 
-            # Если указан daemon_id, проверяем его
-            if daemon_id and server_data[1] != daemon_id:
-                return {'success': False, 'message': 'Неверный ID демона'}
+    @command('get_config', schema={**SERVER_PARAMS, 'include_config': bool},
+             required={'server_id': 'Не указан ID сервера'})
+    async def cmd_get_config(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Команда получения текущей версии конфигурации сервера"""
+        server_id = data.get('server_id')
+        daemon_id = data.get('daemon_id')
 
-            # Загружаем данные
-            server_info = {
-                'daemon_id': server_data[1],
-                'name': server_data[2],
-                'ip_address': server_data[3],
-                'port': server_data[4],
-                'config_path': server_data[5],
-                'status': server_data[6]
-            }
+        try:
+            server, error = self.find_server(server_id, daemon_id)
+            if error:
+                return {'success': False, 'message': error}
 
-            # Получаем статистику
-            stats = await self.get_xray_stats(server_info)
+            current = await self.configs.current(server.server_id)
+            if current is None:
+                return {'success': True, 'version': None, 'hash': None}
 
-            return {
-                'success': True,
-                'stats': stats
-            }
+            version, digest = current
+            result = {'success': True, 'version': version, 'hash': digest}
+            if data.get('include_config'):
+                result['config'] = await self.configs.get(digest)
+            return result
 
         except Exception as e:
-            logger.error(f"Ошибка получения статистики: {e}")
+            logger.error(f"Ошибка получения конфигурации: {e}")
             return {'success': False, 'message': str(e)}
-        finally:
-            conn.close()
 
-    async def cmd_update_config(self, data: Dict[str, Any]) -> Dict[str, Any]:
-        """Команда обновления конфигурации XRay"""
-        server_id = data.get('server_id')
-        daemon_id = data.get('daemon_id')
+    @command('rollout_config',
+             schema={'config': dict, 'server_ids': (list, str), 'waves': list, 'max_failure_rate': (int, float),
+                     'health_delay': (int, float)},
+             required={'config': 'Не указана конфигурация'}, primary=True)
+    async def cmd_rollout_config(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Команда поэтапного применения конфигурации к набору серверов"""
         config_data = data.get('config')
+        targets = data.get('server_ids', '*')
+
+        try:
+            if targets == '*':
+                server_ids = [server.server_id for server in self.servers]
+            else:
+                server_ids = list(dict.fromkeys(map(ServerRegistry._key, targets)))
+                missing = [server_id for server_id in server_ids if server_id not in self.servers]
+                if missing:
+                    return {'success': False, 'message': f"Серверы не найдены: {missing[:20]}"}
+
+            if not server_ids:
+                return {'success': False, 'message': 'Нет серверов для раскатки'}
+
+            rollout = Rollout(
+                uuid.uuid4().hex[:12], server_ids, config_data,
+                waves=data.get('waves', Rollout.DEFAULT_WAVES),
+                max_failure_rate=float(data.get('max_failure_rate', 0.1)),
+                health_delay=float(data.get('health_delay', 5.0))
+            )
 
-        if not server_id or not config_data:
-            return {'success': False, 'message': 'Недостаточно данных'}
+            # Забываем самые старые завершенные раскатки
+            for rollout_id in [key for key, item in self.rollouts.items() if item.finished is not None]:
+                if len(self.rollouts) < self.max_rollouts:
+                    break
+                del self.rollouts[rollout_id]
 
-        # Проверяем в памяти
-        if server_id in self.servers:
-            server = self.servers[server_id]
+            self.rollouts[rollout.id] = rollout
+            rollout.task = asyncio.create_task(rollout.run(
+                functools.partial(self.apply_rollout_wave, rollout),
+                self.check_rollout_wave
+            ))
 
-            # Проверяем ID демона
-            if daemon_id and server['daemon_id'] != daemon_id:
-                return {'success': False, 'message': 'Неверный ID демона'}
+            logger.info(f"Раскатка {rollout.id} запущена: {len(server_ids)} серверов, волны {rollout.to_dict()['waves']}")
+            return {'success': True, **rollout.to_dict()}
+
+        except Exception as e:
+            logger.error(f"Ошибка запуска раскатки: {e}")
+            return {'success': False, 'message': str(e)}
 
+    async def apply_rollout_wave(self, rollout: Rollout, server_ids: List[int]) -> Dict[int, Optional[str]]:
+        """Применение конфигурации к серверам волны через очередь операций"""
+        errors = {}
+        jobs = []
+        for server_id in server_ids:
+            if server_id not in self.servers:
+                errors[server_id] = 'Сервер не найден'
+                continue
+            jobs.append(await self.jobs.submit('update_config', server_id, {'config': rollout.config, 'rollout_id': rollout.id}))
+
+        for job in jobs:
+            await job.done
+            errors[job.server_id] = job.error if job.status != 'success' else None
+
+        return errors
+
+    async def check_rollout_wave(self, server_ids: List[int]) -> Dict[int, bool]:
+        """Проверка доступности серверов волны"""
+        servers = [self.servers.get(server_id) for server_id in server_ids]
+        servers = [server for server in servers if server is not None]
+
+        health = await self.prober.sweep(servers)
+        for server in servers:
+            self.apply_probe_result(server, health[server.server_id])
+        return health
+
+    @command('rollout_status', schema={'rollout_id': str, 'cancel': bool}, primary=True)
+    async def cmd_rollout_status(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Команда получения хода раскатки (без ID - список последних раскаток)"""
+        rollout_id = data.get('rollout_id')
+
+        if not rollout_id:
+            return {'success': True, 'rollouts': [rollout.to_dict() for rollout in reversed(self.rollouts.values())]}
+
+        rollout = self.rollouts.get(rollout_id)
+        if rollout is None:
+            return {'success': False, 'message': 'Раскатка не найдена'}
+
+        if data.get('cancel') and rollout.task and not rollout.task.done():
+            rollout.task.cancel()
             try:
-                # Обновляем конфигурацию
-                await self.update_xray_config(server, config_data)
+                await rollout.task
+            except asyncio.CancelledError:
+                pass
 
-                # Перезапускаем XRay для применения новой конфигурации
-                await self.restart_xray_process(server)
+        return {'success': True, **rollout.to_dict()}
 
-                logger.info(f"Конфигурация XRay на сервере {server['name']} обновлена")
+    @command('dead_jobs', primary=True)
+    async def cmd_dead_jobs(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Команда получения операций, исчерпавших попытки (последние сначала)"""
+        return {'success': True, 'jobs': [job.to_dict() for job in reversed(self.jobs.dead_letter)]}
 
-                return {'success': True}
+    @command('job_status', schema={'job_id': (int, str)}, required={'job_id': 'Не указан ID операции'},
+             primary=True)
+    async def cmd_job_status(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Команда получения состояния фоновой операции"""
+        job_id = data.get('job_id')
 
-            except Exception as e:
-                logger.error(f"Ошибка обновления конфигурации: {e}")
-                return {'success': False, 'message': str(e)}
+        try:
+            job = await self.jobs.get(int(job_id))
+            if job is None:
+                return {'success': False, 'message': 'Операция не найдена'}
+            return {'success': True, 'job': job}
 
-        # Проверяем в базе данных
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        except Exception as e:
+            logger.error(f"Ошибка получения состояния операции: {e}")
+            return {'success': False, 'message': str(e)}
+
+    @command('get_stats_history', schema={**SERVER_PARAMS, 'from': (int, float, str), 'to': (int, float, str),
+                                          'resolution': str},
+             required={'server_id': 'Не указан ID сервера'},
+             checks={'from': (is_timestamp, 'Параметр from должен быть unix-временем'),
+                     'to': (is_timestamp, 'Параметр to должен быть unix-временем')})
+    async def cmd_get_stats_history(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Команда получения истории статистики сервера за период"""
+        server_id = data.get('server_id')
+        daemon_id = data.get('daemon_id')
 
         try:
-            cursor.execute("SELECT * FROM servers WHERE server_id = ?", (server_id,))
-            server_data = cursor.fetchone()
+            server, error = self.find_server(server_id, daemon_id)
+            if error:
+                return {'success': False, 'message': error}
 
-            if not server_data:
-                return {'success': False, 'message': 'Сервер не найден'}
+            end = parse_timestamp(data.get('to') or time.time() + 1)
+            start = parse_timestamp(data.get('from') or end - 3600)
+            history = await self.collector.query(server.server_id, start, end, data.get('resolution', 'auto'))
 
-            # Если указан daemon_id, проверяем его
-            if daemon_id and server_data[1] != daemon_id:
-                return {'success': False, 'message': 'Неверный ID демона'}
+            return {'success': True, 'from': start, 'to': end, **history}
 
-            # Загружаем данные
-            server_info = {
-                'daemon_id': server_data[1],
-                'name': server_data[2],
-                'ip_address': server_data[3],
-                'port': server_data[4],
-                'config_path': server_data[5],
-                'status': server_data[6]
-            }
+        except Exception as e:
+            logger.error(f"Ошибка получения истории статистики: {e}")
+            return {'success': False, 'message': str(e)}
 
-            # Обновляем конфигурацию
-            await self.update_xray_config(server_info, config_data)
+    @command('aggregate_stats', schema={'top': int, 'percentiles': list, 'refresh': bool, 'server_ids': list},
+             checks={'top': (lambda value: value > 0, 'Параметр top должен быть больше нуля'),
+                     'percentiles': (valid_percentiles, 'Перцентили должны быть числами от 0 до 100')})
+    async def cmd_aggregate_stats(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Команда агрегации статистики по всему парку серверов"""
+        try:
+            top_n = int(data.get('top', 10))
+            points = [float(point) for point in data.get('percentiles', (50, 90, 95, 99))]
 
-            # Перезапускаем XRay
-            await self.restart_xray_process(server_info)
+            # По запросу опрашиваем узлы, иначе используем последние собранные данные
+            if data.get('refresh'):
+                await self.collector.collect_once(write=self.worker_id == 0)
+            elif self.worker_id != 0 and time.monotonic() - self.collector.last_collect > self.collector.interval:
+                # Сбор статистики идет в процессе 0, остальные опрашивают узлы сами, не записывая точки
+                await self.collector.collect_once(write=False)
 
-            logger.info(f"Конфигурация XRay на сервере {server_info['name']} обновлена")
+            latest = self.collector.latest
+            server_ids = data.get('server_ids')
+            if server_ids:
+                latest = {sid: latest[sid] for sid in map(ServerRegistry._key, server_ids) if sid in latest}
 
-            return {'success': True}
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(None, aggregate_stats, dict(latest), top_n, points)
+
+            return {'success': True, **result}
 
         except Exception as e:
-            logger.error(f"Ошибка обновления конфигурации: {e}")
+            logger.error(f"Ошибка агрегации статистики: {e}")
             return {'success': False, 'message': str(e)}
-        finally:
-            conn.close()
 
-    async def check_xray_status(self, server: Dict[str, Any]) -> str:
+    @command('loop_stats', schema={'limit': int})
+    async def cmd_loop_stats(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Команда получения отчетов о блокировках цикла событий"""
+        limit = data.get('limit', 20)
+        reports = list(self.loop_monitor.reports)[-limit:] if limit > 0 else []
+        return {'success': True, **self.loop_monitor.stats(), 'reports': reports[::-1]}
+
+    @command('daemon_stats')
+    async def cmd_daemon_stats(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Команда получения внутренней статистики демона"""
+        return {
+            'success': True,
+            'stats': {
+                'servers': len(self.servers),
+                'database': {'queries': self.db.queries},
+                'heartbeats': self.heartbeats.stats(),
+                'deadlines': {
+                    'offline': self.offline_deadlines.stats(),
+                    'cleanup': self.cleanup_deadlines.stats(),
+                    'removed_inactive': self.removed_inactive
+                },
+                'prober': self.prober.stats(),
+                'http_client': self.node_client.stats(),
+                'collector': self.collector.stats(),
+                'events': self.events.stats(),
+                'jobs': self.jobs.stats(),
+                'config_reloads': dict(self.reload_stats),
+                'auth': self.auth.stats(),
+                'loop': self.loop_monitor.stats(),
+                'registry_sync': self.registry_sync.stats(),
+                'worker': {'id': self.worker_id, 'workers': self.workers, 'forwarded': self.primary_forwarded},
+                'server_list': self.server_list.stats(),
+                'cluster': dict(self.cluster.stats(), **self.rebalance_stats) if self.cluster is not None else None
+            }
+        }
+
+    async def check_xray_status(self, server: ServerRecord) -> str:
         """Проверка статуса XRay на сервере"""
         try:
-            # Здесь можно реализовать проверку статуса XRay
-            # Например, через HTTP API или проверку порта
-
-            # Для примера просто возвращаем 'online'
-            return 'online'
+            if await self.prober.probe(server):
+                return 'online'
+            return 'offline'
 
         except Exception as e:
             logger.error(f"Ошибка проверки статуса XRay: {e}")
             return 'offline'
 
-    async def restart_xray_process(self, server: Dict[str, Any]) -> bool:
-        """Перезапуск процесса XRay"""
+    def apply_probe_result(self, server: ServerRecord, ok: bool):
+        """Применение результата фоновой проверки к записи о сервере"""
+        if ok:
+            self.set_server_status(server, 'online', datetime.now())
+        else:
+            self.set_server_status(server, 'offline')
+
+    def set_server_status(self, server: ServerRecord, status: str, heartbeat: Optional[datetime] = None):
+        """
+        Изменение статуса сервера в памяти
+
+        Запись в базу данных выполнит буфер сердцебиений, подписчики получат
+        событие, если статус изменился.
+        """
+        previous = server.status
+        if heartbeat is not None:
+            server.last_heartbeat = heartbeat
+            self.schedule_deadlines(server)
+        server.status = status
+        if heartbeat is not None or previous != status:
+            self.servers.touch(server)
+        self.heartbeats.record(server.server_id, status, server.last_heartbeat)
+
+        if previous != status:
+            logger.info(f"Сервер {server.name} ({server.server_id}): {previous} -> {status}")
+            self.events.publish(server.server_id, self.status_event(server, previous))
+
+    @staticmethod
+    def status_event(server: ServerRecord, previous: Optional[str] = None) -> Dict[str, Any]:
+        """Событие о статусе сервера для подписчиков"""
+        return {
+            'type': 'status',
+            'server_id': server.server_id,
+            'status': server.status,
+            'previous': previous,
+            'last_heartbeat': server.last_heartbeat.isoformat() if server.last_heartbeat else None
+        }
+
+    def publish_stats_point(self, point: tuple):
+        """Отправка подписчикам новой точки статистики"""
+        server_id, timestamp, connections, up, down = point
+        self.events.publish(server_id, {
+            'type': 'stats',
+            'timestamp': timestamp,
+            'connections': connections,
+            'traffic_up': up,
+            'traffic_down': down
+        })
+
+    def agent_url(self, server: ServerRecord, path: str) -> Optional[str]:
+        """URL агента узла или None, если агент для сервера не настроен"""
+        if server.agent_url:
+            return server.agent_url.rstrip('/') + path
+        if self.agent_port:
+            return f"http://{server.ip_address}:{self.agent_port}{path}"
+        return None
+
+    async def agent_request(self, server: ServerRecord, method: str, path: str, json_data: Any = None) -> Any:
+        """Запрос к агенту узла, без настроенного агента - AgentNotConfigured"""
+        url = self.agent_url(server, path)
+        if url is None:
+            raise AgentNotConfigured(f"Агент узла для сервера {server.name} не настроен")
+        headers = {'X-Auth-Key': self.agent_key} if self.agent_key else None
+        return await self.node_client.request(method, url, json_data, headers=headers)
+
+    async def restart_xray_process(self, server: ServerRecord) -> bool:
+        """Перезапуск процесса XRay через агент узла"""
         try:
-            # Здесь можно реализовать перезапуск XRay
-            # Например, через системные команды или API
+            logger.info(f"Перезапуск XRay на сервере {server.name}")
 
-            # Для примера просто логируем
-            logger.info(f"Перезапуск XRay на сервере {server['name']}")
+            await self.agent_request(server, 'POST', NODE_RESTART_PATH)
 
             return True
 
         except Exception as e:
             logger.error(f"Ошибка перезапуска XRay: {e}")
-            return False
+            raise
+
+    async def get_xray_stats(self, server: ServerRecord) -> Dict[str, Any]:
+        """
+        Получение статистики XRay через агент узла (в числовом виде, см. normalize_stats)
 
-    async def get_xray_stats(self, server: Dict[str, Any]) -> Dict[str, Any]:
-        """Получение статистики XRay"""
+        Без агента возвращается тестовая статистика.
+        """
         try:
-            # Здесь можно реализовать получение статистики
-            # Например, через HTTP API XRay
+            if self.agent_url(server, NODE_STATS_PATH) is None:
+                return normalize_stats(STUB_XRAY_STATS)
 
-            # Для примера возвращаем тестовые данные
-            return {
-                'uptime': '1h 30m',
-                'inbound_connections': 42,
-                'outbound_connections': 38,
-                'total_up': '1.2 GB',
-                'total_down': '3.4 GB',
-                'users': [
-                    {'id': 1, 'email': 'user1@example.com', 'up': '500 MB', 'down': '1.2 GB'},
-                    {'id': 2, 'email': 'user2@example.com', 'up': '700 MB', 'down': '2.2 GB'}
-                ]
-            }
+            stats = await self.agent_request(server, 'GET', NODE_STATS_PATH)
+            return normalize_stats(stats or {})
 
         except Exception as e:
             logger.error(f"Ошибка получения статистики: {e}")
-            return {}
+            raise
 
-    async def update_xray_config(self, server: Dict[str, Any], config: Dict[str, Any]) -> bool:
-        """Обновление конфигурации XRay"""
+    async def collect_xray_stats(self, server: ServerRecord) -> Optional[Dict[str, Any]]:
+        """Статистика для фонового сбора: серверы без агента пропускаются, чтобы не писать тестовые точки"""
+        if self.agent_url(server, NODE_STATS_PATH) is None:
+            return None
+        return await self.get_xray_stats(server)
+
+    async def update_xray_config(self, server: ServerRecord, config: Dict[str, Any]) -> bool:
+        """
+        Передача конфигурации XRay агенту узла для записи в config_path сервера
+
+        config_path - путь на узле: XRay работает там, а не рядом с демоном.
+        """
         try:
-            # Здесь можно реализовать обновление конфигурации
-            # Например, через запись в файл конфигурации
+            logger.info(f"Обновление конфигурации XRay на сервере {server.name}")
 
-            # Для примера просто логируем
-            logger.info(f"Обновление конфигурации XRay на сервере {server['name']}")
+            await self.agent_request(server, 'POST', NODE_CONFIG_PATH, {'path': server.config_path, 'config': config})
 
             return True
 
         except Exception as e:
             logger.error(f"Ошибка обновления конфигурации: {e}")
-            return False
+            raise
+
+    async def start_cluster(self):
+        """Подключение к кластеру: опрос узлов и фоновые задачи членства и перебалансировки"""
+        await self.cluster.client.start()
+        await self.cluster.ping_all()
+        logger.info(f"Узел кластера {self.cluster.node_id}, участники: {sorted(self.cluster.ring.nodes)}")
+
+        self.monitoring_tasks.append(asyncio.create_task(self.cluster.run(self.on_cluster_change)))
+        if self.worker_id == 0:
+            self._rebalance_wakeup = asyncio.Event()
+            self.monitoring_tasks.append(asyncio.create_task(self.rebalance_loop()))
+            # Пока узел не работал, состав кластера мог измениться
+            self._rebalance_wakeup.set()
+
+    async def stop_cluster(self):
+        """Уход из кластера: при cluster_handoff_on_stop серверы передаются новым владельцам"""
+        try:
+            if self.cluster_handoff_on_stop and self.worker_id == 0:
+                self.cluster.mark_leaving()
+                await self.rebalance_servers()
+            await self.cluster.leave()
+        except Exception as e:
+            logger.error(f"Ошибка выхода из кластера: {e}")
+        finally:
+            await self.cluster.client.close()
+
+    def on_cluster_change(self):
+        """Изменение состава кластера: запуск перебалансировки"""
+        if self._rebalance_wakeup is not None:
+            self._rebalance_wakeup.set()
+
+    async def rebalance_loop(self):
+        """Перебалансировка после изменения состава кластера (с повтором при ошибках)"""
+        while True:
+            await self._rebalance_wakeup.wait()
+            self._rebalance_wakeup.clear()
+            try:
+                failed = await self.rebalance_servers()
+            except Exception as e:
+                logger.error(f"Ошибка перебалансировки кластера: {e}")
+                failed = True
+            if failed:
+                await asyncio.sleep(self.cluster.interval * self.cluster.max_failures)
+                self._rebalance_wakeup.set()
+
+    async def rebalance_servers(self) -> int:
+        """
+        Передача серверов, владельцем которых стал другой узел
+
+        Сервер регистрируется у нового владельца командой connect (с прежним
+        daemon_id) и только после этого удаляется здесь. История статистики и
+        версий конфигурации остается на прежнем узле.
+
+        :return: Количество серверов, которые передать не удалось
+        """
+        moves = {}  # {node_id: [ServerRecord]}
+        for index, server in enumerate(list(self.servers)):
+            owner = self.remote_owner({'server_id': server.server_id})
+            if owner is not None:
+                moves.setdefault(owner, []).append(server)
+            if index % 10000 == 9999:
+                # Не держим цикл событий на больших реестрах
+                await asyncio.sleep(0)
+        if not moves:
+            return 0
+
+        started = time.perf_counter()
+        moved = failed = 0
+        for node_id, servers in moves.items():
+            for start in range(0, len(servers), self.batch_max_items):
+                chunk = servers[start:start + self.batch_max_items]
+                commands = [{'command': 'connect', 'data': {
+                    'server_id': server.server_id,
+                    'daemon_id': server.daemon_id,
+                    'server_name': server.name,
+                    'server_ip': server.ip_address,
+                    'server_port': server.port,
+                    'config_path': server.config_path,
+                    'agent_url': server.agent_url
+                }} for server in chunk]
+                try:
+                    response = await self.cluster.request(node_id, '/api/batch', {'commands': commands})
+                    accepted = [server for server, result in zip(chunk, response['results']) if result.get('success')]
+                except Exception as e:
+                    logger.warning(f"Не удалось передать серверы узлу {node_id}: {e}")
+                    accepted = []
+
+                if accepted:
+                    await self.remove_servers(accepted)
+                moved += len(accepted)
+                failed += len(chunk) - len(accepted)
+
+        self.rebalance_stats['rebalances'] += 1
+        self.rebalance_stats['moved'] += moved
+        self.rebalance_stats['failed'] += failed
+        logger.info(f"Перебалансировка кластера: передано серверов {moved}, ошибок {failed} "
+                    f"за {time.perf_counter() - started:.3f} с")
+        return failed
+
+    def schedule_deadlines(self, server: ServerRecord, cleanup_floor: float = 0.0):
+        """
+        Перенос сроков сервера от его последнего сердцебиения
+
+        :param server: Запись о сервере
+        :param cleanup_floor: Самый ранний допустимый срок удаления (время time.time())
+        """
+        if server.last_heartbeat is None:
+            return
+
+        seen = server.last_heartbeat.timestamp()
+        self.offline_deadlines.schedule(server.server_id, seen + self.heartbeat_timeout)
+        if self.inactive_server_ttl:
+            self.cleanup_deadlines.schedule(server.server_id, max(seen + self.inactive_server_ttl, cleanup_floor))
+
+    async def remove_servers(self, servers: List[ServerRecord]):
+        """Удаление серверов из базы данных (одной транзакцией) и из памяти"""
+        server_ids = [server.server_id for server in servers]
+
+        def _remove(conn: sqlite3.Connection):
+            conn.executemany(SQL_DELETE_SERVER, [(server_id,) for server_id in server_ids])
+            self.registry_sync.record(conn, server_ids, 'delete')
+
+        await self.db.transaction(_remove)
+
+        for server_id in server_ids:
+            self.forget_server(server_id)
+
+    def forget_server(self, server_id: int):
+        """Удаление сервера и связанного с ним состояния из памяти"""
+        self.servers.remove(server_id)
+        self.heartbeats.discard(server_id)
+        self.user_trackers.pop(server_id, None)
+        self.configs.forget(server_id)
+        self.offline_deadlines.cancel(server_id)
+        self.cleanup_deadlines.cancel(server_id)
+
+    def merge_server(self, record: ServerRecord):
+        """
+        Применение записи о сервере, прочитанной из базы, к реестру
+
+        Существующая запись обновляется на месте. Статус не трогаем, если у
+        этого процесса есть более свежие, еще не записанные изменения.
+        """
+        server = self.servers.get(record.server_id)
+        if server is None or server.daemon_id != record.daemon_id:
+            self.servers.add(record)
+            self.schedule_deadlines(record)
+            return
+
+        server.name = record.name
+        server.ip_address = record.ip_address
+        server.port = record.port
+        server.config_path = record.config_path
+        server.agent_url = record.agent_url
+        self.servers.touch(server)
+        if self.heartbeats.has_pending(server.server_id):
+            return
+
+        previous = server.status
+        server.status = record.status
+        if record.last_heartbeat != server.last_heartbeat:
+            server.last_heartbeat = record.last_heartbeat
+            self.schedule_deadlines(server)
+        if previous != server.status:
+            self.events.publish(server.server_id, self.status_event(server, previous))
+
+    async def apply_registry_changes(self, changes: Optional[List[tuple]]):
+        """
+        Применение изменений реестра, сделанных другими рабочими процессами
+
+        :param changes: Список (server_id, вид изменения) или None - перечитать реестр целиком
+        """
+        if changes is None:
+            logger.warning("Журнал изменений реестра отстал, реестр перечитывается целиком")
+            seen = set()
+            async for rows in self.db.iterate(SQL_SELECT_ALL_SERVERS):
+                for row in rows:
+                    record = ServerRecord.from_row(row)
+                    self.merge_server(record)
+                    seen.add(record.server_id)
+            for server_id in [server_id for server_id, _ in self.servers.items() if server_id not in seen]:
+                self.forget_server(server_id)
+            return
+
+        reload_ids = set()
+        for server_id, kind in changes:
+            if kind == 'config':
+                self.configs.forget(server_id)
+            elif kind == 'delete':
+                reload_ids.discard(server_id)
+                self.forget_server(server_id)
+            else:
+                reload_ids.add(server_id)
+
+        # Перечитываем измененные серверы пачками; отсутствующие в базе уже удалены
+        reload_ids = sorted(reload_ids)
+        for start in range(0, len(reload_ids), 500):
+            chunk = reload_ids[start:start + 500]
+            rows = await self.db.fetchall(SQL_SELECT_SERVERS_IN.format(','.join('?' * len(chunk))), chunk)
+            found = set()
+            for row in rows:
+                record = ServerRecord.from_row(row)
+                self.merge_server(record)
+                found.add(record.server_id)
+            for server_id in set(chunk) - found:
+                self.forget_server(server_id)
+
+    async def expire_heartbeats(self, server_ids: list):
+        """Перевод в offline серверов, у которых истек срок сердцебиения"""
+        for server_id in server_ids:
+            server = self.servers.get(server_id)
+            if server is None or server.status == 'offline':
+                continue
+            self.set_server_status(server, 'offline')
+            logger.warning(f"Сервер {server.name} ({server_id}) не отвечает")
+
+    async def remove_inactive_servers(self, server_ids: list):
+        """Удаление серверов, не присылавших сердцебиений дольше inactive_server_ttl"""
+        servers = [
+            server for server in map(self.servers.get, server_ids)
+            if server is not None and server.status == 'offline'
+        ]
+        if not servers:
+            return
+
+        try:
+            await self.remove_servers(servers)
+        except Exception as e:
+            logger.error(f"Ошибка удаления неактивных серверов: {e}")
+            retry = time.time() + 60
+            for server in servers:
+                self.cleanup_deadlines.schedule(server.server_id, retry)
+            return
+
+        self.removed_inactive += len(servers)
+        logger.warning(f"Удалено неактивных серверов: {len(servers)} "
+                       f"(без сердцебиения дольше {self.inactive_server_ttl} с)")
 
     async def monitor_servers(self):
-        """Мониторинг подключенных серверов"""
+        """Перевод серверов в offline точно по истечении heartbeat_timeout"""
         while self.running:
             try:
-                # Проверяем время последнего сердцебиания для каждого сервера
-                current_time = datetime.now()
-
-                for server_id, server in list(self.servers.items()):
-                    # Если последнее сердцебиение было более 5 минут назад, считаем сервер оффлайн
-                    if server['last_heartbeat'] and (current_time - server['last_heartbeat']).total_seconds() > 300:
-                        server['status'] = 'offline'
-                        logger.warning(f"Сервер {server['name']} ({server_id}) не отвечает")
+                await self.offline_deadlines.run(self.expire_heartbeats)
+            except Exception as e:
+                logger.error(f"Ошибка мониторинга серверов: {e}")
+                await asyncio.sleep(1)
 
-                # Ждем 1 минуту до следующей проверки
+    async def cleanup_inactive_servers(self):
+        """Удаление серверов, неактивных дольше inactive_server_ttl"""
+        while self.running:
+            try:
+                await self.cleanup_deadlines.run(self.remove_inactive_servers)
+            except Exception as e:
+                logger.error(f"Ошибка удаления неактивных серверов: {e}")
                 await asyncio.sleep(60)
 
+    async def prune_nonces(self, interval: float = 60.0):
+        """Удаление истекших записей общей таблицы nonce (процесс 0 в режиме --workers)"""
+        while self.running:
+            await asyncio.sleep(interval)
+            try:
+                await self.db.execute(SQL_PRUNE_NONCES, (time.time(),))
             except Exception as e:
-                logger.error(f"Ошибка мониторинга серверов: {e}")
-                await asyncio.sleep(60)
+                logger.error(f"Ошибка очистки таблицы nonce: {e}")
 
-def main():
-    """Основная функция запуска демона"""
-    import argparse
 
-    # Парсинг аргументов командной строки
-    parser = argparse.ArgumentParser(description='Xeray UI - Демон управления серверами XRay')
-    parser.add_argument('--host', default='0.0.0.0', help='Хост для запуска сервера')
-    parser.add_argument('--port', type=int, default=8080, help='Порт для запуска сервера')
-    parser.add_argument('--secret', default='daemon-secret-key', help='Секретный ключ для аутентификации')
-    args = parser.parse_args()
+def logging_from_args(args, filename: str = 'daemon.log') -> logging.handlers.QueueListener:
+    """Настройка журналирования по аргументам командной строки"""
+    return setup_logging(
+        level=args.log_level, log_path=args.log_path, json_lines=args.log_json, max_bytes=args.log_max_bytes,
+        backup_count=args.log_backups, rotate_when=args.log_rotate_when, rate=args.log_rate, filename=filename
+    )
+
+
+def run_daemon(args, worker_id: Optional[int] = None, primary: Optional[tuple] = None):
+    """
+    Запуск демона в текущем процессе до сигнала завершения
+
+    :param args: Аргументы командной строки
+    :param worker_id: Номер рабочего процесса в режиме --workers (None - единственный процесс)
+    :param primary: (внутренний порт процесса 0, ключ подписи запросов между процессами)
+    """
+    # Журналирование через очередь и фоновый поток, у рабочих процессов свои файлы
+    filename = 'daemon.log' if worker_id is None else f'daemon.worker-{worker_id}.log'
+    log_listener = logging_from_args(args, filename)
+    failed = False
 
     # Создаем и запускаем демон
-    daemon = XrayDaemon(host=args.host, port=args.port, secret=args.secret)
+    daemon = XrayDaemon(host=args.host, port=args.port, secret=args.secret, db_path=args.db_path)
+    if worker_id is not None:
+        daemon.enable_workers(worker_id, args.workers, *primary)
+    daemon.heartbeats.flush_interval = args.heartbeat_flush_interval
+    daemon.heartbeat_timeout = args.heartbeat_timeout
+    daemon.inactive_server_ttl = args.inactive_ttl
+    daemon.heartbeats.flush_size = args.heartbeat_flush_size
+    daemon.prober.concurrency = args.probe_concurrency
+    daemon.prober.timeout = args.probe_timeout
+    daemon.prober.http_path = args.probe_http_path
+    daemon.node_client.limit_per_host = args.node_limit_per_host
+    daemon.node_client.timeout = args.node_timeout
+    daemon.node_client.retries = args.node_retries
+    daemon.agent_port = args.agent_port
+    daemon.agent_key = args.agent_key
+    daemon.collector.interval = args.stats_interval
+    daemon.jobs.workers = args.job_workers
+    daemon.jobs.max_attempts = args.job_attempts
+    daemon.auth.allow_legacy = not args.no_legacy_auth
+    daemon.auth.max_nonces = args.auth_max_nonces
+    daemon.metrics_public = args.metrics_public
+    daemon.loop_monitor.enabled = args.loop_monitor
+    daemon.loop_monitor.threshold = args.loop_block_threshold / 1000
+    if args.auth_keys:
+        with open(args.auth_keys, encoding='utf-8') as f:
+            for caller, key in json.load(f).items():
+                daemon.auth.add_key(caller, key)
+    if args.node_id:
+        peers = dict(peer.split('=', 1) for peer in args.peers.split(',') if peer.strip())
+        host = '127.0.0.1' if args.host in ('0.0.0.0', '') else args.host
+        url = args.advertise_url or f'http://{host}:{args.port}'
+        daemon.enable_cluster(args.node_id, url, peers, secret=args.cluster_secret)
+        daemon.cluster_handoff_on_stop = args.cluster_handoff_on_stop
 
     try:
-        # Запускаем демон
-        asyncio.run(daemon.start())
+        # Запускаем демон и работаем до сигнала завершения
+        asyncio.run(daemon.run())
 
     except KeyboardInterrupt:
         logger.info("Завершение работы по запросу пользователя...")
     except Exception as e:
         logger.error(f"Ошибка при запуске демона: {e}")
+        failed = True
+    finally:
+        # Дописываем оставшиеся в очереди записи
+        log_listener.stop()
+
+    # Ненулевой код завершения, чтобы супервизор видел падение рабочего процесса
+    if failed and worker_id is not None:
+        sys.exit(1)
+
+
+def run_supervisor(args):
+    """
+    Запуск args.workers рабочих процессов на одном порту (SO_REUSEPORT)
+
+    Схема базы создается и прерванные операции помечаются один раз до запуска
+    процессов: позже незавершенные операции могут выполняться в соседнем процессе.
+    Внутренний порт процесса 0 и ключ подписи запросов между процессами
+    выбираются здесь же и не меняются при перезапуске процессов.
+    """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise SystemExit('Режим --workers требует поддержки SO_REUSEPORT')
+
+    log_listener = logging_from_args(args)
+    try:
+        db_dir = os.path.dirname(args.db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        db = Database(args.db_path)
+        try:
+            db.run_sync(XrayDaemon._create_schema)
+            interrupted = db.run_sync(lambda conn: conn.execute(SQL_FAIL_INTERRUPTED_JOBS).rowcount)
+            db.run_sync(lambda conn: conn.commit())
+            if interrupted:
+                logger.warning(f"Операций, прерванных перезапуском демона: {interrupted}")
+        finally:
+            # Поток и подключение базы не должны переходить в рабочие процессы
+            db.close()
+
+        primary_port = args.internal_port
+        if not primary_port:
+            with socket.socket() as probe:
+                probe.bind(('127.0.0.1', 0))
+                primary_port = probe.getsockname()[1]
+        primary = (primary_port, secrets.token_hex(32))
+
+        supervisor = WorkerSupervisor(args.workers, functools.partial(run_daemon, args, primary=primary))
+        signal.signal(signal.SIGINT, lambda signum, frame: supervisor.stop())
+        signal.signal(signal.SIGTERM, lambda signum, frame: supervisor.stop())
+
+        logger.info(f"Запуск {args.workers} рабочих процессов на {args.host}:{args.port} "
+                    f"(процесс 0 также на 127.0.0.1:{primary_port})")
+        supervisor.run()
+        logger.info(f"Рабочие процессы остановлены (перезапусков: {supervisor.restarts})")
     finally:
-        # Останавливаем демон
-        if daemon.running:
-            asyncio.run(daemon.stop())
+        log_listener.stop()
+
+
+def main():
+    """Основная функция запуска демона"""
+    import argparse
+
+    # Парсинг аргументов командной строки
+    parser = argparse.ArgumentParser(description='Xeray UI - Демон управления серверами XRay')
+    parser.add_argument('--host', default='0.0.0.0', help='Хост для запуска сервера')
+    parser.add_argument('--port', type=int, default=8080, help='Порт для запуска сервера')
+    parser.add_argument('--secret', default='daemon-secret-key', help='Секретный ключ для аутентификации')
+    parser.add_argument('--db-path', default='daemon.db', help='Путь к базе данных демона')
+    parser.add_argument('--auth-keys',
+                        help='JSON-файл с ключами подписи запросов {"идентификатор": "ключ"}')
+    parser.add_argument('--auth-max-nonces', type=int, default=100000,
+                        help='Размер кеша nonce подписанных запросов: не меньше 600 * пиковое число '
+                             'подписанных запросов в секунду, при заполнении запросы получают 503')
+    parser.add_argument('--loop-monitor', action='store_true',
+                        help='Включить диагностику блокировок цикла событий (команда loop_stats)')
+    parser.add_argument('--loop-block-threshold', type=float, default=100,
+                        help='Порог блокировки цикла событий для отчета (в миллисекундах)')
+    parser.add_argument('--log-level', default=LOG_LEVEL, help='Уровень журналирования')
+    parser.add_argument('--log-path', default=LOG_PATH, help='Каталог файла журнала')
+    parser.add_argument('--log-json', action='store_true', help='Писать файл журнала в формате JSON Lines')
+    parser.add_argument('--log-max-bytes', type=int, default=50 * 1024 * 1024,
+                        help='Размер файла журнала для ротации (в байтах)')
+    parser.add_argument('--log-backups', type=int, default=10, help='Количество архивных файлов журнала')
+    parser.add_argument('--log-rotate-when',
+                        help='Ротация журнала по времени вместо размера (midnight, H, D, ...)')
+    parser.add_argument('--log-rate', type=float, default=20,
+                        help='Сообщений INFO в секунду с одного места вызова (0 - без ограничения)')
+    parser.add_argument('--metrics-public', action='store_true',
+                        help='Отдавать /metrics без аутентификации')
+    parser.add_argument('--no-legacy-auth', action='store_true',
+                        help='Не принимать общий секретный ключ в X-Auth-Key (только подписанные запросы)')
+    parser.add_argument('--probe-concurrency', type=int, default=256,
+                        help='Максимальное число одновременных проверок доступности серверов')
+    parser.add_argument('--probe-timeout', type=float, default=3.0, help='Таймаут проверки доступности (в секундах)')
+    parser.add_argument('--probe-http-path', default=None,
+                        help='Путь для HTTP-проверки доступности (по умолчанию только TCP)')
+    parser.add_argument('--node-limit-per-host', type=int, default=8,
+                        help='Максимальное число соединений с одним узлом')
+    parser.add_argument('--node-timeout', type=float, default=10.0, help='Таймаут запросов к узлам (в секундах)')
+    parser.add_argument('--node-retries', type=int, default=2, help='Количество повторов запросов к узлам')
+    parser.add_argument('--agent-port', type=int, default=None,
+                        help='Порт агента узла для серверов без agent_url (по умолчанию агент не используется)')
+    parser.add_argument('--agent-key', default=None, help='Ключ доступа к агенту узла (заголовок X-Auth-Key)')
+    parser.add_argument('--stats-interval', type=float, default=60.0,
+                        help='Интервал сбора статистики с узлов (в секундах)')
+    parser.add_argument('--node-id', help='Идентификатор узла кластера (включает режим кластера)')
+    parser.add_argument('--peers', default='',
+                        help='Узлы кластера: идентификатор=http://хост:порт через запятую')
+    parser.add_argument('--advertise-url', help='Адрес API этого узла для других узлов кластера')
+    parser.add_argument('--cluster-secret', help='Ключ подписи запросов внутри кластера (по умолчанию --secret)')
+    parser.add_argument('--cluster-handoff-on-stop', action='store_true',
+                        help='Передавать серверы другим узлам кластера при остановке')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Количество рабочих процессов на одном порту (SO_REUSEPORT)')
+    parser.add_argument('--internal-port', type=int, default=0,
+                        help='Внутренний порт процесса 0 на 127.0.0.1 для команд, пересылаемых '
+                             'другими рабочими процессами (по умолчанию свободный порт)')
+    parser.add_argument('--job-workers', type=int, default=16,
+                        help='Максимальное число одновременных операций над серверами')
+    parser.add_argument('--job-attempts', type=int, default=3,
+                        help='Максимальное число попыток операции над сервером (1 - без повторов)')
+    parser.add_argument('--heartbeat-timeout', type=float, default=300,
+                        help='Время без сердцебиения до перевода сервера в offline (в секундах)')
+    parser.add_argument('--inactive-ttl', type=float, default=0,
+                        help='Время без сердцебиения до удаления сервера из базы (в секундах, '
+                             'по умолчанию 0 - не удалять, серверы только переводятся в offline)')
+    parser.add_argument('--heartbeat-flush-interval', type=float, default=5.0,
+                        help='Интервал сброса буфера сердцебиений в базу (в секундах)')
+    parser.add_argument('--heartbeat-flush-size', type=int, default=500,
+                        help='Размер буфера сердцебиений для досрочного сброса')
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        run_supervisor(args)
+    else:
+        run_daemon(args)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""Общие помощники тестов демона"""
+
+import logging
+import os
+
+import pytest
+
+from daemon import Database, XrayDaemon
+
+
+@pytest.fixture(autouse=True)
+def quiet_logging():
+    """Журнал демона в тестах не нужен"""
+    logging.disable(logging.CRITICAL)
+    yield
+    logging.disable(logging.NOTSET)
+
+
+@pytest.fixture
+def db(tmp_path):
+    """База данных демона со схемой во временном каталоге"""
+    database = Database(os.path.join(str(tmp_path), 'daemon.db'))
+    database.run_sync(XrayDaemon._create_schema)
+    yield database
+    database.close()
+
+
+@pytest.fixture
+def make_daemon(tmp_path):
+    """
+    Фабрика демонов с временной базой данных
+
+    Демон создается внутри работающего цикла событий (asyncio.run в тесте),
+    базы закрываются после теста.
+    """
+    daemons = []
+
+    def factory(name: str = 'daemon') -> XrayDaemon:
+        daemon = XrayDaemon(host='127.0.0.1', port=0, db_path=os.path.join(str(tmp_path), f'{name}.db'))
+        daemons.append(daemon)
+        return daemon
+
+    yield factory
+    for daemon in daemons:
+        daemon.db.close()
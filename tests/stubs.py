@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""Заглушки узлов для тестов демона"""
+
+from typing import Any, Dict
+
+import aiohttp.web
+
+
+async def serve(app: aiohttp.web.Application) -> tuple:
+    """Запуск приложения на свободном локальном порту, возвращает (runner, базовый URL)"""
+    runner = aiohttp.web.AppRunner(app)
+    await runner.setup()
+    site = aiohttp.web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+
+class AgentStub:
+    """
+    Заглушка агента узла (см. NODE_STATS_PATH в daemon.py) на локальном порту
+
+    Запоминает вызовы и записанные конфигурации, а для путей из failures
+    отвечает ошибкой заданное число раз.
+    """
+
+    def __init__(self, stats: Dict[str, Any] = None):
+        self.stats = stats or {'uptime': 60, 'inbound_connections': 1, 'outbound_connections': 1,
+                               'total_up': 100, 'total_down': 300, 'users': []}
+        self.calls = []  # [(путь, тело запроса)]
+        self.failures = {}  # {путь: (сколько раз отвечать ошибкой, HTTP-статус)}
+        self.configs = {}  # {путь к конфигурации на узле: последняя записанная конфигурация}
+        self.runner = None
+        self.url = None
+
+    def count(self, path: str) -> int:
+        return sum(1 for called, _ in self.calls if called == path)
+
+    def fail(self, path: str, times: int = 1, status: int = 400):
+        self.failures[path] = (times, status)
+
+    async def handle(self, request: aiohttp.web.Request):
+        body = await request.json() if request.can_read_body else None
+        self.calls.append((request.path, body))
+
+        times, status = self.failures.get(request.path, (0, 200))
+        if times:
+            self.failures[request.path] = (times - 1, status)
+            return aiohttp.web.json_response({'success': False}, status=status)
+        if request.path == '/stats':
+            return aiohttp.web.json_response(self.stats)
+        if request.path == '/config':
+            self.configs[body['path']] = body['config']
+        return aiohttp.web.json_response({'success': True})
+
+    async def start(self) -> 'AgentStub':
+        app = aiohttp.web.Application()
+        app.router.add_get('/stats', self.handle)
+        app.router.add_post('/config', self.handle)
+        app.router.add_post('/restart', self.handle)
+        app.router.add_post('/users/add', self.handle)
+        app.router.add_post('/users/remove', self.handle)
+        self.runner, self.url = await serve(app)
+        return self
+
+    async def stop(self):
+        await self.runner.cleanup()
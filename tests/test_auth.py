@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""Проверка подписей запросов: HMAC, окно времени, повторы и переполнение кеша nonce"""
+
+import asyncio
+import time
+
+import aiohttp
+
+from daemon import RequestAuthenticator
+from tests.stubs import serve
+
+KEY = 'k' * 64
+PATH = '/api/update_config'
+BODY = b'{"server_id": 1}'
+
+
+def signed(nonce: str, timestamp: int = None, body: bytes = BODY, key: str = KEY,
+           method: str = 'POST', path: str = PATH) -> dict:
+    timestamp = str(int(time.time()) if timestamp is None else timestamp)
+    return {
+        'X-Auth-Caller': 'panel',
+        'X-Auth-Timestamp': timestamp,
+        'X-Auth-Nonce': nonce,
+        'X-Auth-Signature': RequestAuthenticator.sign(key, method, path, timestamp, nonce, body)
+    }
+
+
+def make_auth(**options) -> RequestAuthenticator:
+    return RequestAuthenticator('daemon-secret-key', {'panel': KEY}, **options)
+
+
+def test_valid_signature_is_accepted():
+    auth = make_auth()
+    assert auth.verify('POST', PATH, signed('n1'), BODY) == ('panel', None)
+    assert auth.stats()['verified'] == 1
+
+
+def test_tampered_or_foreign_signatures_are_rejected():
+    auth = make_auth()
+
+    assert auth.verify('POST', PATH, signed('n1'), BODY + b' ')[1] == 'Неверная подпись'
+    assert auth.verify('POST', '/api/delete_server', signed('n2'), BODY)[1] == 'Неверная подпись'
+    assert auth.verify('POST', PATH, signed('n3', key='x' * 64), BODY)[1] == 'Неверная подпись'
+    assert auth.verify('POST', PATH, dict(signed('n4'), **{'X-Auth-Caller': 'other'}), BODY)[0] is None
+    # Неудачные проверки не занимают кеш nonce
+    assert auth.stats()['nonces'] == 0
+
+
+def test_expired_timestamp_is_rejected():
+    auth = make_auth(max_skew=300)
+    assert auth.verify('POST', PATH, signed('n1', int(time.time()) - 301), BODY) == (None, 'Подпись просрочена')
+    assert auth.verify('POST', PATH, signed('n2', int(time.time()) + 301), BODY) == (None, 'Подпись просрочена')
+
+
+def test_replayed_nonce_is_rejected():
+    auth = make_auth()
+    headers = signed('n1')
+
+    assert auth.verify('POST', PATH, headers, BODY)[0] == 'panel'
+    assert auth.verify('POST', PATH, headers, BODY) == (None, 'Повторный запрос')
+    assert auth.stats()['replays'] == 1
+
+
+def test_full_nonce_cache_rejects_instead_of_evicting_live_nonces():
+    auth = make_auth(max_nonces=3)
+    first = signed('n0')
+    for nonce in ('n0', 'n1', 'n2'):
+        assert auth.verify('POST', PATH, signed(nonce), BODY)[0] == 'panel'
+
+    assert auth.verify('POST', PATH, signed('n3'), BODY) == (None, RequestAuthenticator.NONCE_CACHE_FULL)
+    # Самый старый nonce не вытеснен, повтор по-прежнему отклоняется
+    assert auth.verify('POST', PATH, first, BODY) == (None, 'Повторный запрос')
+    assert auth.stats()['overflows'] == 1
+
+
+def test_expired_nonces_free_the_cache():
+    auth = make_auth(max_skew=1, max_nonces=2)
+    for nonce in ('n0', 'n1'):
+        assert auth.verify('POST', PATH, signed(nonce), BODY)[0] == 'panel'
+
+    # Окно nonce - 2 * max_skew от момента проверки
+    for entry in auth._nonces:
+        auth._nonces[entry] -= 3
+    assert auth.verify('POST', PATH, signed('n2'), BODY)[0] == 'panel'
+    assert auth.stats()['nonces'] == 1
+
+
+def test_legacy_key_can_be_disabled():
+    auth = make_auth()
+    legacy = {'X-Auth-Key': 'daemon-secret-key'}
+
+    assert auth.verify('POST', PATH, legacy, BODY) == ('legacy', None)
+    auth.allow_legacy = False
+    assert auth.verify('POST', PATH, legacy, BODY)[0] is None
+
+
+def test_oversized_signed_body_gets_json_413(make_daemon):
+    async def scenario():
+        daemon = make_daemon()
+        daemon.max_body_size = 1024
+        daemon.auth.add_key('panel', KEY)
+        runner, url = await serve(daemon.build_app())
+        url += PATH
+        body = b'{"pad": "' + b'x' * 4096 + b'"}'
+
+        async def chunks():
+            # Без Content-Length лимит срабатывает только при чтении тела
+            for start in range(0, len(body), 512):
+                yield body[start:start + 512]
+
+        responses = []
+        try:
+            async with aiohttp.ClientSession() as session:
+                for nonce, data in (('n1', body), ('n2', chunks())):
+                    async with session.post(url, data=data, headers=signed(nonce, body=body)) as response:
+                        responses.append((response.status, await response.json()))
+        finally:
+            await runner.cleanup()
+        return responses
+
+    for status, result in asyncio.run(scenario()):
+        assert status == 413
+        assert result == {'success': False, 'message': 'Тело запроса больше 1024 байт'}
+
+
+def test_ws_query_key_follows_legacy_setting(make_daemon):
+    async def scenario():
+        daemon = make_daemon()
+        daemon.auth.add_key('panel', KEY)
+        runner, url = await serve(daemon.build_app())
+
+        async def connect(query: str = '', headers: dict = None):
+            try:
+                async with session.ws_connect(f'{url}/ws{query}', headers=headers) as ws:
+                    await ws.close()
+                    return 101
+            except aiohttp.WSServerHandshakeError as e:
+                return e.status
+
+        try:
+            async with aiohttp.ClientSession() as session:
+                statuses = [await connect(f'?key={daemon.secret}'), await connect('?key=wrong')]
+                daemon.auth.allow_legacy = False
+                statuses.append(await connect(f'?key={daemon.secret}'))
+                # Подписанный запрос без ключа в параметре
+                statuses.append(await connect(headers=signed('n1', body=b'', method='GET', path='/ws')))
+        finally:
+            await runner.cleanup()
+        return statuses
+
+    assert asyncio.run(scenario()) == [101, 401, 401, 101]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""Нагрузочный сценарий бенчмарков на малом объеме: смесь команд, перцентили, отставание цикла"""
+
+import argparse
+import asyncio
+
+from bench_daemon import bench_load, latency_summary, parse_mix
+
+
+def test_mix_and_latency_summary():
+    assert parse_mix('check_status=70, get_stats=25,update_config') == {
+        'check_status': 70.0, 'get_stats': 25.0, 'update_config': 1.0
+    }
+    samples = [n / 1000 for n in range(1, 101)]
+    assert latency_summary(samples) == {'p50_ms': 51.0, 'p95_ms': 96.0, 'p99_ms': 100.0, 'max_ms': 100.0}
+    assert latency_summary([]) == {}
+
+
+def test_load_scenario_runs_without_errors():
+    args = argparse.Namespace(servers=3, users=6, requests=40, concurrency=4,
+                              mix='check_status=50,get_stats=30,update_config=20')
+
+    result = asyncio.run(bench_load(args))
+
+    commands = result['commands']
+    assert sum(item['requests'] for item in commands.values()) == 40
+    assert all(item['errors'] == 0 for item in commands.values()), commands
+    assert result['rps'] > 0 and result['latency']['p50_ms'] <= result['latency']['max_ms']
+    assert 'p99_ms' in result['loop_lag']
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Кольцо консистентного хеширования и состав кластера"""
+
+import asyncio
+import socket
+
+from daemon import ClusterMembership, HashRing
+
+KEYS = [str(server_id) for server_id in range(10000)]
+
+
+def owners(ring: HashRing) -> dict:
+    return {key: ring.owner(key) for key in KEYS}
+
+
+def test_empty_ring_has_no_owner():
+    assert HashRing().owner('1') is None
+
+
+def test_ownership_does_not_depend_on_node_order():
+    assert owners(HashRing(['a', 'b', 'c'])) == owners(HashRing(['c', 'a', 'b']))
+
+
+def test_keys_are_spread_over_nodes():
+    counts = {}
+    for owner in owners(HashRing(['a', 'b', 'c', 'd'])).values():
+        counts[owner] = counts.get(owner, 0) + 1
+
+    assert set(counts) == {'a', 'b', 'c', 'd'}
+    assert all(0.15 < count / len(KEYS) < 0.35 for count in counts.values())
+
+
+def test_added_node_takes_keys_only_for_itself():
+    before = owners(HashRing(['a', 'b', 'c', 'd']))
+    after = owners(HashRing(['a', 'b', 'c', 'd', 'e']))
+
+    moved = [key for key in KEYS if before[key] != after[key]]
+    assert all(after[key] == 'e' for key in moved)
+    assert 0.1 < len(moved) / len(KEYS) < 0.3
+
+
+def test_removed_node_hands_over_only_its_keys():
+    before = owners(HashRing(['a', 'b', 'c', 'd']))
+    after = owners(HashRing(['a', 'b', 'c']))
+
+    moved = [key for key in KEYS if before[key] != after[key]]
+    assert moved == [key for key in KEYS if before[key] == 'd']
+
+
+def test_ping_from_peer_adds_it_to_ring():
+    async def scenario():
+        membership = ClusterMembership('a', 'http://127.0.0.1:1', {}, secret='s')
+        response, changed = membership.handle_ping({
+            'node_id': 'b', 'url': 'http://127.0.0.1:2/', 'members': {'c': 'http://127.0.0.1:3'}, 'leaving': False
+        })
+        first = (response['node_id'], changed, set(membership.ring.nodes))
+        _, changed_again = membership.handle_ping({'node_id': 'b', 'url': 'http://127.0.0.1:2', 'leaving': True})
+        return first, changed_again, membership
+
+    (node_id, changed, ring), changed_again, membership = asyncio.run(scenario())
+
+    assert (node_id, changed, ring) == ('a', True, {'a', 'b'})
+    # Узел c известен, но в кольцо попадет только после успешного опроса
+    assert membership.members == {'a': 'http://127.0.0.1:1', 'b': 'http://127.0.0.1:2', 'c': 'http://127.0.0.1:3'}
+    assert changed_again and membership.ring.nodes == {'a'}
+
+
+def test_unreachable_peer_is_excluded_after_max_failures():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+
+    async def scenario():
+        membership = ClusterMembership('a', 'http://127.0.0.1:1', {'b': f'http://127.0.0.1:{port}'}, secret='s',
+                                       max_failures=2, timeout=1.0)
+        membership.handle_ping({'node_id': 'b', 'url': f'http://127.0.0.1:{port}'})
+        await membership.client.start()
+        try:
+            results = [await membership.ping_all() for _ in range(2)]
+        finally:
+            await membership.client.close()
+        return results, membership
+
+    results, membership = asyncio.run(scenario())
+
+    assert results == [False, True]
+    assert membership.ring.nodes == {'a'} and membership.owner(1) == 'a'
+
+
+def test_leaving_node_drops_out_of_its_own_ring():
+    async def scenario():
+        membership = ClusterMembership('a', 'http://127.0.0.1:1', {}, secret='s')
+        membership.handle_ping({'node_id': 'b', 'url': 'http://127.0.0.1:2'})
+        membership.mark_leaving()
+        return membership
+
+    membership = asyncio.run(scenario())
+
+    assert membership.ring.nodes == {'b'}
+    assert all(membership.owner(server_id) == 'b' for server_id in range(100))
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Проверка параметров команд API по схеме"""
+
+from daemon import COMMANDS, CommandSpec
+
+
+def make_spec(schema, required=None) -> CommandSpec:
+    return CommandSpec('test', None, schema, required or {})
+
+
+def test_required_parameters():
+    spec = make_spec({}, {'server_id': 'Не указан ID сервера'})
+    assert spec.validate({}) == 'Не указан ID сервера'
+    assert spec.validate({'server_id': ''}) == 'Не указан ID сервера'
+    assert spec.validate({'server_id': 1}) is None
+
+
+def test_types_are_checked():
+    spec = make_spec({'server_id': (int, str), 'limit': int})
+    assert spec.validate({'server_id': 'a', 'limit': 10}) is None
+    assert spec.validate({'server_id': 1.5}) == 'Некорректный тип параметра server_id'
+    assert spec.validate({'limit': '10'}) == 'Некорректный тип параметра limit'
+
+
+def test_bool_is_not_accepted_as_int():
+    spec = make_spec({'server_id': (int, str), 'limit': int, 'wait': bool})
+    assert spec.validate({'server_id': True}) == 'Некорректный тип параметра server_id'
+    assert spec.validate({'limit': False}) == 'Некорректный тип параметра limit'
+    assert spec.validate({'wait': True}) is None
+
+
+def test_registered_commands_reject_bool_server_id():
+    assert COMMANDS['get_config'].validate({'server_id': True}) == 'Некорректный тип параметра server_id'
+
+
+def test_value_checks_run_after_type_checks():
+    spec = CommandSpec('test', None, {'top': int}, {}, {'top': (lambda value: value > 0, 'top <= 0')})
+    assert spec.validate({'top': 'x'}) == 'Некорректный тип параметра top'
+    assert spec.validate({'top': 0}) == 'top <= 0'
+    assert spec.validate({'top': 5}) is None
+
+
+def test_stats_commands_reject_bad_values():
+    aggregate = COMMANDS['aggregate_stats']
+    assert aggregate.validate({'top': 0}) == 'Параметр top должен быть больше нуля'
+    assert aggregate.validate({'top': -1}) == 'Параметр top должен быть больше нуля'
+    assert aggregate.validate({'percentiles': [50, 'p99']}) == 'Перцентили должны быть числами от 0 до 100'
+    assert aggregate.validate({'percentiles': [101]}) == 'Перцентили должны быть числами от 0 до 100'
+    assert aggregate.validate({'top': 3, 'percentiles': [50, 99.9]}) is None
+
+    history = COMMANDS['get_stats_history']
+    assert history.validate({'server_id': 1, 'from': 'yesterday'}) == 'Параметр from должен быть unix-временем'
+    assert history.validate({'server_id': 1, 'to': 'inf'}) == 'Параметр to должен быть unix-временем'
+    assert history.validate({'server_id': 1, 'from': '1700000000', 'to': 1700003600.5}) is None
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""Хранилище конфигураций и update_config: хеши, JSON Patch, горячее применение, повтор после неудачного перезапуска"""
+
+import asyncio
+import json
+import os
+
+import aiohttp
+import pytest
+
+from daemon import ERROR_INVALID_PARAMS, apply_json_patch, canonical_json, config_hash
+from tests.stubs import AgentStub, serve
+
+CONFIG = {
+    'inbounds': [{'tag': 'vless-in', 'port': 443, 'protocol': 'vless', 'settings': {'clients': [
+        {'id': 'uuid-1', 'email': 'user1@example.com'}
+    ]}}],
+    'outbounds': [{'protocol': 'freedom'}]
+}
+
+
+def run_with_server(make_daemon, tmp_path, scenario, **job_options):
+    """
+    Запуск сценария scenario(daemon, agent, send) с одним подключенным сервером
+
+    send(data) выполняет update_config с ожиданием результата.
+    """
+    async def main():
+        agent = await AgentStub().start()
+        daemon = make_daemon()
+        for name, value in job_options.items():
+            setattr(daemon.jobs, name, value)
+        await daemon.node_client.start()
+        await daemon.jobs.start()
+        try:
+            result = await daemon.process_command('connect', {
+                'server_id': 1, 'server_name': 'node-1', 'server_ip': '127.0.0.1', 'server_port': 443,
+                'config_path': os.path.join(str(tmp_path), 'config.json'), 'agent_url': agent.url
+            })
+            assert result['success']
+
+            async def send(data):
+                return await daemon.process_command('update_config', dict({'server_id': 1, 'wait': True}, **data))
+
+            return await scenario(daemon, agent, send)
+        finally:
+            await daemon.jobs.stop()
+            await daemon.node_client.close()
+            await agent.stop()
+
+    return asyncio.run(main())
+
+
+def test_config_hash_does_not_depend_on_key_order():
+    reordered = {'outbounds': CONFIG['outbounds'], 'inbounds': CONFIG['inbounds']}
+    assert canonical_json(reordered) == canonical_json(CONFIG)
+    assert config_hash(canonical_json(reordered)) == config_hash(canonical_json(CONFIG))
+
+
+def test_json_patch_operations():
+    document = {'a': {'b': [1, 2]}, 'c': 1}
+    patched = apply_json_patch(document, [
+        {'op': 'add', 'path': '/a/b/-', 'value': 3},
+        {'op': 'replace', 'path': '/c', 'value': 2},
+        {'op': 'remove', 'path': '/a/b/0'}
+    ])
+    assert patched == {'a': {'b': [2, 3]}, 'c': 2}
+
+    with pytest.raises(ValueError):
+        apply_json_patch({'c': 1}, [{'op': 'test', 'path': '/c', 'value': 2}])
+
+
+@pytest.mark.parametrize('patch', [
+    [1],
+    [{'op': 'add', 'path': 5, 'value': 1}],
+    [{'op': 'jump', 'path': '/a'}],
+    [{'op': 'replace', 'path': '/a'}],
+    [{'op': 'move', 'path': '/b'}],
+    [{'op': 'add', 'path': '/a/9', 'value': 1}],
+    [{'op': 'add', 'path': '/a/-1', 'value': 1}],
+    [{'op': 'replace', 'path': '/a/2', 'value': 1}],
+    [{'op': 'remove', 'path': '/a/01'}],
+    {'op': 'remove', 'path': '/a/0'},
+])
+def test_malformed_patch_raises_value_error(patch):
+    with pytest.raises(ValueError):
+        apply_json_patch({'a': [1, 2]}, patch)
+
+
+def test_add_at_end_of_list_is_allowed():
+    assert apply_json_patch({'a': [1, 2]}, [{'op': 'add', 'path': '/a/2', 'value': 3}]) == {'a': [1, 2, 3]}
+
+
+def test_unchanged_config_is_not_written_or_restarted(make_daemon, tmp_path):
+    async def scenario(daemon, agent, send):
+        first = await send({'config': CONFIG})
+        second = await send({'config': json.loads(json.dumps(CONFIG))})
+        return first, second, agent.count('/restart'), agent
+
+    first, second, restarts, agent = run_with_server(make_daemon, tmp_path, scenario)
+
+    assert first['success'] and first['result']['changed'] and first['result']['restarted']
+    assert second['success'] and not second['result']['changed']
+    assert second['result']['hash'] == first['result']['hash']
+    assert restarts == 1
+    # Конфигурация записывается агентом на узле, в config_path сервера
+    assert agent.count('/config') == 1
+    assert agent.configs == {os.path.join(str(tmp_path), 'config.json'): CONFIG}
+
+
+def test_patch_against_current_hash(make_daemon, tmp_path):
+    async def scenario(daemon, agent, send):
+        first = await send({'config': CONFIG})
+        base_hash = first['result']['hash']
+        patched = await send({'patch': [{'op': 'replace', 'path': '/inbounds/0/port', 'value': 8443}],
+                              'base_hash': base_hash})
+        stale = await send({'patch': [{'op': 'replace', 'path': '/inbounds/0/port', 'value': 9443}],
+                            'base_hash': base_hash})
+        current = await daemon.process_command('get_config', {'server_id': 1, 'include_config': True})
+        return patched, stale, current, daemon.jobs.stats()
+
+    patched, stale, current, jobs = run_with_server(make_daemon, tmp_path, scenario)
+
+    assert patched['success'] and patched['result']['version'] == 2
+    assert current['version'] == 2 and current['config']['inbounds'][0]['port'] == 8443
+    # Устаревшая базовая версия - постоянная ошибка, без повторов
+    assert not stale['success'] and 'Базовая версия' in stale['message']
+    assert jobs['retried'] == 0
+
+
+def test_null_patch_with_config_is_a_full_update(make_daemon, tmp_path):
+    async def scenario(daemon, agent, send):
+        return await send({'config': CONFIG, 'patch': None})
+
+    result = run_with_server(make_daemon, tmp_path, scenario)
+
+    assert result['success'] and result['result']['version'] == 1
+
+
+def test_config_and_patch_together_are_rejected_with_400(make_daemon, tmp_path):
+    async def scenario(daemon, agent, send):
+        runner, url = await serve(daemon.build_app())
+        try:
+            async with aiohttp.ClientSession(headers={'X-Auth-Key': daemon.secret}) as session:
+                async with session.post(f'{url}/api/update_config', json={
+                    'server_id': 1, 'config': CONFIG, 'patch': [], 'base_hash': 'x'
+                }) as response:
+                    return response.status, await response.json(), daemon.jobs.stats()['submitted']
+        finally:
+            await runner.cleanup()
+
+    status, body, submitted = run_with_server(make_daemon, tmp_path, scenario)
+
+    assert status == 400
+    assert body['error'] == ERROR_INVALID_PARAMS and 'patch' in body['message']
+    assert submitted == 0
+
+
+def test_malformed_patch_is_rejected_before_queueing(make_daemon, tmp_path):
+    async def scenario(daemon, agent, send):
+        first = await send({'config': CONFIG})
+        result = await send({'patch': [{'op': 'add', 'path': ['inbounds'], 'value': 1}],
+                             'base_hash': first['result']['hash']})
+        return result, daemon.jobs.stats()
+
+    result, jobs = run_with_server(make_daemon, tmp_path, scenario)
+
+    assert result['error'] == ERROR_INVALID_PARAMS and 'path' in result['message']
+    assert jobs['submitted'] == 1 and jobs['dead_letter'] == 0
+
+
+def test_failed_restart_is_not_recorded_and_retry_restarts_again(make_daemon, tmp_path):
+    async def scenario(daemon, agent, send):
+        agent.fail('/restart')
+        failed = await send({'config': CONFIG})
+        version_after_failure = await daemon.configs.current(1)
+        retried = await send({'config': CONFIG})
+        return failed, version_after_failure, retried, agent.count('/restart')
+
+    failed, version_after_failure, retried, restarts = run_with_server(make_daemon, tmp_path, scenario,
+                                                                       max_attempts=1)
+
+    assert not failed['success']
+    assert version_after_failure is None
+    assert retried['success'] and retried['result']['changed'] and retried['result']['restarted']
+    assert restarts == 2
+
+
+def test_failed_restart_is_retried_by_the_job_queue(make_daemon, tmp_path):
+    async def scenario(daemon, agent, send):
+        agent.fail('/restart')
+        result = await send({'config': CONFIG})
+        job = await daemon.jobs.get(result['job_id'])
+        return result, job, agent.count('/restart')
+
+    result, job, restarts = run_with_server(make_daemon, tmp_path, scenario, max_attempts=2, retry_delay=0.01)
+
+    assert result['success'] and result['result']['version'] == 1
+    assert job['attempts'] == 2
+    assert restarts == 2
+
+
+def with_user(config, user_id, email):
+    """Копия конфигурации с дополнительным пользователем первого входящего подключения"""
+    config = json.loads(json.dumps(config))
+    config['inbounds'][0]['settings']['clients'].append({'id': user_id, 'email': email})
+    return config
+
+
+def test_user_changes_are_applied_through_agent_without_restart(make_daemon, tmp_path):
+    async def scenario(daemon, agent, send):
+        await send({'config': CONFIG})
+        added = await send({'config': with_user(CONFIG, 'uuid-2', 'user2@example.com')})
+        removed = await send({'config': CONFIG})
+        return added, removed, agent, dict(daemon.reload_stats)
+
+    added, removed, agent, reload_stats = run_with_server(make_daemon, tmp_path, scenario)
+
+    assert added['success'] and not added['result']['restarted'] and added['result']['version'] == 2
+    assert removed['success'] and not removed['result']['restarted']
+    user_calls = [call for call in agent.calls if call[0].startswith('/users/')]
+    assert user_calls == [
+        ('/users/add', {'tag': 'vless-in', 'users': [{'id': 'uuid-2', 'email': 'user2@example.com'}]}),
+        ('/users/remove', {'tag': 'vless-in', 'emails': ['user2@example.com']})
+    ]
+    assert agent.count('/restart') == 1
+    assert reload_stats['restarts_avoided'] == 2
+
+
+def test_failed_hot_reload_falls_back_to_restart(make_daemon, tmp_path):
+    async def scenario(daemon, agent, send):
+        await send({'config': CONFIG})
+        agent.fail('/users/add')
+        result = await send({'config': with_user(CONFIG, 'uuid-2', 'user2@example.com')})
+        return result, agent.count('/restart'), dict(daemon.reload_stats)
+
+    result, restarts, reload_stats = run_with_server(make_daemon, tmp_path, scenario)
+
+    assert result['success'] and result['result']['restarted']
+    assert restarts == 2
+    assert reload_stats['hot_reload_failures'] == 1
+
+
+def test_update_without_agent_fails_and_is_not_recorded(make_daemon, tmp_path):
+    async def scenario():
+        daemon = make_daemon()
+        await daemon.node_client.start()
+        await daemon.jobs.start()
+        try:
+            await daemon.process_command('connect', {
+                'server_id': 1, 'server_name': 'node-1', 'server_ip': '127.0.0.1', 'server_port': 443,
+                'config_path': '/etc/xray/config.json'
+            })
+            update = await daemon.process_command('update_config', {'server_id': 1, 'config': CONFIG, 'wait': True})
+            restart = await daemon.process_command('restart_xray', {'server_id': 1, 'wait': True})
+            return update, restart, await daemon.configs.current(1), daemon.jobs.stats()
+        finally:
+            await daemon.jobs.stop()
+            await daemon.node_client.close()
+
+    update, restart, current, jobs = asyncio.run(scenario())
+
+    assert not update['success'] and 'не настроен' in update['message']
+    assert not restart['success'] and 'не настроен' in restart['message']
+    assert current is None
+    # Без агента повторять бессмысленно
+    assert jobs['retried'] == 0 and jobs['dead_letter'] == 0
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Инкрементальная выдача пользователей get_stats: курсор, эпоха, история удалений"""
+
+import asyncio
+
+from daemon import UserDeltaTracker
+from tests.stubs import AgentStub
+
+
+def user(email: str, up: int = 0, down: int = 0) -> dict:
+    return {'id': f'id-{email}', 'email': email, 'up': up, 'down': down}
+
+
+def test_changes_since_cursor():
+    tracker = UserDeltaTracker()
+    tracker.update([user('a', 1), user('b', 1), user('c', 1)])
+    cursor = tracker.cursor
+    seq = tracker.parse_cursor(cursor)
+
+    tracker.update([user('a', 1), user('b', 5), user('d', 1)])
+
+    changed, removed = tracker.changes_since(seq)
+    assert [item['email'] for item in changed] == ['b', 'd']
+    assert removed == ['c']
+    assert [item['email'] for item in tracker.snapshot()] == ['a', 'b', 'd']
+
+    # Без изменений выдача пустая, курсор продвигается
+    tracker.update([user('a', 1), user('b', 5), user('d', 1)])
+    assert tracker.changes_since(tracker.parse_cursor(tracker.cursor)) == ([], [])
+    assert tracker.cursor != cursor
+
+
+def test_foreign_or_unknown_cursor_requires_full_snapshot():
+    tracker = UserDeltaTracker()
+    tracker.update([user('a')])
+    other = UserDeltaTracker()
+    other.update([user('a')])
+
+    # Курсор другой эпохи (выдан до перезапуска демона), из будущего или испорченный
+    assert tracker.parse_cursor(other.cursor) is None
+    assert tracker.parse_cursor(f'{tracker.epoch}:{tracker.seq + 1}') is None
+    assert tracker.parse_cursor(f'{tracker.epoch}:x') is None
+    assert tracker.parse_cursor(None) is None
+    assert tracker.parse_cursor(tracker.cursor) == tracker.seq
+
+
+def test_cursor_older_than_removal_history_requires_full_snapshot():
+    tracker = UserDeltaTracker(max_removed=2)
+    tracker.update([user(email) for email in 'abcd'])
+    old_seq = tracker.seq
+
+    for remaining in ('bcd', 'cd', 'd'):
+        tracker.update([user(email) for email in remaining])
+
+    # Удаление a вытеснено из истории: по старому курсору его не восстановить
+    assert tracker.parse_cursor(f'{tracker.epoch}:{old_seq}') is None
+    assert tracker.parse_cursor(f'{tracker.epoch}:{old_seq + 1}') == old_seq + 1
+
+
+def test_get_stats_switches_to_delta_mode(make_daemon):
+    async def scenario():
+        agent = await AgentStub({'uptime': 1, 'inbound_connections': 0, 'outbound_connections': 0,
+                                 'total_up': 0, 'total_down': 0,
+                                 'users': [user('a', 1), user('b', 1)]}).start()
+        daemon = make_daemon()
+        await daemon.node_client.start()
+        try:
+            await daemon.process_command('connect', {
+                'server_id': 1, 'server_name': 'node-1', 'server_ip': '127.0.0.1', 'server_port': 443,
+                'config_path': '/etc/xray/config.json', 'agent_url': agent.url
+            })
+            first = await daemon.process_command('get_stats', {'server_id': 1})
+            agent.stats['users'] = [user('a', 7)]
+            second = await daemon.process_command('get_stats', {'server_id': 1, 'since': first['cursor']})
+            stale = await daemon.process_command('get_stats', {'server_id': 1, 'since': 'old:1'})
+            return first, second, stale
+        finally:
+            await daemon.node_client.close()
+            await agent.stop()
+
+    first, second, stale = asyncio.run(scenario())
+
+    assert first['mode'] == 'full' and len(first['stats']['users']) == 2
+    assert second['mode'] == 'delta'
+    assert [(item['email'], item['up']) for item in second['stats']['users']] == [('a', 7)]
+    assert second['stats']['removed_users'] == ['b']
+    assert stale['mode'] == 'full' and len(stale['stats']['users']) == 1
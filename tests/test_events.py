@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Рассылка событий подписчикам /ws: подписки, вытеснение при отставании, отключение медленных"""
+
+import asyncio
+import json
+
+import aiohttp
+
+from daemon import EventHub, ServerRecord
+from tests.stubs import serve
+
+
+def make_server(server_id: int) -> ServerRecord:
+    return ServerRecord(server_id, f'daemon_{server_id}', f'node-{server_id}', '127.0.0.1', 443,
+                        '/etc/xray/config.json')
+
+
+def drain(subscription) -> list:
+    messages = []
+    while not subscription.queue.empty():
+        message = subscription.queue.get_nowait()
+        messages.append(json.loads(message) if message is not None else None)
+    return messages
+
+
+def test_events_reach_only_watchers():
+    async def scenario():
+        hub = EventHub()
+        one, everything, none = hub.subscribe(), hub.subscribe(), hub.subscribe()
+        hub.watch(one, [1])
+        hub.watch(everything, '*')
+        hub.publish(1, {'type': 'status'})
+        hub.publish(2, {'type': 'status'})
+        hub.unwatch(one, [1])
+        hub.publish(1, {'type': 'stats'})
+        return [[event['server_id'] for event in drain(item)] for item in (one, everything, none)], hub.stats()
+
+    received, stats = asyncio.run(scenario())
+
+    assert received == [[1], [1, 2, 1], []]
+    assert stats['published'] == 3 and stats['delivered'] == 4
+
+
+def test_slow_subscriber_loses_oldest_events_and_is_disconnected():
+    async def scenario():
+        hub = EventHub(queue_size=2, max_dropped=5)
+        subscription = hub.subscribe()
+        hub.watch(subscription, '*')
+        for n in range(4):
+            hub.publish(1, {'n': n})
+        lagging = (subscription.pending_dropped, [event['n'] for event in drain(subscription)])
+
+        for n in range(10):
+            hub.publish(1, {'n': n})
+        return lagging, drain(subscription), hub.stats()
+
+    (pending_dropped, kept), after_overflow, stats = asyncio.run(scenario())
+
+    assert (pending_dropped, kept) == (2, [2, 3])
+    # После max_dropped потерь подписчик отписан, последним в очереди стоит None
+    assert after_overflow[-1] is None
+    assert stats['subscribers'] == 0 and stats['disconnected_slow'] == 1
+
+
+def test_ws_subscription_receives_snapshot_events_and_lag_notice(make_daemon):
+    async def scenario():
+        daemon = make_daemon()
+        daemon.events.queue_size = 2
+        for server_id in (1, 2):
+            daemon.servers.add(make_server(server_id))
+        runner, url = await serve(daemon.build_app())
+        messages = []
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.ws_connect(f'{url}/ws?key={daemon.secret}') as ws:
+                    await ws.send_json({'action': 'subscribe', 'server_ids': [1]})
+                    messages.append(await ws.receive_json(timeout=5))
+
+                    # Пять смен статуса подряд: в очереди из двух сообщений три вытесняются
+                    for status in ('online', 'offline', 'online', 'offline', 'online'):
+                        daemon.set_server_status(daemon.servers.get(1), status)
+                    daemon.set_server_status(daemon.servers.get(2), 'online')
+                    for _ in range(3):
+                        messages.append(await ws.receive_json(timeout=5))
+
+                    await ws.send_json({'action': 'jump'})
+                    messages.append(await ws.receive_json(timeout=5))
+        finally:
+            await runner.cleanup()
+        return messages
+
+    snapshot, lagged, fourth, fifth, error = asyncio.run(scenario())
+
+    assert snapshot['type'] == 'status' and snapshot['server_id'] == 1 and snapshot['previous'] is None
+    assert lagged == {'type': 'lagged', 'dropped': 3}
+    assert [(fourth['status'], fourth['previous']), (fifth['status'], fifth['previous'])] == [
+        ('offline', 'online'), ('online', 'offline')
+    ]
+    assert fifth['server_id'] == 1
+    assert error['type'] == 'error'
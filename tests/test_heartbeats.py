@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""Буфер отложенной записи сердцебиений: схлопывание, сброс пачкой, возврат изменений при ошибке"""
+
+import asyncio
+import datetime
+
+from daemon import SQL_INSERT_SERVER, HeartbeatBuffer, db_timestamp
+
+HEARTBEAT = datetime.datetime(2024, 1, 1, 12, 0, 0)
+
+
+def add_servers(db, count: int):
+    db.run_sync(lambda conn: conn.executemany(SQL_INSERT_SERVER, [
+        (server_id, f'daemon_{server_id}', f'node-{server_id}', '127.0.0.1', 443, '/etc/xray/config.json', None)
+        for server_id in range(1, count + 1)
+    ]))
+    db.run_sync(lambda conn: conn.commit())
+
+
+def statuses(db) -> dict:
+    rows = db.run_sync(lambda conn: conn.execute("SELECT server_id, status, last_heartbeat FROM servers").fetchall())
+    return {server_id: (status, last_heartbeat) for server_id, status, last_heartbeat in rows}
+
+
+class FailingDatabase:
+    """База, транзакции которой завершаются ошибкой"""
+
+    async def transaction(self, func, *args):
+        raise RuntimeError('database is locked')
+
+
+def test_changes_are_coalesced_and_flushed_in_one_batch(db):
+    add_servers(db, 3)
+    buffer = HeartbeatBuffer(db)
+
+    async def scenario():
+        buffer.record(1, 'online', HEARTBEAT)
+        buffer.record(2, 'online', HEARTBEAT)
+        buffer.record(1, 'offline', HEARTBEAT + datetime.timedelta(seconds=30))
+        pending = buffer.has_pending(1)
+        return pending, await buffer.flush(), await buffer.flush()
+
+    pending, flushed, flushed_again = asyncio.run(scenario())
+
+    assert pending and (flushed, flushed_again) == (2, 0)
+    rows = statuses(db)
+    assert rows[1] == ('offline', db_timestamp(HEARTBEAT + datetime.timedelta(seconds=30)))
+    assert rows[2] == ('online', db_timestamp(HEARTBEAT))
+    assert rows[3][0] == 'connected'
+    stats = buffer.stats()
+    assert (stats['writes'], stats['coalesced'], stats['flushes'], stats['pending']) == (3, 1, 1, 0)
+
+
+def test_failed_flush_requeues_without_overwriting_newer_changes(db):
+    add_servers(db, 2)
+    buffer = HeartbeatBuffer(db)
+
+    async def scenario():
+        buffer.record(1, 'online', HEARTBEAT)
+        buffer.record(2, 'online', HEARTBEAT)
+        buffer.db = FailingDatabase()
+        try:
+            await buffer.flush()
+        except RuntimeError:
+            pass
+        # Изменение, пришедшее во время неудачного сброса, новее возвращенного
+        buffer.record(1, 'offline', HEARTBEAT + datetime.timedelta(seconds=30))
+        buffer.db = db
+        return await buffer.flush()
+
+    flushed = asyncio.run(scenario())
+
+    assert flushed == 2
+    rows = statuses(db)
+    assert rows[1][0] == 'offline' and rows[2][0] == 'online'
+    assert buffer.stats()['failed_flushes'] == 1
+
+
+def test_full_buffer_is_flushed_before_the_interval(db):
+    add_servers(db, 3)
+    buffer = HeartbeatBuffer(db, flush_interval=60, flush_size=3)
+
+    async def scenario():
+        task = asyncio.create_task(buffer.run())
+        await asyncio.sleep(0)
+        for server_id in (1, 2, 3):
+            buffer.record(server_id, 'online', HEARTBEAT)
+        for _ in range(100):
+            if buffer.flushes:
+                break
+            await asyncio.sleep(0.01)
+        task.cancel()
+        return buffer.flushes
+
+    assert asyncio.run(scenario()) == 1
+    assert {status for status, _ in statuses(db).values()} == {'online'}
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""Очередь фоновых операций: порядок по серверам, общий лимит, повторы и dead letter"""
+
+import asyncio
+
+from daemon import JobQueue, PermanentJobError
+
+
+def run_queue(db, handler, jobs, **options):
+    """
+    Выполнение операций в очереди с одним обработчиком handler(job)
+
+    :param jobs: Список (server_id, данные)
+    :return: (очередь, список завершенных операций)
+    """
+    async def scenario():
+        queue = JobQueue(db, {'test': handler}, **options)
+        await queue.start()
+        try:
+            submitted = [await queue.submit('test', server_id, data) for server_id, data in jobs]
+            await asyncio.wait_for(asyncio.gather(*(job.done for job in submitted)), timeout=10)
+            return queue, submitted
+        finally:
+            await queue.stop()
+
+    return asyncio.run(scenario())
+
+
+def test_jobs_of_one_server_run_in_order_without_overlap(db):
+    events = []
+
+    async def handler(job):
+        events.append(('start', job.server_id, job.data['n']))
+        await asyncio.sleep(0.01)
+        events.append(('end', job.server_id, job.data['n']))
+
+    jobs = [(server_id, {'n': n}) for n in range(5) for server_id in (1, 2)]
+    queue, submitted = run_queue(db, handler, jobs, workers=4)
+
+    assert all(job.status == 'success' for job in submitted)
+    for server_id in (1, 2):
+        server_events = [(kind, n) for kind, sid, n in events if sid == server_id]
+        assert server_events == [(kind, n) for n in range(5) for kind in ('start', 'end')]
+
+    # Операции разных серверов выполнялись параллельно
+    assert events[:2] == [('start', 1, 0), ('start', 2, 0)]
+
+
+def test_global_concurrency_is_capped_by_workers(db):
+    running = 0
+    peak = 0
+
+    async def handler(job):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    queue, submitted = run_queue(db, handler, [(server_id, {}) for server_id in range(10)], workers=3)
+
+    assert peak == 3
+    assert queue.stats()['succeeded'] == 10
+
+
+def test_failed_job_is_retried_before_next_job_of_the_server(db):
+    calls = []
+
+    async def handler(job):
+        calls.append((job.data['n'], job.attempts))
+        if job.data['n'] == 0 and job.attempts < 3:
+            raise RuntimeError('узел недоступен')
+        return job.data['n']
+
+    queue, submitted = run_queue(db, handler, [(1, {'n': 0}), (1, {'n': 1})], max_attempts=3, retry_delay=0.01)
+
+    first, second = submitted
+    assert calls == [(0, 1), (0, 2), (0, 3), (1, 1)]
+    assert (first.status, first.attempts, first.result, first.error) == ('success', 3, 0, None)
+    assert second.status == 'success'
+    assert queue.stats()['retried'] == 2
+    assert not queue.dead_letter
+
+
+def test_job_that_exhausts_attempts_goes_to_dead_letter(db):
+    async def handler(job):
+        raise RuntimeError('узел недоступен')
+
+    async def scenario():
+        queue = JobQueue(db, {'test': handler}, max_attempts=2, retry_delay=0.01)
+        await queue.start()
+        try:
+            job = await queue.submit('test', 1, {})
+            await asyncio.wait_for(job.done, timeout=10)
+            queue.jobs.clear()
+            return queue, job, await queue.get(job.id)
+        finally:
+            await queue.stop()
+
+    queue, job, stored = asyncio.run(scenario())
+
+    assert (job.status, job.attempts, job.error) == ('failed', 2, 'узел недоступен')
+    assert list(queue.dead_letter) == [job]
+    assert queue.stats()['dead_letter'] == 1
+    # Итоговое состояние сохранено в operation_logs
+    assert (stored['status'], stored['attempts'], stored['error']) == ('failed', 2, 'узел недоступен')
+
+
+def test_permanent_error_is_not_retried(db):
+    async def handler(job):
+        raise PermanentJobError('Сервер не найден')
+
+    queue, (job,) = run_queue(db, handler, [(1, {})], max_attempts=5, retry_delay=0.01)
+
+    assert (job.status, job.attempts) == ('failed', 1)
+    assert not queue.dead_letter
+    assert queue.stats()['retried'] == 0
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""Журналирование через очередь: ограничение частоты, JSON Lines, запись фоновым потоком"""
+
+import json
+import logging
+import os
+import sys
+
+import pytest
+
+from daemon import JsonLinesFormatter, RateLimitFilter, setup_logging
+
+
+def make_record(created: float, lineno: int = 10, level: int = logging.INFO, msg: str = 'сообщение %s',
+                args=(1,)) -> logging.LogRecord:
+    record = logging.LogRecord('daemon', level, 'daemon.py', lineno, msg, args, None)
+    record.created = created
+    return record
+
+
+def test_rate_limit_counts_suppressed_messages_per_call_site():
+    rate_filter = RateLimitFilter(rate=1, burst=2)
+
+    passed = [rate_filter.filter(make_record(100.0)) for _ in range(5)]
+    other_line = rate_filter.filter(make_record(100.0, lineno=20))
+    warning = rate_filter.filter(make_record(100.0, level=logging.WARNING))
+    # Через секунду накоплен один токен, к сообщению дописывается число отброшенных
+    record = make_record(101.0)
+    after_pause = rate_filter.filter(record)
+
+    assert passed == [True, True, False, False, False]
+    assert other_line and warning and after_pause
+    assert record.getMessage() == 'сообщение 1 (пропущено похожих сообщений: 3)'
+    assert rate_filter.suppressed == 3
+
+
+def test_json_lines_format():
+    try:
+        raise ValueError('сбой')
+    except ValueError:
+        record = logging.LogRecord('daemon', logging.ERROR, 'daemon.py', 7, 'ошибка %s', ('узла',),
+                                   sys.exc_info())
+
+    entry = json.loads(JsonLinesFormatter().format(record))
+
+    assert entry['level'] == 'ERROR' and entry['message'] == 'ошибка узла' and entry['line'] == 7
+    assert 'ValueError: сбой' in entry['exception']
+
+
+@pytest.fixture
+def root_logger():
+    """Восстановление обработчиков корневого журнала после setup_logging"""
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    logging.disable(logging.NOTSET)
+    yield root
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+def test_records_are_written_by_listener_thread(tmp_path, root_logger):
+    listener = setup_logging('INFO', str(tmp_path), json_lines=True, rate=1, burst=3, console=False,
+                             filename='worker-1.log')
+    log = logging.getLogger('daemon.test')
+    for n in range(10):
+        log.info('запрос %d', n)
+    log.debug('не пишется')
+    log.warning('предупреждение')
+    listener.stop()
+
+    with open(os.path.join(str(tmp_path), 'worker-1.log'), encoding='utf-8') as file:
+        entries = [json.loads(line) for line in file]
+
+    assert [entry['message'] for entry in entries] == ['запрос 0', 'запрос 1', 'запрос 2', 'предупреждение']
+    assert entries[0]['logger'] == 'daemon.test'
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""Диагностика блокировок цикла событий: замер отставания, стек и метка заблокировавшей задачи"""
+
+import asyncio
+import time
+
+
+def block_loop(seconds: float):
+    """Синхронная работа в цикле событий"""
+    time.sleep(seconds)
+
+
+def test_blocking_command_is_reported_with_label_and_stack(make_daemon):
+    async def scenario():
+        daemon = make_daemon()
+        monitor = daemon.loop_monitor
+        monitor.enabled = True
+        monitor.interval = 0.02
+        monitor.threshold = 0.1
+        task = asyncio.create_task(monitor.run())
+        try:
+            await asyncio.sleep(0.1)
+            previous = monitor.set_label('slow_command')
+            block_loop(0.3)
+            monitor.reset_label(previous)
+            await asyncio.sleep(0.1)
+            return await daemon.process_command('loop_stats', {'limit': 5}), dict(monitor._labels)
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    result, labels = asyncio.run(scenario())
+
+    assert result['enabled'] and result['blocks'] >= 1
+    report = next(item for item in result['reports'] if item['label'] == 'slow_command')
+    assert report['blocked_ms'] >= 200 and result['max_lag_ms'] >= 200
+    assert any('block_loop' in line for line in report['stack'])
+    # Метки снимаются по завершении команды
+    assert labels == {}
+
+
+def test_disabled_monitor_keeps_no_labels(make_daemon):
+    async def scenario():
+        daemon = make_daemon()
+        label = daemon.loop_monitor.set_label('command')
+        return label, daemon.loop_monitor._labels, await daemon.process_command('loop_stats', {})
+
+    label, labels, result = asyncio.run(scenario())
+
+    assert label is None and labels == {}
+    assert result['success'] and not result['enabled'] and result['reports'] == []
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""Метрики команд и HTTP-запросов в формате Prometheus (/metrics)"""
+
+import asyncio
+
+import aiohttp
+
+from daemon import LatencyMetrics
+from tests.stubs import serve
+
+
+def test_histogram_is_cumulative():
+    metrics = LatencyMetrics('test', 'command', 'Время')
+    for seconds, error in ((0.0005, False), (0.001, False), (0.003, True), (20.0, False)):
+        metrics.start('ping')
+        metrics.finish('ping', seconds, error)
+    metrics.start('slow')
+
+    lines = metrics.render()
+
+    assert 'test_duration_seconds_bucket{command="ping",le="0.001"} 2' in lines
+    assert 'test_duration_seconds_bucket{command="ping",le="0.005"} 3' in lines
+    assert 'test_duration_seconds_bucket{command="ping",le="10.0"} 3' in lines
+    assert 'test_duration_seconds_bucket{command="ping",le="+Inf"} 4' in lines
+    assert 'test_duration_seconds_count{command="ping"} 4' in lines
+    assert 'test_duration_seconds_sum{command="ping"} 20.004500' in lines
+    assert 'test_errors_total{command="ping"} 1' in lines
+    assert 'test_in_flight{command="ping"} 0' in lines and 'test_in_flight{command="slow"} 1' in lines
+    assert '# TYPE test_duration_seconds histogram' in lines
+
+
+def test_metrics_endpoint(make_daemon):
+    async def scenario():
+        daemon = make_daemon()
+        runner, url = await serve(daemon.build_app())
+        try:
+            async with aiohttp.ClientSession(headers={'X-Auth-Key': daemon.secret}) as session:
+                await session.post(f'{url}/api/daemon_stats', json={})
+                await session.post(f'{url}/api/no_such_command', json={})
+                await session.post(f'{url}/api/get_config', json={'server_id': True})
+                async with session.get(f'{url}/metrics') as response:
+                    authorized = (response.status, response.headers['Content-Type'], await response.text())
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f'{url}/metrics') as response:
+                    anonymous = response.status
+                daemon.metrics_public = True
+                async with session.get(f'{url}/metrics') as response:
+                    public = response.status
+        finally:
+            await runner.cleanup()
+        return authorized, anonymous, public
+
+    (status, content_type, body), anonymous, public = asyncio.run(scenario())
+
+    assert status == 200 and content_type.startswith('text/plain')
+    lines = body.splitlines()
+    assert 'xeray_daemon_command_duration_seconds_count{command="daemon_stats"} 1' in lines
+    # Ошибка проверки параметров считается ошибкой команды
+    assert 'xeray_daemon_command_errors_total{command="get_config"} 1' in lines
+    assert 'xeray_daemon_http_request_duration_seconds_count{handler="/api/daemon_stats"} 1' in lines
+    # Неизвестные команды не создают отдельных меток
+    assert 'xeray_daemon_http_request_duration_seconds_count{handler="/api/{command}"} 1' in lines
+    assert not any('no_such_command' in line for line in lines)
+    assert 'xeray_daemon_servers 0' in lines
+    assert (anonymous, public) == (401, 200)
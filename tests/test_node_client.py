@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""Общий HTTP-клиент обращений к узлам: таймауты и повторы"""
+
+import asyncio
+
+import aiohttp.web
+import pytest
+
+from daemon import NodeClient
+from tests.stubs import serve
+
+
+async def start_slow_stub(delay: float):
+    """Узел, отвечающий через delay секунд"""
+    async def handle(request):
+        await asyncio.sleep(delay)
+        return aiohttp.web.json_response({'success': True})
+
+    app = aiohttp.web.Application()
+    app.router.add_post('/slow', handle)
+    return await serve(app)
+
+
+def test_session_timeout_applies_without_explicit_timeout():
+    async def scenario():
+        runner, url = await start_slow_stub(0.5)
+        client = NodeClient(timeout=0.2, retries=0)
+        await client.start()
+        try:
+            with pytest.raises(asyncio.TimeoutError):
+                await client.request('POST', url + '/slow', {})
+            # Явный таймаут запроса заменяет таймаут сессии
+            return await client.request('POST', url + '/slow', {}, timeout=5.0), client.failures
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    assert asyncio.run(scenario()) == ({'success': True}, 1)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""Проверка доступности серверов на локальных заглушках"""
+
+import asyncio
+import socket
+
+import aiohttp.web
+
+from daemon import HealthProber, ServerRecord, ServerRegistry
+
+
+def closed_port() -> int:
+    """Локальный порт, на котором никто не слушает"""
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+async def start_listener():
+    """TCP-заглушка узла, возвращает (сервер, порт)"""
+    async def handle(reader, writer):
+        writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+async def start_http_stub(status: int):
+    """HTTP-заглушка с фиксированным статусом ответа, возвращает (runner, порт)"""
+    async def handle(request):
+        return aiohttp.web.Response(status=status)
+
+    app = aiohttp.web.Application()
+    app.router.add_get('/health', handle)
+    runner = aiohttp.web.AppRunner(app)
+    await runner.setup()
+    site = aiohttp.web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, site._server.sockets[0].getsockname()[1]
+
+
+def make_server(server_id: int, port: int) -> ServerRecord:
+    return ServerRecord(server_id, f'daemon_{server_id}', f'node-{server_id}', '127.0.0.1', port, '/etc/xray/config.json')
+
+
+def test_tcp_probe_up_and_down():
+    async def scenario():
+        listener, port = await start_listener()
+        prober = HealthProber(ServerRegistry(), timeout=1.0)
+        try:
+            result = await prober.sweep([make_server(1, port), make_server(2, closed_port())])
+        finally:
+            listener.close()
+            await listener.wait_closed()
+        return prober, result
+
+    prober, result = asyncio.run(scenario())
+
+    assert result == {1: True, 2: False}
+    assert (prober.probes, prober.failed_probes) == (2, 1)
+
+
+def test_http_probe_checks_status_code():
+    async def scenario():
+        ok_runner, ok_port = await start_http_stub(200)
+        bad_runner, bad_port = await start_http_stub(503)
+        prober = HealthProber(ServerRegistry(), timeout=1.0, http_path='/health')
+        try:
+            return await prober.sweep([make_server(1, ok_port), make_server(2, bad_port)])
+        finally:
+            await ok_runner.cleanup()
+            await bad_runner.cleanup()
+
+    assert asyncio.run(scenario()) == {1: True, 2: False}
+
+
+def test_backoff_doubles_for_dead_hosts_and_resets_on_success():
+    prober = HealthProber(ServerRegistry(), interval=10.0, max_backoff=50.0)
+
+    delays = [prober.next_delay(1, False) for _ in range(5)]
+    for delay, expected in zip(delays, (10.0, 20.0, 40.0, 50.0, 50.0)):
+        assert expected * 0.9 <= delay <= expected * 1.1
+
+    assert 9.0 <= prober.next_delay(1, True) <= 11.0
+    assert 9.0 <= prober.next_delay(1, False) <= 11.0
+
+
+def test_background_run_feeds_results_and_backs_off_dead_hosts():
+    async def scenario():
+        listener, port = await start_listener()
+        registry = ServerRegistry()
+        registry.add(make_server(1, port))
+        registry.add(make_server(2, closed_port()))
+        prober = HealthProber(registry, interval=0.05, timeout=1.0)
+        results = {1: [], 2: []}
+
+        task = asyncio.create_task(prober.run(lambda server, ok: results[server.server_id].append(ok)))
+        await asyncio.sleep(0.8)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        listener.close()
+        await listener.wait_closed()
+        return prober, results
+
+    prober, results = asyncio.run(scenario())
+
+    assert results[1] and all(results[1])
+    assert results[2] and not any(results[2])
+    # Недоступный сервер проверяется с растущей паузой: 0.05, 0.1, 0.2, 0.4 с
+    assert len(results[2]) <= 5 < len(results[1])
+    assert prober.stats()['backing_off'] == 1
+
+
+def test_probe_results_update_server_status(make_daemon):
+    async def scenario():
+        daemon = make_daemon()
+        server = make_server(1, closed_port())
+        daemon.servers.add(server)
+
+        daemon.apply_probe_result(server, True)
+        online = (server.status, server.last_heartbeat)
+        daemon.apply_probe_result(server, False)
+        return online, server
+
+    (status, heartbeat), server = asyncio.run(scenario())
+
+    assert status == 'online' and heartbeat is not None
+    assert server.status == 'offline'
+    # Время последнего сердцебиения при неудачной проверке не меняется
+    assert server.last_heartbeat == heartbeat
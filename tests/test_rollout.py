@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""Поэтапная раскатка конфигурации: волны, остановка по доле сбоев, отмена"""
+
+import asyncio
+import os
+
+import pytest
+
+from daemon import Rollout
+from tests.stubs import AgentStub
+
+CONFIG = {'inbounds': [], 'outbounds': [{'protocol': 'freedom'}]}
+
+
+@pytest.mark.parametrize('total, waves, sizes', [
+    (100, (5, 25, 100), [5, 20, 75]),
+    (3, (5, 25), [1, 1, 1]),
+    (1, (5, 25, 100), [1]),
+    (10, (50,), [5, 5]),
+])
+def test_servers_are_split_into_cumulative_waves(total, waves, sizes):
+    assert [len(wave) for wave in Rollout.split_waves(list(range(total)), waves)] == sizes
+
+
+def run_rollout(rollout: Rollout, errors=None, down=()):
+    """Выполнение раскатки с заглушками применения и проверки, возвращает примененные волны"""
+    applied = []
+
+    async def apply(server_ids):
+        applied.append(list(server_ids))
+        return {server_id: (errors or {}).get(server_id) for server_id in server_ids}
+
+    async def check(server_ids):
+        return {server_id: server_id not in down for server_id in server_ids}
+
+    asyncio.run(rollout.run(apply, check))
+    return applied
+
+
+def test_all_waves_are_applied_in_order():
+    rollout = Rollout('r1', list(range(1, 21)), CONFIG, waves=(10, 50), health_delay=0)
+
+    applied = run_rollout(rollout)
+
+    assert applied == [[1, 2], list(range(3, 11)), list(range(11, 21))]
+    assert rollout.status == 'completed' and rollout.finished is not None
+    assert rollout.to_dict()['succeeded'] == 20 and rollout.to_dict()['current_wave'] == 3
+
+
+def test_rollout_stops_when_wave_failure_rate_is_exceeded():
+    rollout = Rollout('r1', list(range(1, 21)), CONFIG, waves=(10, 50), max_failure_rate=0.2, health_delay=0)
+
+    # Во второй волне (8 серверов) один сбой применения и два недоступных сервера
+    applied = run_rollout(rollout, errors={3: 'HTTP 500'}, down={4, 5})
+
+    assert len(applied) == 2
+    result = rollout.to_dict()
+    assert result['status'] == 'aborted' and 'волне 2: 3/8' in result['error']
+    assert result['failures'] == {'3': 'HTTP 500', '4': 'Сервер недоступен после применения',
+                                  '5': 'Сервер недоступен после применения'}
+
+
+def test_cancelled_rollout_keeps_progress():
+    async def scenario():
+        rollout = Rollout('r1', [1, 2, 3], CONFIG, waves=(34,), health_delay=60)
+
+        async def apply(server_ids):
+            return dict.fromkeys(server_ids)
+
+        task = asyncio.create_task(rollout.run(apply, None))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return rollout
+
+    rollout = asyncio.run(scenario())
+
+    assert rollout.status == 'cancelled' and rollout.current_wave == 1 and rollout.finished is not None
+
+
+def test_rollout_commands(make_daemon, tmp_path):
+    async def scenario():
+        agent = await AgentStub().start()
+        listener = await asyncio.start_server(lambda reader, writer: writer.close(), '127.0.0.1', 0)
+        port = listener.sockets[0].getsockname()[1]
+        daemon = make_daemon()
+        await daemon.node_client.start()
+        await daemon.jobs.start()
+        try:
+            for server_id in (1, 2, 3):
+                await daemon.process_command('connect', {
+                    'server_id': server_id, 'server_name': f'node-{server_id}', 'server_ip': '127.0.0.1',
+                    'server_port': port, 'config_path': os.path.join(str(tmp_path), f'{server_id}.json'),
+                    'agent_url': agent.url
+                })
+
+            started = await daemon.process_command('rollout_config', {
+                'config': CONFIG, 'server_ids': [1, 2, 3], 'waves': [34], 'health_delay': 0
+            })
+            await asyncio.wait_for(daemon.rollouts[started['rollout_id']].task, timeout=10)
+            completed = await daemon.process_command('rollout_status', {'rollout_id': started['rollout_id']})
+
+            slow = await daemon.process_command('rollout_config', {'config': CONFIG, 'health_delay': 60})
+            await asyncio.sleep(0.1)
+            cancelled = await daemon.process_command('rollout_status', {'rollout_id': slow['rollout_id'],
+                                                                        'cancel': True})
+            listing = await daemon.process_command('rollout_status', {})
+            missing = await daemon.process_command('rollout_config', {'config': CONFIG, 'server_ids': [1, 42]})
+            return started, completed, cancelled, listing, missing, len(agent.configs)
+        finally:
+            await daemon.jobs.stop()
+            await daemon.node_client.close()
+            listener.close()
+            await agent.stop()
+
+    started, completed, cancelled, listing, missing, written = asyncio.run(scenario())
+
+    assert started['success'] and started['waves'] == [2, 1]
+    assert completed['status'] == 'completed' and completed['succeeded'] == 3
+    assert written == 3
+    assert cancelled['status'] == 'cancelled' and cancelled['current_wave'] == 1
+    assert [item['rollout_id'] for item in listing['rollouts']] == [cancelled['rollout_id'], started['rollout_id']]
+    assert not missing['success'] and '42' in missing['message']
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""Реестр серверов: загрузка при запуске, сроки offline и удаления, чтение списка через GET /servers"""
+
+import asyncio
+import datetime
+
+import aiohttp
+
+from daemon import ServerRecord
+from tests.stubs import serve
+
+
+def make_server(server_id: int) -> ServerRecord:
+    server = ServerRecord(server_id, f'daemon_{server_id}', f'node-{server_id}', '127.0.0.1', 443,
+                          '/etc/xray/config.json')
+    server.last_heartbeat = datetime.datetime.now() - datetime.timedelta(days=30)
+    return server
+
+
+def test_inactive_servers_are_kept_by_default(make_daemon):
+    async def scenario():
+        daemon = make_daemon()
+        server = make_server(1)
+        daemon.schedule_deadlines(server)
+        return daemon, server
+
+    daemon, server = asyncio.run(scenario())
+
+    assert daemon.inactive_server_ttl == 0
+    assert daemon.offline_deadlines.get(server.server_id) is not None
+    assert daemon.cleanup_deadlines.get(server.server_id) is None
+
+
+def test_inactive_ttl_schedules_removal(make_daemon):
+    async def scenario():
+        daemon = make_daemon()
+        daemon.inactive_server_ttl = 3600
+        server = make_server(1)
+        daemon.schedule_deadlines(server)
+        return daemon, server
+
+    daemon, server = asyncio.run(scenario())
+
+    assert daemon.cleanup_deadlines.get(server.server_id) == server.last_heartbeat.timestamp() + 3600
+
+
+def test_server_list_pages_and_etags(make_daemon):
+    async def scenario():
+        daemon = make_daemon()
+        for server_id in range(1, 6):
+            daemon.servers.add(make_server(server_id))
+        daemon.set_server_status(daemon.servers.get(3), 'online')
+
+        runner, url = await serve(daemon.build_app())
+        results = {}
+        try:
+            async with aiohttp.ClientSession(headers={'X-Auth-Key': daemon.secret}) as session:
+                async def get(path, **headers):
+                    async with session.get(url + path, headers=headers) as response:
+                        body = await response.json() if response.status != 304 else None
+                        return response.status, response.headers.get('ETag'), body
+
+                results['first'] = await get('/servers?limit=2')
+                results['next'] = await get(f"/servers?limit=2&cursor={results['first'][2]['next_cursor']}")
+                results['online'] = await get('/servers?status=online')
+                results['cached'] = await get('/servers?limit=2', **{'If-None-Match': results['first'][1]})
+                daemon.set_server_status(daemon.servers.get(1), 'online')
+                results['changed'] = await get('/servers?limit=2', **{'If-None-Match': results['first'][1]})
+                results['server'] = await get('/server/3')
+                results['missing'] = await get('/server/42')
+            async with aiohttp.ClientSession() as session:
+                async with session.get(url + '/servers') as response:
+                    results['anonymous'] = response.status
+        finally:
+            await runner.cleanup()
+        return results
+
+    results = asyncio.run(scenario())
+
+    status, etag, first = results['first']
+    assert status == 200 and etag
+    assert (first['total'], first['next_cursor']) == (5, 2)
+    assert [server['server_id'] for server in first['servers']] == [1, 2]
+    assert [server['server_id'] for server in results['next'][2]['servers']] == [3, 4]
+    assert [server['server_id'] for server in results['online'][2]['servers']] == [3]
+    assert results['cached'][0] == 304
+    assert results['changed'][0] == 200 and results['changed'][1] != etag
+    assert results['server'][2]['server']['status'] == 'online' and results['server'][2]['config'] is None
+    assert results['missing'][0] == 404
+    assert results['anonymous'] == 401
+
+
+def test_registry_is_preloaded_from_database(make_daemon):
+    async def scenario():
+        first = make_daemon('shared')
+        for server_id in (1, 2):
+            await first.process_command('connect', {
+                'server_id': server_id, 'server_name': f'node-{server_id}', 'server_ip': '127.0.0.1',
+                'server_port': 443, 'config_path': '/etc/xray/config.json'
+            })
+        first.set_server_status(first.servers.get(2), 'online')
+        await first.heartbeats.flush()
+
+        second = make_daemon('shared')
+        loaded = await second.load_servers(chunk_size=1)
+        return loaded, second
+
+    loaded, daemon = asyncio.run(scenario())
+
+    assert loaded == 2 and len(daemon.servers) == 2
+    assert daemon.servers.get(2).status == 'online'
+    server, error = daemon.find_server(1, daemon.servers.get(1).daemon_id)
+    assert error is None and server.name == 'node-1'
+    # Загруженным серверам сразу назначаются сроки перевода в offline
+    assert daemon.offline_deadlines.get(1) is not None
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""Сбор статистики: приращения счетчиков, агрегаты по интервалам, сроки хранения, агрегация по парку"""
+
+import asyncio
+
+import pytest
+
+import daemon
+from daemon import ERROR_INVALID_PARAMS, ServerRegistry, StatsCollector, aggregate_stats, normalize_stats, percentiles
+
+# Начало суток: границы минут, часов и дней совпадают
+DAY = 1700006400
+
+
+def make_collector(db, **options) -> StatsCollector:
+    return StatsCollector(db, ServerRegistry(), fetch=None, **options)
+
+
+def node_stats(connections: int, up: int, down: int) -> dict:
+    return {'inbound_connections': connections, 'total_up': up, 'total_down': down}
+
+
+def test_cumulative_counters_become_deltas(db):
+    collector = make_collector(db)
+
+    points = [
+        collector.make_point(1, DAY, node_stats(5, 1000, 5000)),
+        collector.make_point(1, DAY + 60, node_stats(7, 1500, 5200)),
+        # Счетчики уменьшились - узел перезапущен, приращение равно текущему значению
+        collector.make_point(1, DAY + 120, node_stats(2, 300, 100)),
+    ]
+
+    assert points == [(1, DAY, 5, 0, 0), (1, DAY + 60, 7, 500, 200), (1, DAY + 120, 2, 300, 100)]
+
+
+def test_points_are_rolled_up_by_minute_hour_and_day(db):
+    collector = make_collector(db)
+    points = [
+        (1, DAY + 5, 4, 100, 1000),
+        (1, DAY + 35, 8, 50, 500),
+        (1, DAY + 65, 6, 10, 100),
+        (1, DAY + 3600, 2, 1, 1),
+        (2, DAY + 5, 100, 9, 9),
+    ]
+
+    async def scenario():
+        await collector.write(points)
+        return {resolution: await collector.query(1, DAY, DAY + 86400, resolution)
+                for resolution in ('raw', '1m', '1h', '1d')}
+
+    results = asyncio.run(scenario())
+
+    assert len(results['raw']['points']) == 4
+    minutes = results['1m']['points']
+    assert [point['timestamp'] for point in minutes] == [DAY, DAY + 60, DAY + 3600]
+    assert minutes[0] == {'timestamp': DAY, 'samples': 2, 'connections_avg': 6.0, 'connections_max': 8,
+                          'traffic_up': 150, 'traffic_down': 1500}
+    hours = results['1h']['points']
+    assert [(point['samples'], point['traffic_up']) for point in hours] == [(3, 160), (1, 1)]
+    day = results['1d']['points']
+    assert day == [{'timestamp': DAY, 'samples': 4, 'connections_avg': 5.0, 'connections_max': 8,
+                    'traffic_up': 161, 'traffic_down': 1601}]
+
+
+def test_auto_resolution_depends_on_period(db):
+    collector = make_collector(db)
+
+    async def scenario():
+        return [(await collector.query(1, DAY, DAY + span))['resolution']
+                for span in (3600, 86400, 30 * 86400)]
+
+    assert asyncio.run(scenario()) == ['1m', '1h', '1d']
+
+
+def test_prune_keeps_rollups_longer_than_raw_points(db):
+    collector = make_collector(db, retention={'statistics': 3600, 'statistics_1m': 7200})
+
+    async def scenario():
+        await collector.write([(1, DAY, 1, 1, 1), (1, DAY + 5000, 1, 1, 1)])
+        deleted = await collector.prune(now=DAY + 8000)
+        return deleted, {resolution: len((await collector.query(1, DAY, DAY + 86400, resolution))['points'])
+                         for resolution in ('raw', '1m', '1h')}
+
+    deleted, counts = asyncio.run(scenario())
+
+    # Сырая точка DAY старше часа, минутный агрегат DAY - старше двух часов
+    assert deleted == 2
+    assert counts == {'raw': 1, '1m': 1, '1h': 2}
+
+
+def test_legacy_string_stats_are_normalized_to_numbers():
+    stats = normalize_stats({
+        'uptime': '1h 30m', 'inbound_connections': '12', 'outbound_connections': None,
+        'total_up': '1.5 GB', 'total_down': 2048,
+        'users': [{'id': 'uuid-1', 'email': 'a@example.com', 'up': '10 KiB', 'down': ''}]
+    })
+
+    assert stats == {
+        'uptime': 5400, 'inbound_connections': 12, 'outbound_connections': 0,
+        'total_up': int(1.5 * 1024 ** 3), 'total_down': 2048,
+        'users': [{'id': 'uuid-1', 'email': 'a@example.com', 'up': 10240, 'down': 0}]
+    }
+    with pytest.raises(ValueError):
+        normalize_stats({'total_up': 'много'})
+
+
+FLEET = {
+    1: {'uptime': 100, 'inbound_connections': 10, 'outbound_connections': 1, 'total_up': 100, 'total_down': 900,
+        'users': [{'id': 'u1', 'email': 'a@example.com', 'up': 50, 'down': 450},
+                  {'id': 'u2', 'email': None, 'up': 10, 'down': 10}]},
+    2: {'uptime': 300, 'inbound_connections': 30, 'outbound_connections': 2, 'total_up': 200, 'total_down': 800,
+        'users': [{'id': 'u1', 'email': 'a@example.com', 'up': 100, 'down': 100},
+                  {'id': 'u3', 'email': 'c@example.com', 'up': 300, 'down': 0}]},
+}
+
+
+@pytest.fixture(params=['numpy', 'pure'])
+def numpy_backend(request, monkeypatch):
+    """Агрегация с NumPy (если установлен) и без него"""
+    if request.param == 'numpy':
+        if daemon.numpy is None:
+            pytest.skip('NumPy не установлен')
+    else:
+        monkeypatch.setattr(daemon, 'numpy', None)
+    return request.param
+
+
+def test_fleet_aggregation(numpy_backend):
+    result = aggregate_stats(FLEET, top_n=2, percentile_points=(50, 100))
+
+    assert result['totals'] == {'servers': 2, 'users': 3, 'inbound_connections': 40, 'outbound_connections': 3,
+                                'total_up': 300, 'total_down': 1700}
+    # Пользователь с email суммируется по серверам, без email - определяется по id
+    assert result['top_users'] == [
+        {'user': 'a@example.com', 'up': 150, 'down': 550, 'total': 700},
+        {'user': 'c@example.com', 'up': 300, 'down': 0, 'total': 300}
+    ]
+    assert result['percentiles']['inbound_connections'] == {'p50': 20.0, 'p100': 30.0}
+    assert result['percentiles']['uptime'] == {'p50': 200.0, 'p100': 300.0}
+
+
+def test_percentiles_interpolate_like_numpy(numpy_backend):
+    assert percentiles([1, 2, 3, 4], (0, 25, 50, 90)) == {'p0': 1, 'p25': 1.75, 'p50': 2.5, 'p90': 3.7}
+    assert percentiles([], (50,)) == {'p50': 0}
+
+
+def test_empty_fleet_and_bad_parameters(make_daemon):
+    async def scenario():
+        instance = make_daemon()
+        return (await instance.process_command('aggregate_stats', {}),
+                await instance.process_command('aggregate_stats', {'top': 0}),
+                await instance.process_command('aggregate_stats', {'percentiles': [50, 150]}))
+
+    empty, bad_top, bad_points = asyncio.run(scenario())
+
+    assert empty['success'] and empty['totals']['servers'] == 0 and empty['top_users'] == []
+    assert bad_top['error'] == ERROR_INVALID_PARAMS and bad_points['error'] == ERROR_INVALID_PARAMS
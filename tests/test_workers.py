@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""Режим нескольких рабочих процессов: команды процесса 0, общий кеш nonce, перезапуск процессов"""
+
+import asyncio
+import os
+import socket
+import sys
+import time
+
+import aiohttp
+
+from daemon import ERROR_INVALID_PARAMS, RequestAuthenticator, WorkerSupervisor
+from tests.stubs import AgentStub
+
+KEY = 'k' * 64
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def public_url(daemon) -> str:
+    return f"http://127.0.0.1:{daemon.site._server.sockets[0].getsockname()[1]}"
+
+
+async def wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'условие не выполнено за отведенное время'
+        await asyncio.sleep(0.05)
+
+
+def run_workers(make_daemon, scenario):
+    """Запуск сценария scenario(primary, worker) с двумя процессами демона в одном цикле событий"""
+    async def main():
+        port = free_port()
+        primary, worker = make_daemon('shared'), make_daemon('shared')
+        for worker_id, daemon in enumerate((primary, worker)):
+            daemon.enable_workers(worker_id, 2, port, 'w' * 64)
+            daemon.auth.add_key('panel', KEY)
+            await daemon.start()
+        try:
+            return await scenario(primary, worker)
+        finally:
+            for daemon in (worker, primary):
+                await daemon.stop()
+
+    return asyncio.run(main())
+
+
+def test_stateful_commands_run_in_worker_zero(make_daemon, tmp_path):
+    async def scenario(primary, worker):
+        agent = await AgentStub().start()
+        try:
+            await worker.process_command('connect', {
+                'server_id': 1, 'server_name': 'node-1', 'server_ip': '127.0.0.1', 'server_port': 443,
+                'config_path': os.path.join(str(tmp_path), 'config.json'), 'agent_url': agent.url
+            })
+            await wait_for(lambda: 1 in primary.servers)
+
+            restart = await worker.process_command('restart_xray', {'server_id': 1, 'wait': True})
+            status = await worker.process_command('job_status', {'job_id': restart['job_id']})
+            invalid = await worker.process_command('update_config', {
+                'server_id': 1, 'patch': [{'op': 'add', 'path': ['inbounds'], 'value': 1}], 'base_hash': 'x'
+            })
+            # Локальные команды процесс выполняет сам
+            local = await worker.process_command('check_status', {'server_id': 1})
+            return restart, status, invalid, local, primary.jobs.submitted, worker.jobs.submitted, worker
+        finally:
+            await agent.stop()
+
+    restart, status, invalid, local, primary_jobs, worker_jobs, worker = run_workers(make_daemon, scenario)
+
+    assert restart['success'] and restart['result'] == {'restarted': True}
+    assert status['success'] and status['job']['status'] == 'success'
+    # Ответ 400 процесса 0 возвращается как есть
+    assert invalid['error'] == ERROR_INVALID_PARAMS
+    assert local['success']
+    assert (primary_jobs, worker_jobs) == (1, 0)
+    assert worker.primary_forwarded == 3
+
+
+def test_replay_into_another_worker_is_rejected(make_daemon):
+    async def scenario(primary, worker):
+        body = b'{}'
+        headers = RequestAuthenticator.signed_headers('panel', KEY, 'POST', '/api/loop_stats', body)
+        headers['Content-Type'] = 'application/json'
+        statuses = []
+        async with aiohttp.ClientSession() as session:
+            for daemon in (primary, worker):
+                async with session.post(public_url(daemon) + '/api/loop_stats', data=body, headers=headers) as response:
+                    statuses.append(response.status)
+        return statuses
+
+    assert run_workers(make_daemon, scenario) == [200, 401]
+
+
+def exit_immediately(worker_id: int):
+    sys.exit(3)
+
+
+def test_supervisor_restarts_crashed_worker_with_backoff():
+    supervisor = WorkerSupervisor(1, exit_immediately, restart_delay=0.05, max_restart_delay=0.2, stop_timeout=5)
+    supervisor.start()
+    try:
+        deadline = time.monotonic() + 10
+        while supervisor.restarts < 3 and time.monotonic() < deadline:
+            supervisor.check()
+            time.sleep(0.01)
+        delays = dict(supervisor._delays)
+    finally:
+        supervisor.terminate()
+
+    assert supervisor.restarts >= 3
+    # Процесс падает сразу после запуска: задержка удваивается до максимума
+    assert delays[0] == 0.2
+    assert supervisor.stats()['alive'] == 0